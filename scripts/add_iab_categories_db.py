@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+add_iab_categories_db.py - IAB Content Taxonomy enrichment for the database
+
+Maps each classification's generic category to IAB tier 1 / tier 2 and the
+sensitive-content flags, using the iab_mapping table (seeded from
+DEFAULT_IAB_MAPPING). Enrichment is one set-based UPDATE per chunk of
+classification ids with iab_enriched = 0, so a rerun only touches new rows.
+
+  python3 add_iab_categories_db.py --db wxawebcat.db
+  python3 add_iab_categories_db.py --db wxawebcat.db --mapping my_mapping.csv --reenrich
+
+To skip this pass altogether, run the classifier with --inline-iab.
+"""
+
+import argparse
+import csv
+import time
+from typing import Dict, Tuple
+
+from wxawebcat_db import (
+    DatabaseConfig,
+    IAB_COLUMNS,
+    configure_database,
+    enrich_iab,
+    fan_out,
+    get_connection,
+    init_database,
+    load_iab_mapping,
+    set_iab_mapping,
+    shard_paths,
+)
+
+
+def read_mapping_csv(path: str) -> Dict[str, Tuple]:
+    """
+    Mapping from a CSV with a header row: category, IAB_COLUMNS...
+
+    is_sensitive is 0/1 (or true/false); sensitive_categories is a
+    ';'-separated list.
+    """
+    mapping = {}
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            missing = [c for c in ('category',) + IAB_COLUMNS if c not in row]
+            if missing:
+                raise ValueError(f"{path}: missing column(s) {', '.join(missing)}")
+            mapping[row['category'].strip()] = (
+                row['iab_tier1_id'] or None,
+                row['iab_tier1_name'] or None,
+                row['iab_tier2_id'] or None,
+                row['iab_tier2_name'] or None,
+                row['is_sensitive'].strip().lower() in ('1', 'true', 'yes'),
+                [c.strip() for c in row['sensitive_categories'].split(';') if c.strip()],
+            )
+    return mapping
+
+
+def reset_enrichment(conn) -> int:
+    """Queue every classification (enriched or without a mapping) for enrichment again"""
+    conn.execute("UPDATE current_classification SET iab_enriched = 0 WHERE iab_enriched != 0")
+    return conn.execute(
+        "UPDATE classifications SET iab_enriched = 0 WHERE iab_enriched != 0").rowcount
+
+
+def print_mapping(db_path: str):
+    # --mapping writes every shard; on a sharded database the main file
+    # only keeps the seeded defaults
+    with get_connection(shard_paths(db_path)[0]) as conn:
+        mapping = load_iab_mapping(conn)
+    print(f"\n{'CATEGORY':20s} {'IAB TIER 1':28s} {'IAB TIER 2':24s} SENSITIVE")
+    for category, (_, tier1, _, tier2, sensitive, _) in sorted(mapping.items()):
+        print(f"{category:20s} {tier1 or '-':28s} {tier2 or '-':24s} {'yes' if sensitive else ''}")
+
+
+def main():
+    p = argparse.ArgumentParser(description="Add IAB taxonomy to classifications")
+    p.add_argument("--db", default="wxawebcat.db", help="Database path")
+    p.add_argument("--config", help="TOML file with a [database] section")
+    p.add_argument("--chunk-size", type=int, default=50000,
+                   help="Classification ids per UPDATE / transaction (default: 50000)")
+    p.add_argument("--mapping", help="CSV replacing the category -> IAB mapping table")
+    p.add_argument("--reenrich", action="store_true",
+                   help="Enrich every classification again (e.g. after changing the mapping)")
+    p.add_argument("--show-mapping", action="store_true", help="Print the mapping table")
+    args = p.parse_args()
+
+    if args.config:
+        configure_database(args.db, DatabaseConfig.from_toml(args.config))
+    init_database(args.db)
+
+    if args.mapping:
+        try:
+            mapping = read_mapping_csv(args.mapping)
+        except (OSError, ValueError) as e:
+            p.error(str(e))
+        fan_out(args.db, set_iab_mapping, mapping)
+        print(f"✓ Loaded {len(mapping)} category mappings from {args.mapping}")
+
+    if args.show_mapping:
+        print_mapping(args.db)
+        return
+
+    if args.reenrich:
+        reset = sum(fan_out(args.db, reset_enrichment))
+        print(f"Re-enriching {reset:,} classifications")
+
+    started = time.time()
+
+    def progress(path: str, position: int, last: int, enriched: int):
+        print(f"  {path}: id {position:,}/{last:,} - {enriched:,} enriched")
+
+    enriched = enrich_iab(args.db, max(1, args.chunk_size), progress)
+    elapsed = time.time() - started
+    print(f"✓ IAB-enriched {enriched:,} classifications in {elapsed:.1f}s"
+          + (f" ({enriched / elapsed:,.0f}/s)" if elapsed > 0 and enriched else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+wxawebcat_archive.py - Content-addressed archive of fetched pages
+
+With --archive DIR the fetcher keeps each page's raw HTML (truncated to
+max_body_bytes). Pages are compressed one frame each (zstd if the
+`zstandard` package is installed, zlib otherwise), deduplicated by hash and
+appended to segment files in DIR. The page_archive table maps each hash to
+its segment, offset and length; domains.page_hash links a domain to the
+page it was last fetched with. On a sharded database each shard keeps its
+own page_archive index over the shared segment files, so deduplication is
+per shard: a page fetched for domains on two shards is stored twice.
+
+Rebuild title / meta / body_snippet in http_data from the archive, in
+parallel and without touching the network:
+  python3 wxawebcat_archive.py --db wxawebcat.db --archive pages/ --reextract
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from wxawebcat_db import (
+    FetchRecord,
+    build_content_fingerprint,
+    fan_out,
+    get_connection,
+    init_database,
+    shard_paths,
+)
+
+
+SEGMENT_MAX_BYTES = 256 * 1024 * 1024
+
+
+def page_hash(raw: bytes) -> str:
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+def segment_path(root: Path, segment: int) -> Path:
+    return root / f"seg-{segment:06d}.dat"
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("This archive needs zstandard: pip install zstandard")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+class PageArchive:
+    """
+    Append-only page writer, driven by the fetcher's DB writer thread.
+
+    Segment data is flushed and fsynced before the DB transaction holding
+    its index rows commits, so an index row never points past the data, even
+    after a power loss. Bytes written by a batch that then fails to commit
+    are simply never referenced. Pages are deduplicated against the index
+    of the connection passed in, i.e. per shard.
+    """
+
+    def __init__(self, root: str, level: int = 3,
+                 segment_max_bytes: int = SEGMENT_MAX_BYTES):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.segment_max_bytes = segment_max_bytes
+        if zstandard is not None:
+            self.codec = "zstd"
+            self._zstd = zstandard.ZstdCompressor(level=level)
+        else:
+            self.codec = "zlib"
+            self.level = min(level, 9)
+        segments = sorted(self.root.glob("seg-*.dat"))
+        self.segment = int(segments[-1].stem.split('-')[1]) if segments else 1
+        self._file = None
+        self.stored = 0
+        self.deduplicated = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+
+    def compress(self, raw: bytes) -> bytes:
+        if self.codec == "zstd":
+            return self._zstd.compress(raw)
+        return zlib.compress(raw, self.level)
+
+    def _append(self, data: bytes) -> Tuple[int, int]:
+        if self._file is None:
+            self._file = open(segment_path(self.root, self.segment), 'ab')
+        if self._file.tell() and self._file.tell() + len(data) > self.segment_max_bytes:
+            self._file.close()
+            self.segment += 1
+            self._file = open(segment_path(self.root, self.segment), 'ab')
+        offset = self._file.tell()
+        self._file.write(data)
+        return self.segment, offset
+
+    def store_batch(self, conn: sqlite3.Connection, results: List[FetchRecord]):
+        """Archive each result's raw_html (cleared on it) and set its page_hash"""
+        pages: Dict[str, bytes] = {}
+        archived = 0
+        for r in results:
+            raw = r.raw_html
+            if raw:
+                r.raw_html = None
+                h = page_hash(raw)
+                r.page_hash = h
+                pages.setdefault(h, raw)
+                archived += 1
+        if not pages:
+            return
+
+        hashes = list(pages)
+        known = set()
+        for i in range(0, len(hashes), 500):
+            chunk = hashes[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            known.update(row[0] for row in conn.execute(
+                f"SELECT page_hash FROM page_archive WHERE page_hash IN ({placeholders})", chunk))
+
+        rows = []
+        for h, raw in pages.items():
+            if h in known:
+                continue
+            data = self.compress(raw)
+            segment, offset = self._append(data)
+            rows.append((h, segment, offset, len(data), len(raw), self.codec))
+            self.raw_bytes += len(raw)
+            self.stored_bytes += len(data)
+        if rows:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            conn.executemany("""
+                INSERT OR IGNORE INTO page_archive
+                    (page_hash, segment, offset, length, raw_length, codec)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, rows)
+        self.stored += len(rows)
+        self.deduplicated += archived - len(rows)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def summary(self) -> str:
+        ratio = self.raw_bytes / self.stored_bytes if self.stored_bytes else 0
+        return (f"{self.stored:,} pages stored ({self.deduplicated:,} deduplicated), "
+                f"{self.raw_bytes / 1e6:.1f} MB -> {self.stored_bytes / 1e6:.1f} MB "
+                f"({ratio:.1f}x {self.codec})")
+
+
+def read_page(root: str, segment: int, offset: int, length: int, codec: str) -> bytes:
+    """Raw HTML of one archived page"""
+    with open(segment_path(Path(root), segment), 'rb') as f:
+        f.seek(offset)
+        return decompress(f.read(length), codec)
+
+
+def _reextract_chunk(root: str, segment: int, entries: List[Tuple[str, int, int, str]],
+                     max_body_bytes: Optional[int] = None) -> List[Tuple[str, Dict, str]]:
+    """Worker: decompress and re-extract one segment's run of pages, in file order"""
+    # Imported here: the fetcher itself imports this module
+    from wxawebcat_web_fetcher_db import FetchConfig, extract_page
+
+    # The cap the fetcher extracted with, so the fields come out the same
+    max_chars = max_body_bytes or FetchConfig.max_body_bytes
+
+    out = []
+    with open(segment_path(Path(root), segment), 'rb') as f:
+        for h, offset, length, codec in entries:
+            f.seek(offset)
+            html = decompress(f.read(length), codec).decode('utf-8', errors='ignore')
+            fields = extract_page(html, max_chars)
+            out.append((h, fields, build_content_fingerprint(fields)))
+    return out
+
+
+def _chunks(rows: List[sqlite3.Row], size: int):
+    """Group index rows (ordered by segment, offset) into per-segment runs"""
+    start = 0
+    while start < len(rows):
+        segment = rows[start]["segment"]
+        end = start
+        while end < len(rows) and end - start < size and rows[end]["segment"] == segment:
+            end += 1
+        yield segment, [(r["page_hash"], r["offset"], r["length"], r["codec"])
+                        for r in rows[start:end]]
+        start = end
+
+
+def apply_extractions(conn: sqlite3.Connection, extracted: List[Tuple[str, Dict, str]]):
+    """Write re-extracted fields to every successful domain sharing each page"""
+    # Domains whose fingerprint changed go back to the classifier
+    conn.executemany("""
+        UPDATE domains SET
+            http_data = json_set(http_data, '$.title', ?, '$.meta', json(?),
+                                 '$.body_snippet', ?),
+            classified = CASE WHEN content_hash IS ? THEN classified ELSE 0 END,
+            content_hash = ?,
+            updated_at = datetime('now')
+        WHERE page_hash = ? AND fetch_status = 'success'
+    """, [(f["title"], json.dumps(f["meta"]), f["body_snippet"], fp, fp, h)
+          for h, f, fp in extracted])
+
+
+def reextract(db_path: str, root: str, workers: int, chunk_size: int = 2000,
+              max_body_bytes: Optional[int] = None) -> int:
+    """
+    Rebuild http_data fields for every archived page; returns pages processed.
+    `max_body_bytes` is the fetcher's (default: FetchConfig.max_body_bytes).
+    """
+    # Each shard indexes the pages of its own domains
+    return sum(_reextract_shard(path, root, workers, chunk_size, max_body_bytes)
+               for path in shard_paths(db_path))
+
+
+def _reextract_shard(db_path: str, root: str, workers: int, chunk_size: int,
+                     max_body_bytes: Optional[int]) -> int:
+    with get_connection(db_path) as conn:
+        rows = conn.execute("""
+            SELECT page_hash, segment, offset, length, codec FROM page_archive
+            WHERE page_hash IN (SELECT page_hash FROM domains WHERE page_hash IS NOT NULL)
+            ORDER BY segment, offset
+        """).fetchall()
+
+    print(f"Re-extracting {len(rows):,} archived pages with {workers} workers...")
+    started = time.time()
+    done = 0
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        chunks = _chunks(rows, chunk_size)
+        pending = set()
+        while True:
+            # Bounded in-flight work keeps memory flat on big archives
+            for segment, entries in chunks:
+                pending.add(pool.submit(_reextract_chunk, root, segment, entries,
+                                        max_body_bytes))
+                if len(pending) >= workers * 2:
+                    break
+            if not pending:
+                break
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                extracted = future.result()
+                with get_connection(db_path) as conn:
+                    apply_extractions(conn, extracted)
+                done += len(extracted)
+            elapsed = time.time() - started
+            print(f"  {done:,}/{len(rows):,} pages ({done / elapsed:.0f}/s)")
+
+    print(f"✓ Re-extracted {done:,} pages in {time.time() - started:.1f}s")
+    return done
+
+
+def print_archive_stats(db_path: str, root: Optional[str]):
+    def shard_stats(conn):
+        row = conn.execute("""
+            SELECT COUNT(*), COALESCE(SUM(length), 0), COALESCE(SUM(raw_length), 0)
+            FROM page_archive
+        """).fetchone()
+        domains = conn.execute(
+            "SELECT COUNT(*) FROM domains WHERE page_hash IS NOT NULL").fetchone()[0]
+        segments = {r[0] for r in conn.execute("SELECT DISTINCT segment FROM page_archive")}
+        codecs = dict(conn.execute("SELECT codec, COUNT(*) FROM page_archive GROUP BY codec").fetchall())
+        return tuple(row) + (domains, segments, codecs)
+
+    pages = stored = raw = domains = 0
+    segments, codecs = set(), {}
+    for shard in fan_out(db_path, shard_stats):
+        pages += shard[0]
+        stored += shard[1]
+        raw += shard[2]
+        domains += shard[3]
+        segments |= shard[4]
+        for codec, n in shard[5].items():
+            codecs[codec] = codecs.get(codec, 0) + n
+    print(f"\n{'='*70}")
+    print(f"PAGE ARCHIVE")
+    print(f"{'='*70}")
+    print(f"Pages:        {pages:,} ({codecs or 'none'})")
+    print(f"Domains:      {domains:,} linked to an archived page")
+    print(f"Raw size:     {raw / 1e6:,.1f} MB")
+    print(f"Stored size:  {stored / 1e6:,.1f} MB in {len(segments)} segment(s)"
+          + (f" ({raw / stored:.1f}x)" if stored else ""))
+    if root:
+        on_disk = sum(p.stat().st_size for p in Path(root).glob("seg-*.dat"))
+        print(f"On disk:      {on_disk / 1e6:,.1f} MB")
+    print(f"{'='*70}")
+
+
+def main():
+    p = argparse.ArgumentParser(description="Archived page maintenance")
+    p.add_argument("--db", default="wxawebcat.db")
+    p.add_argument("--archive", help="Archive directory (as passed to the fetcher)")
+    p.add_argument("--reextract", action="store_true",
+                   help="Rebuild title/meta/body_snippet in http_data from the archive")
+    p.add_argument("--stats", action="store_true", help="Show archive statistics")
+    p.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                   help="Re-extraction processes (default: CPU count)")
+    p.add_argument("--max-body-bytes", type=int,
+                   help="Extraction cap the pages were fetched with "
+                        "(default: the fetcher's max_body_bytes)")
+    args = p.parse_args()
+
+    if args.reextract and not args.archive:
+        p.error("--reextract needs --archive")
+
+    init_database(args.db)
+    if args.reextract:
+        reextract(args.db, args.archive, max(1, args.workers),
+                  max_body_bytes=args.max_body_bytes)
+    if args.stats or not args.reextract:
+        print_archive_stats(args.db, args.archive)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,26 +7,32 @@ OPTIMIZED VERSION with batch commits - 100x faster!
 
 import argparse
 import asyncio
-import hashlib
+import csv
 import json
-import re
 from dataclasses import dataclass
 from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
 
 import httpx
 
-from wxawebcat_db import get_connection, get_domains_to_classify, get_statistics
-
-
-def read_toml(path: str) -> dict:
-    """Read TOML configuration file"""
-    try:
-        import tomllib
-    except ImportError:
-        import tomli as tomllib
-    
-    with open(path, "rb") as f:
-        return tomllib.load(f)
+from wxawebcat_db import (
+    DEFAULT_AGING_SHARE,
+    ClassificationRecord,
+    DatabaseConfig,
+    build_content_fingerprint,
+    configure_database,
+    get_connection,
+    get_domains_to_classify,
+    get_pending_count,
+    get_total_statistics,
+    init_database,
+    insert_classifications_bulk,
+    load_iab_mapping,
+    partition,
+    priority_order,
+    read_toml,
+    shard_paths,
+)
 
 
 @dataclass
@@ -44,6 +50,12 @@ class ClassifierConfig:
     batch_size: int = 100  # Commit every N domains
     watch_mode: bool = False  # Continuously watch for new domains
     watch_interval: int = 10  # Seconds between checks for new domains
+    shard: Optional[int] = None  # Only classify this shard of a sharded database
+    inline_iab: bool = False  # Write IAB taxonomy with each batch (no separate pass)
+    aging_share: float = DEFAULT_AGING_SHARE  # Share of picks taken oldest-first, not by priority
+    enable_redirect_cache: bool = True
+    redirect_seed_file: Optional[str] = None  # Extra "host,category[,confidence]" seeds
+    redirect_min_confidence: float = 0.8  # LLM decisions below this are not reused
     
     @classmethod
     def from_toml(cls, toml_path: str, db_path: str = None):
@@ -54,6 +66,7 @@ class ClassifierConfig:
         classifier_cfg = cfg_dict.get("classifier", {})
         content_hash_cfg = cfg_dict.get("content_hash", {})
         tld_cfg = cfg_dict.get("tld_rules", {})
+        redirect_cfg = cfg_dict.get("redirect_cache", {})
         
         return cls(
             db_path=db_path or "wxawebcat.db",
@@ -68,6 +81,11 @@ class ClassifierConfig:
             batch_size=classifier_cfg.get("batch_size", 100),
             watch_mode=classifier_cfg.get("watch_mode", False),
             watch_interval=classifier_cfg.get("watch_interval", 10),
+            inline_iab=classifier_cfg.get("inline_iab", False),
+            aging_share=float(classifier_cfg.get("aging_share", DEFAULT_AGING_SHARE)),
+            enable_redirect_cache=redirect_cfg.get("enabled", True),
+            redirect_seed_file=redirect_cfg.get("seed_file") or None,
+            redirect_min_confidence=float(redirect_cfg.get("min_confidence", 0.8)),
         )
 
 
@@ -167,16 +185,98 @@ def rule_preclass(doc: Dict[str, Any], enable_tld_rules: bool = True) -> Optiona
     return None
 
 
-def build_content_fingerprint(http: Dict[str, Any]) -> str:
-    """Build content fingerprint"""
-    title = (http.get("title") or "").strip()
-    meta_desc = ((http.get("meta", {}) or {}).get("description") or "").strip()
-    snippet = (http.get("body_snippet") or "")[:500].strip()
-    
-    combined = f"{title}|{meta_desc}|{snippet}".lower()
-    combined = re.sub(r'\s+', ' ', combined)
-    
-    return hashlib.sha256(combined.encode('utf-8')).hexdigest()
+# Redirect targets that say nothing about the domain sending visitors there:
+# parking services, aftermarkets and registrar landing pages. They match the
+# final_url host and its subdomains; [redirect_cache] seed_file adds more.
+REDIRECT_HOST_SEEDS = {
+    "sedoparking.com": ("Parked", 0.97, "Sedo parking"),
+    "sedo.com": ("Parked", 0.95, "Sedo marketplace"),
+    "parkingcrew.net": ("Parked", 0.97, "ParkingCrew parking"),
+    "bodis.com": ("Parked", 0.97, "Bodis parking"),
+    "above.com": ("Parked", 0.95, "Above.com parking"),
+    "afternic.com": ("Parked", 0.95, "Afternic marketplace"),
+    "dan.com": ("Parked", 0.95, "Dan.com marketplace"),
+    "hugedomains.com": ("Parked", 0.97, "HugeDomains marketplace"),
+    "buydomains.com": ("Parked", 0.95, "BuyDomains marketplace"),
+    "undeveloped.com": ("Parked", 0.95, "Undeveloped marketplace"),
+    "domainmarket.com": ("Parked", 0.95, "DomainMarket marketplace"),
+    "godaddy.com": ("Parked", 0.85, "GoDaddy landing page"),
+    "namecheap.com": ("Parked", 0.85, "Namecheap landing page"),
+}
+
+
+def _site(host: str) -> str:
+    return host[4:] if host.startswith("www.") else host
+
+
+def redirect_host(doc: Dict[str, Any]) -> Optional[str]:
+    """Normalized host of final_url when the fetch ended on another site, else None"""
+    final_url = (doc.get("http") or {}).get("final_url")
+    if not final_url:
+        return None
+    try:
+        host = (urlsplit(final_url).hostname or "").rstrip(".")
+    except ValueError:
+        return None
+    if not host:
+        return None
+    # example.com -> www.example.com (or shop.example.com) stays on the site
+    site, origin = _site(host), _site((doc.get("fqdn") or "").lower())
+    if site == origin or site.endswith("." + origin) or origin.endswith("." + site):
+        return None
+    return host
+
+
+def read_redirect_seeds(path: str) -> Dict[str, Tuple[str, float, str]]:
+    """host,category[,confidence] lines ('#' comments) -> REDIRECT_HOST_SEEDS entries"""
+    seeds = {}
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.reader(f):
+            if not row or not row[0].strip() or row[0].startswith('#'):
+                continue
+            host = row[0].strip().lower().rstrip('.')
+            confidence = float(row[2]) if len(row) > 2 and row[2].strip() else 0.95
+            seeds[host] = (row[1].strip(), confidence, f"seed {host}")
+    return seeds
+
+
+def load_redirect_cache(cfg: ClassifierConfig) -> Dict[str, Tuple[str, float, str, bool]]:
+    """
+    Redirect host -> (category, confidence, example fqdn or seed note, seeded).
+
+    LLM decisions persisted by every shard, overridden by the seeds.
+    """
+    cache = {}
+    for path in shard_paths(cfg.db_path):
+        with get_connection(path) as conn:
+            cursor = conn.execute("SELECT host, category, confidence, example_fqdn FROM redirect_host_cache")
+            for row in cursor:
+                cache[row[0]] = (row[1], row[2], row[3], False)
+    seeds = dict(REDIRECT_HOST_SEEDS)
+    if cfg.redirect_seed_file:
+        seeds.update(read_redirect_seeds(cfg.redirect_seed_file))
+    for host, (category, confidence, note) in seeds.items():
+        cache[host] = (category, confidence, note, True)
+    return cache
+
+
+def lookup_redirect_cache(cache: Dict[str, Tuple[str, float, str, bool]], host: str,
+                          fqdn: str) -> Optional[Tuple[str, float, str, bool]]:
+    """Entry for host, or for a seeded parent of it (ww1.sedoparking.com)"""
+    labels = fqdn.lower().split(".")
+    name = host
+    while True:
+        entry = cache.get(name)
+        if entry and entry[3]:
+            # A seed never matches its own brand's domains (godaddy.net -> godaddy.com)
+            if name.split(".")[0] not in labels:
+                return entry
+        elif entry and name == host:
+            return entry
+        dot = name.find(".")
+        if dot < 0 or name.find(".", dot + 1) < 0:
+            return None
+        name = name[dot + 1:]
 
 
 def build_llm_payload(doc: Dict[str, Any], model: str) -> Dict[str, Any]:
@@ -237,156 +337,205 @@ class Metrics:
     rule: int = 0
     tld_classified: int = 0
     hash_cache_hits: int = 0
+    redirect_cache_hits: int = 0
     llm: int = 0
     errors: int = 0
 
 
-async def process_one(domain: Dict[str, Any], cfg: ClassifierConfig, 
-                     llm_sem: asyncio.Semaphore, client: httpx.AsyncClient,
-                     content_hash_cache: Dict[str, Tuple[str, float, str]],
-                     metrics: Metrics) -> Optional[Dict]:
-    """Process one domain (NO database writes)"""
+def preclassify(domain: Dict[str, Any], cfg: ClassifierConfig,
+                content_hash_cache: Dict[str, Tuple[str, float, str]],
+                metrics: Metrics,
+                redirect_cache: Optional[Dict[str, Tuple[str, float, str, bool]]] = None
+                ) -> Optional[ClassificationRecord]:
+    """Rules, redirect and content hash caches only; None means the domain needs the LLM"""
     
     domain_id = domain['domain_id']
     fqdn = domain['fqdn']
     
-    try:
-        # Rules first
-        rule = rule_preclass(domain, enable_tld_rules=cfg.enable_tld_rules)
+    # Rules first
+    rule = rule_preclass(domain, enable_tld_rules=cfg.enable_tld_rules)
+    
+    if rule:
+        category, conf, reason = rule
+        metrics.rule += 1
         
-        if rule:
-            category, conf, reason = rule
-            metrics.rule += 1
+        if "TLD" in reason:
+            metrics.tld_classified += 1
+        
+        return ClassificationRecord(
+            domain_id, fqdn, 'rules', category, conf, reason,
+            signals={'http_status': domain.get("http", {}).get("status")},
+        )
+    
+    # Redirect target cache: whole parking / redirect farms share a decision
+    if cfg.enable_redirect_cache and redirect_cache:
+        host = redirect_host(domain)
+        cached = lookup_redirect_cache(redirect_cache, host, fqdn) if host else None
+        if cached:
+            metrics.redirect_cache_hits += 1
             
-            if "TLD" in reason:
-                metrics.tld_classified += 1
+            return ClassificationRecord(
+                domain_id, fqdn, 'redirect_cache', cached[0], cached[1],
+                f"redirect_cache: {host} matched {cached[2]}",
+                signals={'http_status': domain.get("http", {}).get("status"),
+                         'redirect_host': host},
+            )
+    
+    # Content hash dedup
+    if cfg.enable_content_hash_dedup:
+        http = domain.get("http", {})
+        snippet = http.get("body_snippet") or ""
+        
+        if len(snippet) >= cfg.min_content_length_for_hash:
+            content_hash = build_content_fingerprint(http)
             
-            return {
-                'domain_id': domain_id,
-                'fqdn': fqdn,
-                'method': 'rules',
-                'category': category,
-                'confidence': conf,
-                'reason': reason,
-                'signals': {'http_status': domain.get("http", {}).get("status")},
-                'llm_raw': None,
-                'content_hash': None
-            }
+            if content_hash in content_hash_cache:
+                cached = content_hash_cache[content_hash]
+                metrics.hash_cache_hits += 1
+                
+                return ClassificationRecord(
+                    domain_id, fqdn, 'hash_cache', cached[0], cached[1],
+                    f"hash_cache: matched {cached[2]}",
+                    signals={'http_status': http.get("status")},
+                    content_hash=content_hash,
+                )
+    
+    return None
+
+
+async def classify_with_llm(domain: Dict[str, Any], cfg: ClassifierConfig,
+                            llm_sem: asyncio.Semaphore, client: httpx.AsyncClient,
+                            content_hash_cache: Dict[str, Tuple[str, float, str]],
+                            metrics: Metrics,
+                            redirect_cache: Optional[Dict[str, Tuple[str, float, str, bool]]] = None
+                            ) -> Optional[ClassificationRecord]:
+    """LLM classification; also feeds the in-memory content hash and redirect caches"""
+    
+    fqdn = domain['fqdn']
+    
+    async with llm_sem:
+        result = await llm_classify(client, cfg, domain)
+    
+    if result.get("ok"):
+        parsed = result["parsed"]
+        category = parsed.get("category", "Other")
+        confidence = float(parsed.get("confidence", 0.5))
+        rationale = parsed.get("rationale", "")
+        
+        metrics.llm += 1
         
-        # Content hash dedup
+        # Update in-memory cache
+        content_hash = None
         if cfg.enable_content_hash_dedup:
             http = domain.get("http", {})
             snippet = http.get("body_snippet") or ""
-            
             if len(snippet) >= cfg.min_content_length_for_hash:
                 content_hash = build_content_fingerprint(http)
-                
-                if content_hash in content_hash_cache:
-                    cached = content_hash_cache[content_hash]
-                    metrics.hash_cache_hits += 1
-                    
-                    return {
-                        'domain_id': domain_id,
-                        'fqdn': fqdn,
-                        'method': 'hash_cache',
-                        'category': cached[0],
-                        'confidence': cached[1],
-                        'reason': f"hash_cache: matched {cached[2]}",
-                        'signals': {'http_status': http.get("status")},
-                        'llm_raw': None,
-                        'content_hash': content_hash
-                    }
+                content_hash_cache[content_hash] = (category, confidence, fqdn)
         
-        # LLM classification
-        async with llm_sem:
-            result = await llm_classify(client, cfg, domain)
+        # Confident decisions for off-site redirects cover the target host
+        host = None
+        if (cfg.enable_redirect_cache and redirect_cache is not None
+                and confidence >= cfg.redirect_min_confidence):
+            host = redirect_host(domain)
+            # Hosts under a seed keep the seed, even after its own brand's domains
+            cached = lookup_redirect_cache(redirect_cache, host, "") if host else None
+            if host and not (cached and cached[3]):
+                redirect_cache[host] = (category, confidence, fqdn, False)
+            else:
+                host = None
         
-        if result.get("ok"):
-            parsed = result["parsed"]
-            category = parsed.get("category", "Other")
-            confidence = float(parsed.get("confidence", 0.5))
-            rationale = parsed.get("rationale", "")
-            
-            metrics.llm += 1
-            
-            # Update in-memory cache
-            content_hash = None
-            if cfg.enable_content_hash_dedup:
-                http = domain.get("http", {})
-                snippet = http.get("body_snippet") or ""
-                if len(snippet) >= cfg.min_content_length_for_hash:
-                    content_hash = build_content_fingerprint(http)
-                    content_hash_cache[content_hash] = (category, confidence, fqdn)
-            
-            return {
-                'domain_id': domain_id,
-                'fqdn': fqdn,
-                'method': 'llm',
-                'category': category,
-                'confidence': confidence,
-                'reason': rationale,
-                'signals': {'http_status': domain.get("http", {}).get("status")},
-                'llm_raw': result["raw"],
-                'content_hash': content_hash
-            }
-        else:
-            metrics.errors += 1
-            return None
+        return ClassificationRecord(
+            domain['domain_id'], fqdn, 'llm', category, confidence, rationale,
+            signals={'http_status': domain.get("http", {}).get("status")},
+            llm_raw=result["raw"],
+            content_hash=content_hash,
+            redirect_host=host,
+        )
+    else:
+        metrics.errors += 1
+        return None
+
+
+async def process_one(domain: Dict[str, Any], cfg: ClassifierConfig, 
+                     llm_sem: asyncio.Semaphore, client: httpx.AsyncClient,
+                     content_hash_cache: Dict[str, Tuple[str, float, str]],
+                     metrics: Metrics,
+                     redirect_cache: Optional[Dict[str, Tuple[str, float, str, bool]]] = None
+                     ) -> Optional[ClassificationRecord]:
+    """Process one domain (NO database writes)"""
+    
+    try:
+        result = preclassify(domain, cfg, content_hash_cache, metrics, redirect_cache)
+        if result:
+            return result
+        
+        return await classify_with_llm(domain, cfg, llm_sem, client,
+                                       content_hash_cache, metrics, redirect_cache)
     
     except Exception as e:
         metrics.errors += 1
-        print(f"Error processing {fqdn}: {e}")
+        print(f"Error processing {domain['fqdn']}: {e}")
         return None
 
 
-def batch_insert(conn, results: List[Dict]):
-    """Batch insert results to database"""
-    for result in results:
-        if result:
-            # Insert classification
-            conn.execute("""
-                INSERT INTO classifications 
-                (domain_id, fqdn, method, category, confidence, reason, signals, llm_raw, content_hash, classified_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))
-            """, (
-                result['domain_id'],
-                result['fqdn'],
-                result['method'],
-                result['category'],
-                result['confidence'],
-                result['reason'],
-                json.dumps(result['signals']),
-                json.dumps(result['llm_raw']) if result['llm_raw'] else None,
-                result['content_hash']
-            ))
-            
-            # Update domain as classified
-            conn.execute("""
-                UPDATE domains 
-                SET classified = 1, classified_at = datetime('now')
-                WHERE id = ?
-            """, (result['domain_id'],))
-            
-            # Insert into content hash cache if applicable
-            if result['content_hash'] and result['method'] == 'llm':
-                conn.execute("""
-                    INSERT OR REPLACE INTO content_hash_cache 
-                    (content_hash, category, confidence, example_fqdn, cached_at)
-                    VALUES (?, ?, ?, ?, datetime('now'))
-                """, (
-                    result['content_hash'],
-                    result['category'],
-                    result['confidence'],
-                    result['fqdn']
-                ))
-
-
-async def classify_batch(cfg: ClassifierConfig, content_hash_cache: Dict):
+def batch_insert(conn, results: List[ClassificationRecord], inline_iab: bool = False) -> List[int]:
+    """Batch insert results to database (IAB-enriched already with inline_iab)"""
+    iab_mapping = load_iab_mapping(conn) if inline_iab else None
+    return insert_classifications_bulk(conn, [r for r in results if r], iab_mapping)
+
+
+def write_results(cfg: ClassifierConfig, results: List[ClassificationRecord]):
+    """Commit results, each to the shard holding its domain"""
+    for path, group in partition(cfg.db_path, [r for r in results if r],
+                                 key=lambda r: r.fqdn).items():
+        with get_connection(path) as conn:
+            batch_insert(conn, group, cfg.inline_iab)
+
+
+def classifier_shards(cfg: ClassifierConfig) -> List[str]:
+    """Database files this classifier selects work from"""
+    paths = shard_paths(cfg.db_path)
+    if cfg.shard is None:
+        return paths
+    if not 0 <= cfg.shard < len(paths):
+        raise ValueError(f"--shard {cfg.shard} out of range: {cfg.db_path} has {len(paths)} shard(s)")
+    return [paths[cfg.shard]]
+
+
+def count_pending(cfg: ClassifierConfig) -> int:
+    total = 0
+    for path in classifier_shards(cfg):
+        with get_connection(path) as conn:
+            total += get_pending_count(conn)
+    return total
+
+
+def load_content_hash_cache(db_path: str) -> Dict[str, Tuple[str, float, str]]:
+    """Load the persisted content hash cache (of every shard) into memory"""
+    content_hash_cache = {}
+    for path in shard_paths(db_path):
+        with get_connection(path) as conn:
+            cursor = conn.execute("SELECT content_hash, category, confidence, example_fqdn FROM content_hash_cache")
+            for row in cursor:
+                content_hash_cache[row[0]] = (row[1], row[2], row[3])
+    return content_hash_cache
+
+
+async def classify_batch(cfg: ClassifierConfig, content_hash_cache: Dict,
+                         redirect_cache: Optional[Dict] = None):
     """Classify one batch of unclassified domains"""
     
-    # Get domains to classify
-    with get_connection(cfg.db_path) as conn:
-        domains = get_domains_to_classify(conn)
+    # Get domains to classify, highest priority first across all shards
+    # (ids are per shard, so shards are aged by fetch time)
+    domains = []
+    shards = classifier_shards(cfg)
+    for path in shards:
+        with get_connection(path) as conn:
+            domains.extend(get_domains_to_classify(conn, aging_share=cfg.aging_share))
+    if len(shards) > 1:
+        domains = priority_order(domains, lambda d: d['priority'],
+                                 lambda d: (d['fetched_at'], d['domain_id']), cfg.aging_share)
     
     total = len(domains)
     
@@ -403,25 +552,28 @@ async def classify_batch(cfg: ClassifierConfig, content_hash_cache: Dict):
         results = []
         batch_num = 0
         
-        for i, domain in enumerate(domains):
-            result = await process_one(domain, cfg, llm_sem, client, content_hash_cache, metrics)
-            results.append(result)
+        # Domains are classified a window at a time, up to llm_concurrency
+        # LLM calls in flight (llm_sem); results still commit batch_size at a time
+        window = max(cfg.batch_size, cfg.llm_concurrency)
+        for start in range(0, total, window):
+            results.extend(await asyncio.gather(*[
+                process_one(domain, cfg, llm_sem, client, content_hash_cache, metrics,
+                            redirect_cache)
+                for domain in domains[start:start + window]]))
             
             # Batch commit
-            if len(results) >= cfg.batch_size:
+            while len(results) >= cfg.batch_size:
                 batch_num += 1
-                with get_connection(cfg.db_path) as conn:
-                    batch_insert(conn, results)
+                write_results(cfg, results[:cfg.batch_size])
+                del results[:cfg.batch_size]
                 
-                completed = (i + 1)
+                completed = min(total, batch_num * cfg.batch_size)
                 print(f"Progress: {completed}/{total} ({completed/total*100:.1f}%) - batch {batch_num} committed")
-                results.clear()
         
         # Final batch
         if results:
             batch_num += 1
-            with get_connection(cfg.db_path) as conn:
-                batch_insert(conn, results)
+            write_results(cfg, results)
             print(f"Progress: {total}/{total} (100.0%) - final batch committed")
     
     return total, metrics
@@ -432,20 +584,33 @@ async def main_async(args: argparse.Namespace):
     
     if args.config:
         cfg = ClassifierConfig.from_toml(args.config, db_path=args.db)
+        configure_database(cfg.db_path, DatabaseConfig.from_toml(args.config))
     else:
         cfg = ClassifierConfig(db_path=args.db)
     
     # Override with command line flag
     if args.watch:
         cfg.watch_mode = True
+    if args.inline_iab:
+        cfg.inline_iab = True
+    cfg.shard = args.shard
+    init_database(cfg.db_path)
+    try:
+        shards = classifier_shards(cfg)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return 1
     
     print("=" * 70)
     print("WXAWEBCAT CLASSIFIER (Optimized Database Version)")
     print("=" * 70)
     print(f"Database: {cfg.db_path}")
+    if len(shards) > 1 or cfg.shard is not None:
+        print(f"Shards: {', '.join(shards)}")
     print(f"Batch size: {cfg.batch_size} (commit every {cfg.batch_size} domains)")
     print(f"LLM endpoint: {cfg.vllm_base_url}")
     print(f"LLM concurrency: {cfg.llm_concurrency}")
+    print(f"IAB taxonomy: {'inline' if cfg.inline_iab else 'separate pass (add_iab_categories_db.py)'}")
     
     if cfg.watch_mode:
         print(f"Mode: WATCH (continuous)")
@@ -456,13 +621,12 @@ async def main_async(args: argparse.Namespace):
     print()
     
     # Load content hash cache into memory
-    content_hash_cache = {}
-    with get_connection(cfg.db_path) as conn:
-        cursor = conn.execute("SELECT content_hash, category, confidence, example_fqdn FROM content_hash_cache")
-        for row in cursor:
-            content_hash_cache[row[0]] = (row[1], row[2], row[3])
+    content_hash_cache = load_content_hash_cache(cfg.db_path)
+    redirect_cache = load_redirect_cache(cfg) if cfg.enable_redirect_cache else None
     
     print(f"Loaded {len(content_hash_cache)} content hashes from cache")
+    if redirect_cache is not None:
+        print(f"Loaded {len(redirect_cache)} redirect hosts (seeds included)")
     print()
     
     # Watch mode: continuous loop
@@ -475,21 +639,19 @@ async def main_async(args: argparse.Namespace):
                 iteration += 1
                 
                 # Check for new domains
-                with get_connection(cfg.db_path) as conn:
-                    unclassified_count = conn.execute(
-                        "SELECT COUNT(*) FROM domains WHERE classified = 0"
-                    ).fetchone()[0]
+                unclassified_count = count_pending(cfg)
                 
                 if unclassified_count > 0:
                     print(f"[Iteration {iteration}] Found {unclassified_count} unclassified domains")
                     
-                    count, metrics = await classify_batch(cfg, content_hash_cache)
+                    count, metrics = await classify_batch(cfg, content_hash_cache, redirect_cache)
                     total_classified += count
                     
                     # Print iteration summary
                     if metrics:
                         print(f"[Iteration {iteration}] Classified {count} domains")
-                        print(f"  Rule-based: {metrics.rule}, Hash hits: {metrics.hash_cache_hits}, LLM: {metrics.llm}")
+                        print(f"  Rule-based: {metrics.rule}, Redirect hits: {metrics.redirect_cache_hits}, "
+                              f"Hash hits: {metrics.hash_cache_hits}, LLM: {metrics.llm}")
                         print(f"  Total classified so far: {total_classified}")
                         print()
                 else:
@@ -509,21 +671,17 @@ async def main_async(args: argparse.Namespace):
             print(f"Total iterations:     {iteration}")
             print(f"Total classified:     {total_classified}")
             
-            with get_connection(cfg.db_path) as conn:
-                stats = get_statistics(conn)
-                print(f"Total domains:        {stats['total_domains']}")
-                print(f"Classified:           {stats['classified']}")
-                print(f"Unclassified:         {stats['unclassified']}")
+            stats = get_total_statistics(cfg.db_path)
+            print(f"Total domains:        {stats['total_domains']}")
+            print(f"Classified:           {stats['classified']}")
+            print(f"Unclassified:         {stats['unclassified']}")
             
             return 0
     
     # One-shot mode: process once and exit
     else:
         # Get initial count
-        with get_connection(cfg.db_path) as conn:
-            unclassified_count = conn.execute(
-                "SELECT COUNT(*) FROM domains WHERE classified = 0"
-            ).fetchone()[0]
+        unclassified_count = count_pending(cfg)
         
         print(f"Found {unclassified_count} unclassified domains\n")
         
@@ -531,7 +689,7 @@ async def main_async(args: argparse.Namespace):
             print("Nothing to classify!")
             return 0
         
-        count, metrics = await classify_batch(cfg, content_hash_cache)
+        count, metrics = await classify_batch(cfg, content_hash_cache, redirect_cache)
         
         # Print summary
         print("\n" + "=" * 70)
@@ -540,6 +698,7 @@ async def main_async(args: argparse.Namespace):
         print(f"Total:                {metrics.total}")
         print(f"Rule-based:           {metrics.rule}")
         print(f"  ├─ TLD classified:  {metrics.tld_classified}")
+        print(f"Redirect cache hits:  {metrics.redirect_cache_hits}")
         print(f"Hash cache hits:      {metrics.hash_cache_hits}")
         print(f"LLM classified:       {metrics.llm}")
         print(f"Errors:               {metrics.errors}")
@@ -552,13 +711,13 @@ async def main_async(args: argparse.Namespace):
         
         print("\n" + "=" * 70)
         
-        with get_connection(cfg.db_path) as conn:
-            stats = get_statistics(conn)
-            print(f"Total domains:        {stats['total_domains']}")
-            print(f"Classified:           {stats['classified']}")
-            print(f"Unclassified:         {stats['unclassified']}")
+        stats = get_total_statistics(cfg.db_path)
+        print(f"Total domains:        {stats['total_domains']}")
+        print(f"Classified:           {stats['classified']}")
+        print(f"Unclassified:         {stats['unclassified']}")
         
-        print(f"\nNext: python add_iab_categories_db.py --db {cfg.db_path}")
+        if not cfg.inline_iab:
+            print(f"\nNext: python add_iab_categories_db.py --db {cfg.db_path}")
         
         return 0
 
@@ -568,6 +727,10 @@ def parse_args():
     p.add_argument("--db", default="wxawebcat.db", help="Database path")
     p.add_argument("--config", help="TOML configuration file")
     p.add_argument("--watch", action="store_true", help="Watch mode: continuously monitor for new unclassified domains")
+    p.add_argument("--inline-iab", action="store_true",
+                   help="Fill the IAB columns while classifying (skips add_iab_categories_db.py)")
+    p.add_argument("--shard", type=int,
+                   help="Only classify shard N of a sharded database (run one classifier per shard)")
     return p.parse_args()
 
 
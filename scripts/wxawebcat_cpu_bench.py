@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+wxawebcat_cpu_bench.py - Micro-benchmarks of the per-domain CPU hot paths
+
+Times the functions every fetched or classified domain goes through
+(sanitize_domain, the page extractors, rule_preclass, extract_tld,
+build_content_fingerprint, build_llm_payload, the http_data JSON round
+trip and FetchRecord.to_row) on a deterministic synthetic corpus, and reports ns/op and peak
+allocated bytes/op for each.
+
+Extractors are timed separately per page kind, so a regex change that only
+hurts pathological pages still shows up:
+  normal        ordinary page with head, meta tags, nav and paragraphs
+  huge_script   ~60 KB inline <script> before the content
+  unclosed      unclosed <title>, <script> and tags, stray '<' characters
+  no_head       bare text, no <title> / <meta> at all
+
+Example:
+  python3 wxawebcat_cpu_bench.py --save-baseline cpu_bench.json
+  python3 wxawebcat_cpu_bench.py --baseline cpu_bench.json --only extract_
+"""
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
+import wxawebcat_classifier_db as classifier
+import wxawebcat_web_fetcher_db as fetcher
+from wxawebcat_db import FetchRecord, build_content_fingerprint
+
+
+PAGE_KINDS = ("normal", "huge_script", "unclosed", "no_head")
+
+# Metrics compared against a baseline (all lower-is-better)
+BASELINE_METRICS = ("ns_per_op", "bytes_per_op")
+
+WORDS = ("news sports weather travel finance health recipes music video games "
+         "shopping cars homes jobs education science technology movies books "
+         "fashion beauty fitness pets garden family business market local world "
+         "domain for sale sedo afternic casino bank school government").split()
+
+TLDS = (".com", ".com", ".com", ".net", ".org", ".de", ".io", ".gov", ".edu",
+        ".gov.uk", ".ac.uk", ".edu.au", ".test", ".xyz", ".co.jp")
+
+
+def _words(rng: random.Random, count: int) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+
+def make_fqdn(rng: random.Random, i: int) -> str:
+    labels = [f"{rng.choice(WORDS)}{i}"]
+    if rng.random() < 0.4:
+        labels.insert(0, rng.choice(("www", "shop", "m", "blog", "api.eu")))
+    return '.'.join(labels) + rng.choice(TLDS)
+
+
+def make_raw_domain(rng: random.Random, fqdn: str) -> str:
+    """Input-file spelling of a domain, as sanitize_domain receives it"""
+    roll = rng.random()
+    if roll < 0.2:
+        return f"https://{fqdn.upper()}/index.html"
+    if roll < 0.3:
+        return f"http://{fqdn}:8080/path?q=1"
+    if roll < 0.4:
+        return f"  {fqdn}  "
+    return fqdn
+
+
+def make_page(rng: random.Random, kind: str) -> str:
+    title = _words(rng, rng.randint(2, 8)).title()
+    description = _words(rng, rng.randint(8, 25))
+    body = ''.join(f"<p class=\"c{n}\">{_words(rng, rng.randint(10, 60))} &amp; more</p>\n"
+                   for n in range(rng.randint(5, 40)))
+    nav = ''.join(f'<li><a href="/{w}">{w}</a></li>' for w in _words(rng, 12).split())
+    style = "<style>body{margin:0} .c1{color:#333} .nav li{display:inline}</style>"
+
+    if kind == "huge_script":
+        script = "var d=" + json.dumps([_words(rng, 8) for _ in range(1500)]) + ";"
+        return (f"<!DOCTYPE html><html><head><title>{title}</title>"
+                f'<meta name="description" content="{description}">{style}'
+                f"<script>{script}</script></head><body><ul class=\"nav\">{nav}</ul>"
+                f"{body}</body></html>")
+    if kind == "unclosed":
+        stray = ' '.join(f"a < b{n} <" for n in range(200))
+        return (f"<html><head><title>{title}<meta content=\"{description}\" "
+                f"name='description'><script>var x = 1 < 2;{' ' * 2000}"
+                f"<body><div><ul class=\"nav\">{nav}<p>{stray}{body}<div<span<p")
+    if kind == "no_head":
+        return _words(rng, rng.randint(200, 2000))
+    return (f"<!DOCTYPE html><html lang=\"en\"><head><meta charset=\"utf-8\">"
+            f"<title>{title} &mdash; Home</title>"
+            f'<meta name="description" content="{description}">'
+            f'<meta property="og:title" content="{title}">{style}'
+            f"<script src=\"/app.js\"></script></head>"
+            f"<body><header><ul class=\"nav\">{nav}</ul></header><main>{body}</main>"
+            f"<footer>&copy; {rng.randint(1999, 2025)}</footer></body></html>")
+
+
+def build_corpus(pages_per_kind: int, domains: int, seed: int) -> Dict[str, Any]:
+    """Deterministic inputs for every benchmark"""
+    rng = random.Random(seed)
+    max_body = fetcher.FetchConfig.max_body_bytes
+    pages = {kind: [make_page(rng, kind)[:max_body] for _ in range(pages_per_kind)]
+             for kind in PAGE_KINDS}
+
+    fqdns = [make_fqdn(rng, i) for i in range(domains)]
+    all_pages = [page for kind in PAGE_KINDS for page in pages[kind]]
+    docs = []
+    for i, fqdn in enumerate(fqdns):
+        http = {"status": 0, "error": None, "title": None, "body_snippet": None,
+                "meta": {}, "blocked": False, "content_type": None, "final_url": None}
+        roll = rng.random()
+        if roll < 0.08:
+            dns = {"rcode": "NXDOMAIN", "a": []}
+            http["error"] = "dns_failed"
+        else:
+            dns = {"rcode": "NOERROR", "a": []}
+            http["status"] = rng.choice((200, 200, 200, 200, 200, 301, 403, 404, 503))
+            http["final_url"] = f"https://{fqdn}/"
+            http["content_type"] = "text/html; charset=utf-8"
+            http.update(fetcher.extract_page(all_pages[i % len(all_pages)]))
+        http["timing"] = {"dns": 1.2, "connect": 15.3, "ttfb": 80.1, "body": 4.2,
+                          "total": 101.7}
+        docs.append({"fqdn": fqdn, "dns": dns, "http": http})
+
+    return {
+        "pages": pages,
+        "raw_domains": [make_raw_domain(rng, f) for f in fqdns],
+        "fqdns": fqdns,
+        "docs": docs,
+        "http": [d["http"] for d in docs],
+        "blobs": [json.dumps(d["http"]) for d in docs],
+    }
+
+
+def build_suite(corpus: Dict[str, Any]) -> List[Tuple[str, Callable, List]]:
+    """(name, function of one input, inputs) for every benchmark"""
+    suite = [("sanitize_domain", fetcher.sanitize_domain, corpus["raw_domains"])]
+    for kind in PAGE_KINDS:
+        pages = corpus["pages"][kind]
+        suite += [
+            (f"extract_title[{kind}]", fetcher.extract_title, pages),
+            (f"extract_meta_description[{kind}]", fetcher.extract_meta_description, pages),
+            (f"extract_visible_text[{kind}]", fetcher.extract_visible_text, pages),
+            (f"extract_page[{kind}]", fetcher.extract_page, pages),
+        ]
+    suite += [
+        ("extract_tld", classifier.extract_tld, corpus["fqdns"]),
+        ("rule_preclass", classifier.rule_preclass, corpus["docs"]),
+        ("build_content_fingerprint", build_content_fingerprint, corpus["http"]),
+        ("build_llm_payload", lambda doc: classifier.build_llm_payload(doc, "bench-model"),
+         corpus["docs"]),
+        ("json.dumps(http_data)", json.dumps, corpus["http"]),
+        ("json.loads(http_data)", json.loads, corpus["blobs"]),
+    ]
+    records = [FetchRecord(fqdn, {"rcode": "NOERROR", "a": []}, http, "success")
+               for fqdn, http in zip(corpus["fqdns"], corpus["http"])]
+    fetched_at = "2024-01-01T00:00:00+00:00"
+    suite.append(("FetchRecord.to_row", lambda r: r.to_row(fetched_at), records))
+    return suite
+
+
+def time_per_op(fn: Callable, inputs: List, min_time: float, repeat: int) -> float:
+    """Best-of-`repeat` ns per call, each run cycling over inputs for >= min_time"""
+    perf = time.perf_counter_ns
+    # Calibrate: whole passes over the inputs per timed run
+    passes = 1
+    while True:
+        started = perf()
+        for _ in range(passes):
+            for x in inputs:
+                fn(x)
+        elapsed = perf() - started
+        if elapsed >= min_time * 1e9 / repeat or passes >= 1 << 20:
+            break
+        passes *= 2
+    best = elapsed
+    for _ in range(repeat - 1):
+        started = perf()
+        for _ in range(passes):
+            for x in inputs:
+                fn(x)
+        best = min(best, perf() - started)
+    return best / (passes * len(inputs))
+
+
+def bytes_per_op(fn: Callable, inputs: List) -> float:
+    """Mean peak traced allocation during one call (temporaries included)"""
+    total = 0
+    tracemalloc.start()
+    try:
+        for x in inputs:
+            tracemalloc.clear_traces()
+            fn(x)
+            total += tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return total / len(inputs)
+
+
+def run_suite(args) -> Dict[str, Any]:
+    corpus = build_corpus(args.pages, args.domains, args.seed)
+    results = {}
+    for name, fn, inputs in build_suite(corpus):
+        if args.only and not any(o in name for o in args.only):
+            continue
+        ns = time_per_op(fn, inputs, args.min_time, args.repeat)
+        entry = {"ns_per_op": round(ns, 1)}
+        if not args.no_alloc:
+            entry["bytes_per_op"] = round(bytes_per_op(fn, inputs))
+        results[name] = entry
+        alloc = f"{entry['bytes_per_op']:>12,}" if "bytes_per_op" in entry else ""
+        print(f"{name:<40} {ns:>14,.0f} {alloc}")
+    return {
+        "params": {k: getattr(args, k) for k in ("pages", "domains", "seed")},
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+
+def compare_to_baseline(result: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Print a comparison table and return the names of regressed benchmarks"""
+    if baseline.get("params") != result["params"]:
+        print("Warning: baseline was recorded with different parameters")
+    if baseline.get("python") != result["python"]:
+        print(f"Warning: baseline was recorded with Python {baseline.get('python')}")
+
+    regressions = []
+    print(f"\n{'Benchmark':<40} {'Metric':<13} {'Baseline':>12} {'Current':>12} {'Change':>9}")
+    for name, metrics in result["results"].items():
+        old_metrics = baseline.get("results", {}).get(name)
+        if not old_metrics:
+            print(f"{name:<40} (not in baseline)")
+            continue
+        for metric in BASELINE_METRICS:
+            old, new = old_metrics.get(metric), metrics.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            flag = ""
+            if change > tolerance:
+                flag = "  REGRESSION"
+                regressions.append(f"{name} {metric}")
+            print(f"{name:<40} {metric:<13} {old:>12,.0f} {new:>12,.0f} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Benchmark the per-domain CPU hot paths")
+    p.add_argument("--pages", type=int, default=50,
+                   help="Synthetic pages per page kind (default: 50)")
+    p.add_argument("--domains", type=int, default=2000,
+                   help="Synthetic domains / documents (default: 2000)")
+    p.add_argument("--seed", type=int, default=1, help="Corpus seed (default: 1)")
+    p.add_argument("--min-time", type=float, default=0.5,
+                   help="Seconds of timing per benchmark (default: 0.5)")
+    p.add_argument("--repeat", type=int, default=5,
+                   help="Timed runs per benchmark; the fastest counts (default: 5)")
+    p.add_argument("--only", nargs="+", metavar="TEXT",
+                   help="Only benchmarks whose name contains one of these")
+    p.add_argument("--no-alloc", action="store_true", help="Skip the allocation pass")
+    p.add_argument("--save-baseline", metavar="FILE",
+                   help="Write the results to FILE as the new baseline")
+    p.add_argument("--baseline", metavar="FILE",
+                   help="Compare against a saved baseline; exit 1 on regression")
+    p.add_argument("--tolerance", type=float, default=0.15,
+                   help="Allowed relative regression per metric (default: 0.15)")
+    args = p.parse_args()
+    if args.pages < 1 or args.domains < 1 or args.repeat < 1:
+        p.error("--pages, --domains and --repeat must be at least 1")
+    return args
+
+
+def main():
+    args = parse_args()
+    print(f"{'Benchmark':<40} {'ns/op':>14} {'' if args.no_alloc else 'bytes/op':>12}")
+    result = run_suite(args)
+
+    if args.save_baseline:
+        Path(args.save_baseline).write_text(json.dumps(result, indent=2) + "\n")
+        print(f"Baseline saved to {args.save_baseline}")
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        regressions = compare_to_baseline(result, baseline, args.tolerance)
+        if regressions:
+            print(f"\nRegressed beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+        print("\nNo regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,22 +5,350 @@ wxawebcat_db.py - Database utilities for wxawebcat
 Provides database initialization, connection management, and common queries.
 """
 
+import hashlib
+import heapq
+import os
+import re
 import sqlite3
 import json
+import threading
+import time
+import zlib
+from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Dict, List, Optional, Any, Tuple
 from datetime import datetime, timezone
-from contextlib import contextmanager
+from contextlib import ExitStack, contextmanager
+from itertools import islice
 
 
 DEFAULT_DB_PATH = "wxawebcat.db"
 
+# Pragma profiles, selected with `profile` in a TOML [database] section;
+# pragma keys in that section override individual values
+PRAGMA_PROFILES = {
+    # Fetcher and classifier sharing one file
+    "balanced": {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "cache_size": -65536,          # KiB when negative: 64 MB
+        "mmap_size": 268435456,        # 256 MB
+        "temp_store": "memory",
+        "busy_timeout": 30000,         # ms
+        "wal_autocheckpoint": 1000,    # pages
+    },
+    # Survives power loss, not just process crashes
+    "durable": {
+        "journal_mode": "wal",
+        "synchronous": "full",
+        "cache_size": -65536,
+        "mmap_size": 268435456,
+        "temp_store": "memory",
+        "busy_timeout": 30000,
+        "wal_autocheckpoint": 1000,
+    },
+    # Big one-off loads and rebuilds: an OS crash or power loss can lose or
+    # corrupt recent commits, so only use it on data you can regenerate
+    "bulk": {
+        "journal_mode": "wal",
+        "synchronous": "off",
+        "cache_size": -262144,
+        "mmap_size": 1073741824,
+        "temp_store": "memory",
+        "busy_timeout": 60000,
+        "wal_autocheckpoint": 10000,
+    },
+}
+
+# stats_counters rows kept current by triggers: name -> predicate over the
+# row ({r} is NEW or OLD). Classification methods are counted as "method:<name>".
+DOMAIN_COUNTERS = {
+    "domains_total": "1",
+    "domains_classified": "{r}.classified = 1",
+    "domains_unclassified": "{r}.classified = 0",
+    "domains_failed": "{r}.fetch_status != 'success'",
+    "domains_pending": "{r}.classified = 0 AND {r}.fetch_status = 'success'",
+}
+CLASSIFICATION_COUNTERS = {
+    "classifications_total": "1",
+    "classifications_iab_enriched": "{r}.iab_enriched = 1",
+}
+
+# Generic category -> (IAB tier1 id, tier1 name, tier2 id, tier2 name,
+# sensitive, sensitive categories); seeds the iab_mapping table. Categories
+# without content (Parked, Unreachable, ...) map to no tiers, so they count
+# as enriched and are not rescanned by every enrichment pass.
+DEFAULT_IAB_MAPPING = {
+    "Government": ("news_and_politics", "News & Politics", "Government", "Government", False, []),
+    "News": ("news_and_politics", "News & Politics", "National News", "National News", False, []),
+    "Education": ("education", "Education", "College Education", "College Education", False, []),
+    "Technology": ("technology_and_computing", "Technology & Computing",
+                   "Computing", "Computing", False, []),
+    "Social": ("technology_and_computing", "Technology & Computing",
+               "Social Networking", "Social Networking", False, []),
+    "Business": ("business_and_finance", "Business & Finance", "Business", "Business", False, []),
+    "Finance": ("business_and_finance", "Business & Finance", "Banking", "Banking", False, []),
+    "Shopping": ("shopping", "Shopping", "Sales & Promotions", "Sales & Promotions", False, []),
+    "Gambling": ("hobbies_and_interests", "Hobbies & Interests",
+                 "Casinos & Gambling", "Casinos & Gambling", False, []),
+    "Games": ("video_gaming", "Video Gaming", "Video Gaming", "Video Gaming", False, []),
+    "Arts_Entertainment": ("events_and_attractions", "Events & Attractions",
+                           "Museums & Galleries", "Museums & Galleries", False, []),
+    "Religion": ("religion_and_spirituality", "Religion & Spirituality", None, None, False, []),
+    "Adult": ("adult_content", "Adult Content", "Adult Content", "Adult Content",
+              True, ["Adult Content"]),
+    "Malware": ("spam_or_harmful_content", "Spam or Harmful Content", "Malware", "Malware",
+                True, ["Spam or Harmful Content"]),
+    "Parked": (None, None, None, None, False, []),
+    "Unreachable": (None, None, None, None, False, []),
+    "Blocked": (None, None, None, None, False, []),
+    "Development": (None, None, None, None, False, []),
+    "Other": (None, None, None, None, False, []),
+}
+
+ALLOWED_PRAGMAS = {"journal_mode", "synchronous", "cache_size", "mmap_size",
+                   "temp_store", "busy_timeout", "wal_autocheckpoint",
+                   "journal_size_limit", "foreign_keys"}
+
+# Columns added after the original schema: (table, column, definition).
+# Existing databases get them via ALTER TABLE in migrate_database().
+COLUMN_MIGRATIONS = [
+    ("domains", "fetch_attempts", "INTEGER NOT NULL DEFAULT 1"),
+    ("domains", "etag", "TEXT"),
+    ("domains", "last_modified", "TEXT"),
+    ("domains", "content_hash", "TEXT"),
+    ("domains", "page_hash", "TEXT"),
+    # Input rank or explicit priority: lower goes first, NULL after all ranked
+    ("domains", "priority", "INTEGER"),
+    # Classifier features, extracted from the JSON blobs by SQLite itself
+    ("domains", "dns_rcode", "TEXT GENERATED ALWAYS AS (json_extract(dns_data, '$.rcode')) VIRTUAL"),
+    ("domains", "http_status", "INTEGER GENERATED ALWAYS AS (json_extract(http_data, '$.status')) VIRTUAL"),
+    ("domains", "http_blocked", "INTEGER GENERATED ALWAYS AS (json_extract(http_data, '$.blocked')) VIRTUAL"),
+    ("domains", "title", "TEXT GENERATED ALWAYS AS (json_extract(http_data, '$.title')) VIRTUAL"),
+    ("domains", "meta_description",
+     "TEXT GENERATED ALWAYS AS (json_extract(http_data, '$.meta.description')) VIRTUAL"),
+    ("domains", "body_snippet", "TEXT GENERATED ALWAYS AS (json_extract(http_data, '$.body_snippet')) VIRTUAL"),
+    ("domains", "final_url", "TEXT GENERATED ALWAYS AS (json_extract(http_data, '$.final_url')) VIRTUAL"),
+    # Bumped on every change to a current row (see NEXT_CURRENT_VERSION)
+    ("current_classification", "version", "INTEGER NOT NULL DEFAULT 0"),
+]
+
+# One-off data fixes run right after the matching column is added
+COLUMN_BACKFILLS = {
+    # Older fetchers left fetch_error empty; recover it from the HTTP blob
+    ("domains", "fetch_attempts"): """
+        UPDATE domains SET fetch_error = json_extract(http_data, '$.error')
+        WHERE fetch_status = 'http_failed' AND fetch_error IS NULL
+    """,
+    # Start versions at the classification id, so existing export
+    # watermarks (classification ids) stay valid
+    ("current_classification", "version"): """
+        UPDATE current_classification SET version = classification_id
+    """,
+}
+
+# Indexes that depend on migrated columns, created after the migration runs
+MIGRATION_INDEXES = [
+    """CREATE INDEX IF NOT EXISTS idx_domains_retry
+       ON domains(fetch_error, fetch_attempts) WHERE fetch_status = 'http_failed'""",
+    "CREATE INDEX IF NOT EXISTS idx_domains_fetched_at ON domains(fetched_at)",
+    """CREATE INDEX IF NOT EXISTS idx_domains_page_hash
+       ON domains(page_hash) WHERE page_hash IS NOT NULL""",
+    "CREATE INDEX IF NOT EXISTS idx_current_classification_version ON current_classification(version)",
+    # Exactly the classifier's work queue, in the order it is read
+    """CREATE INDEX IF NOT EXISTS idx_domains_pending
+       ON domains(id) WHERE classified = 0 AND fetch_status = 'success'""",
+    # The same queue in priority order
+    """CREATE INDEX IF NOT EXISTS idx_domains_pending_priority
+       ON domains(priority, id) WHERE classified = 0 AND fetch_status = 'success'""",
+    # Superseded by idx_domains_pending (two values: useless for lookups)
+    "DROP INDEX IF EXISTS idx_domains_classified",
+    "CREATE INDEX IF NOT EXISTS idx_domains_http_status ON domains(http_status)",
+    """CREATE INDEX IF NOT EXISTS idx_domains_dns_rcode
+       ON domains(dns_rcode) WHERE dns_rcode != 'NOERROR'""",
+    # The IAB enrichment backlog
+    """CREATE INDEX IF NOT EXISTS idx_classifications_unenriched
+       ON classifications(id) WHERE iab_enriched = 0""",
+]
+
+
+def read_toml(path: str) -> dict:
+    """Read TOML configuration file"""
+    try:
+        import tomllib
+    except ImportError:
+        import tomli as tomllib
+    
+    with open(path, "rb") as f:
+        return tomllib.load(f)
+
+
+@dataclass
+class DatabaseConfig:
+    """Connection tuning, from the [database] section of a TOML config"""
+    profile: str = "balanced"
+    pragmas: Dict[str, Any] = field(default_factory=dict)  # Overrides on top of the profile
+    page_size: int = 8192              # Only applies when a database is created
+    checkpoint_interval: float = 30.0  # Seconds between writer checkpoints
+    checkpoint_wal_mb: float = 64.0    # Past this WAL size, truncate it when writers are idle
+    
+    @classmethod
+    def from_dict(cls, section: Dict[str, Any]) -> "DatabaseConfig":
+        profile = section.get("profile", "balanced")
+        if profile not in PRAGMA_PROFILES:
+            raise ValueError(f"Unknown database profile {profile!r} "
+                             f"(choose from {', '.join(PRAGMA_PROFILES)})")
+        pragmas = {k: v for k, v in section.items() if k in ALLOWED_PRAGMAS}
+        unknown = set(section) - ALLOWED_PRAGMAS - {
+            "profile", "page_size", "checkpoint_interval", "checkpoint_wal_mb"}
+        if unknown:
+            raise ValueError(f"Unknown [database] settings: {', '.join(sorted(unknown))}")
+        return cls(
+            profile=profile,
+            pragmas=pragmas,
+            page_size=int(section.get("page_size", 8192)),
+            checkpoint_interval=float(section.get("checkpoint_interval", 30.0)),
+            checkpoint_wal_mb=float(section.get("checkpoint_wal_mb", 64.0)),
+        )
+    
+    @classmethod
+    def from_toml(cls, toml_path: str) -> "DatabaseConfig":
+        return cls.from_dict(read_toml(toml_path).get("database", {}))
+    
+    def resolved_pragmas(self) -> Dict[str, Any]:
+        return {**PRAGMA_PROFILES[self.profile], **self.pragmas}
+
+
+class ConnectionManager:
+    """
+    Reusable per-thread connections to one database, tuned once on open.
+
+    transaction() nests: only the outermost block commits (or rolls back),
+    and after committing it runs a PASSIVE checkpoint every
+    checkpoint_interval; truncate_wal() shrinks an oversized WAL from an
+    idle or maintenance path.
+    """
+    
+    def __init__(self, db_path: str, config: Optional[DatabaseConfig] = None):
+        self.db_path = db_path
+        self.config = config or DatabaseConfig()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: List[sqlite3.Connection] = []
+        self._last_checkpoint = time.monotonic()
+    
+    def connection(self) -> sqlite3.Connection:
+        """This thread's connection, opened and tuned on first use"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30.0)
+            conn.row_factory = sqlite3.Row
+            for name, value in self.config.resolved_pragmas().items():
+                conn.execute(f"PRAGMA {name}={value}")
+            self._local.conn = conn
+            self._local.depth = 0
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+    
+    @contextmanager
+    def transaction(self):
+        conn = self.connection()
+        self._local.depth += 1
+        try:
+            yield conn
+            if self._local.depth == 1:
+                conn.commit()
+                self.maybe_checkpoint(conn)
+        except Exception:
+            if self._local.depth == 1:
+                conn.rollback()
+            raise
+        finally:
+            self._local.depth -= 1
+    
+    def maybe_checkpoint(self, conn: Optional[sqlite3.Connection] = None) -> bool:
+        """PASSIVE checkpoint if the policy interval has passed; returns whether it ran"""
+        now = time.monotonic()
+        if now - self._last_checkpoint < self.config.checkpoint_interval:
+            return False
+        self._last_checkpoint = now
+        # PASSIVE never waits on readers, so it is safe on a hot write path
+        (conn or self.connection()).execute("PRAGMA wal_checkpoint(PASSIVE)")
+        return True
+    
+    def truncate_wal(self, conn: Optional[sqlite3.Connection] = None) -> bool:
+        """
+        TRUNCATE checkpoint if the WAL grew past checkpoint_wal_mb; returns
+        whether it ran. It waits up to busy_timeout on readers, so call it
+        when the writer is idle, not between batches.
+        """
+        try:
+            wal_bytes = os.path.getsize(self.db_path + "-wal")
+        except OSError:
+            return False
+        if wal_bytes <= self.config.checkpoint_wal_mb * 1024 * 1024:
+            return False
+        (conn or self.connection()).execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return True
+    
+    def release(self):
+        """Close this thread's connection (e.g. when a worker thread exits)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            self._local.conn = None
+            with self._lock:
+                self._connections.remove(conn)
+            conn.close()
+    
+    def close_all(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+
+
+_managers: Dict[str, ConnectionManager] = {}
+_configs: Dict[str, DatabaseConfig] = {}
+_managers_lock = threading.Lock()
+_managers_pid = os.getpid()
+
+
+def configure_database(db_path: str, config: DatabaseConfig) -> None:
+    """Set the tuning for a database path before its connections are opened"""
+    key = os.path.abspath(db_path)
+    with _managers_lock:
+        _configs[key] = config
+        manager = _managers.pop(key, None)
+    if manager is not None:
+        manager.close_all()
+
+
+def get_manager(db_path: str = DEFAULT_DB_PATH) -> ConnectionManager:
+    """The process-wide connection manager for a database path"""
+    global _managers_pid
+    key = os.path.abspath(db_path)
+    with _managers_lock:
+        if _managers_pid != os.getpid():
+            # Connections must not cross a fork
+            _managers.clear()
+            _managers_pid = os.getpid()
+        manager = _managers.get(key)
+        if manager is None:
+            manager = _managers[key] = ConnectionManager(db_path, _configs.get(key))
+        return manager
+
 
 def init_database(db_path: str = DEFAULT_DB_PATH) -> None:
     """Initialize database with schema"""
     print(f"Initializing database: {db_path}")
     
+    is_new = not os.path.exists(db_path) or os.path.getsize(db_path) == 0
     conn = sqlite3.connect(db_path)
+    if is_new:
+        # Only possible before the first table exists (and before WAL)
+        config = _configs.get(os.path.abspath(db_path)) or DatabaseConfig()
+        conn.execute(f"PRAGMA page_size={int(config.page_size)}")
     
     # Read schema
     schema_path = Path(__file__).parent / "schema.sql"
@@ -36,6 +364,20 @@ def init_database(db_path: str = DEFAULT_DB_PATH) -> None:
             fetched_at TEXT NOT NULL,
             fetch_status TEXT NOT NULL DEFAULT 'success',
             fetch_error TEXT,
+            fetch_attempts INTEGER NOT NULL DEFAULT 1,
+            etag TEXT,
+            last_modified TEXT,
+            content_hash TEXT,
+            page_hash TEXT,
+            priority INTEGER,
+            -- Typed views of the JSON blobs (computed on read, indexable)
+            dns_rcode TEXT GENERATED ALWAYS AS (json_extract(dns_data, '$.rcode')) VIRTUAL,
+            http_status INTEGER GENERATED ALWAYS AS (json_extract(http_data, '$.status')) VIRTUAL,
+            http_blocked INTEGER GENERATED ALWAYS AS (json_extract(http_data, '$.blocked')) VIRTUAL,
+            title TEXT GENERATED ALWAYS AS (json_extract(http_data, '$.title')) VIRTUAL,
+            meta_description TEXT GENERATED ALWAYS AS (json_extract(http_data, '$.meta.description')) VIRTUAL,
+            body_snippet TEXT GENERATED ALWAYS AS (json_extract(http_data, '$.body_snippet')) VIRTUAL,
+            final_url TEXT GENERATED ALWAYS AS (json_extract(http_data, '$.final_url')) VIRTUAL,
             classified INTEGER NOT NULL DEFAULT 0,
             classified_at TEXT,
             created_at TEXT NOT NULL DEFAULT (datetime('now')),
@@ -74,95 +416,734 @@ def init_database(db_path: str = DEFAULT_DB_PATH) -> None:
             hit_count INTEGER DEFAULT 1
         );
         
+        -- LLM decisions per off-site redirect target (final_url host)
+        CREATE TABLE IF NOT EXISTS redirect_host_cache (
+            host TEXT PRIMARY KEY,
+            category TEXT NOT NULL,
+            confidence REAL NOT NULL,
+            example_fqdn TEXT NOT NULL,
+            cached_at TEXT NOT NULL DEFAULT (datetime('now'))
+        );
+        
+        CREATE TABLE IF NOT EXISTS fetch_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            input_path TEXT NOT NULL,
+            input_size INTEGER NOT NULL,
+            input_mtime REAL NOT NULL,
+            byte_offset INTEGER NOT NULL DEFAULT 0,
+            line_number INTEGER NOT NULL DEFAULT 0,
+            config TEXT,
+            status TEXT NOT NULL DEFAULT 'running',
+            started_at TEXT NOT NULL DEFAULT (datetime('now')),
+            updated_at TEXT NOT NULL DEFAULT (datetime('now'))
+        );
+        
+        -- Offsets of archived pages (see wxawebcat_archive.py)
+        CREATE TABLE IF NOT EXISTS page_archive (
+            page_hash TEXT PRIMARY KEY,
+            segment INTEGER NOT NULL,
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            raw_length INTEGER NOT NULL,
+            codec TEXT NOT NULL,
+            archived_at TEXT NOT NULL DEFAULT (datetime('now'))
+        );
+        
+        -- Last current_classification version shipped per incremental export consumer
+        CREATE TABLE IF NOT EXISTS export_watermarks (
+            name TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL DEFAULT 0,
+            last_rows INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT NOT NULL DEFAULT (datetime('now'))
+        );
+        
+        -- Maintained by triggers (see DOMAIN_COUNTERS); read by get_statistics
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        );
+        
+        -- Latest classification of each domain (upserted by
+        -- insert_classifications_bulk); classifications keeps the history
+        CREATE TABLE IF NOT EXISTS current_classification (
+            domain_id INTEGER PRIMARY KEY,
+            classification_id INTEGER NOT NULL,
+            fqdn TEXT NOT NULL,
+            method TEXT NOT NULL,
+            category TEXT NOT NULL,
+            confidence REAL NOT NULL,
+            reason TEXT,
+            iab_tier1_id TEXT,
+            iab_tier1_name TEXT,
+            iab_tier2_id TEXT,
+            iab_tier2_name TEXT,
+            is_sensitive INTEGER DEFAULT 0,
+            sensitive_categories TEXT,
+            iab_enriched INTEGER DEFAULT 0,
+            content_hash TEXT,
+            classified_at TEXT NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (domain_id) REFERENCES domains(id) ON DELETE CASCADE
+        );
+        
+        -- Category -> IAB taxonomy, read by enrich_iab and inline enrichment
+        CREATE TABLE IF NOT EXISTS iab_mapping (
+            category TEXT PRIMARY KEY,
+            iab_tier1_id TEXT,
+            iab_tier1_name TEXT,
+            iab_tier2_id TEXT,
+            iab_tier2_name TEXT,
+            is_sensitive INTEGER NOT NULL DEFAULT 0,
+            sensitive_categories TEXT
+        );
+        
+        -- Shard manifest of a sharded main database (see create_shards)
+        CREATE TABLE IF NOT EXISTS shards (
+            shard INTEGER PRIMARY KEY,
+            path TEXT NOT NULL
+        );
+        
         CREATE INDEX IF NOT EXISTS idx_domains_fqdn ON domains(fqdn);
-        CREATE INDEX IF NOT EXISTS idx_domains_classified ON domains(classified);
         CREATE INDEX IF NOT EXISTS idx_classifications_domain_id ON classifications(domain_id);
         CREATE INDEX IF NOT EXISTS idx_classifications_fqdn ON classifications(fqdn);
         CREATE INDEX IF NOT EXISTS idx_classifications_content_hash ON classifications(content_hash);
+        CREATE INDEX IF NOT EXISTS idx_fetch_runs_input ON fetch_runs(input_path);
+        CREATE INDEX IF NOT EXISTS idx_current_classification_id
+            ON current_classification(classification_id);
+        CREATE INDEX IF NOT EXISTS idx_current_classification_fqdn
+            ON current_classification(fqdn);
         """
     else:
         schema = schema_path.read_text()
     
     conn.executescript(schema)
+    migrate_database(conn)
     conn.commit()
     conn.close()
     
     print(f"✓ Database initialized: {db_path}")
+    
+    for path in shard_paths(db_path):
+        if path != db_path:
+            init_database(path)
+
+
+# Sharded layout: the main file keeps run bookkeeping (fetch_runs) and the
+# shard manifest; every domain, with its classifications, lives in shard
+# shard_of(fqdn). An unsharded database is its own single shard, so the
+# fan-out helpers below work the same on both layouts.
+
+_layouts: Dict[str, List[str]] = {}
+
+
+def shard_of(fqdn: str, shards: int) -> int:
+    """Stable fqdn -> shard mapping (independent of PYTHONHASHSEED)"""
+    return zlib.crc32(fqdn.encode('utf-8')) % shards
+
+
+def shard_file(db_path: str, shard: int) -> str:
+    """wxawebcat.db -> wxawebcat.shard03.db, next to the main file"""
+    path = Path(db_path)
+    return str(path.with_name(f"{path.stem}.shard{shard:02d}{path.suffix}"))
+
+
+def shard_paths(db_path: str) -> List[str]:
+    """Database files holding domains, in shard order (just db_path if unsharded)"""
+    key = os.path.abspath(db_path)
+    paths = _layouts.get(key)
+    if paths is None:
+        rows = []
+        if os.path.exists(db_path):
+            conn = sqlite3.connect(db_path)
+            try:
+                rows = conn.execute("SELECT path FROM shards ORDER BY shard").fetchall()
+            except sqlite3.OperationalError:
+                pass
+            finally:
+                conn.close()
+        base = Path(db_path).parent
+        paths = [str(base / row[0]) for row in rows] or [db_path]
+        _layouts[key] = paths
+    # Shards inherit the main file's tuning unless configured themselves
+    config = _configs.get(key)
+    if config is not None:
+        for path in paths:
+            _configs.setdefault(os.path.abspath(path), config)
+    return paths
+
+
+def create_shards(db_path: str, count: int) -> List[str]:
+    """Turn a new (domain-free) database into a main file plus `count` shards"""
+    init_database(db_path)
+    with get_connection(db_path) as conn:
+        existing = conn.execute("SELECT COUNT(*) FROM shards").fetchone()[0]
+        if existing:
+            if existing != count:
+                raise ValueError(f"{db_path} already has {existing} shards")
+            return shard_paths(db_path)
+        if conn.execute("SELECT 1 FROM domains LIMIT 1").fetchone():
+            raise ValueError(f"{db_path} already holds domains; shard a new database")
+        conn.executemany("INSERT INTO shards (shard, path) VALUES (?, ?)",
+                         [(i, Path(shard_file(db_path, i)).name) for i in range(count)])
+    _layouts.pop(os.path.abspath(db_path), None)
+    paths = shard_paths(db_path)
+    for path in paths:
+        init_database(path)
+    return paths
+
+
+def shard_for(db_path: str, fqdn: str) -> str:
+    """Database file that holds `fqdn`"""
+    paths = shard_paths(db_path)
+    return paths[shard_of(fqdn, len(paths))] if len(paths) > 1 else paths[0]
+
+
+def partition(db_path: str, items: List, key=lambda item: item) -> Dict[str, List]:
+    """Group items by the shard file of key(item) (an fqdn)"""
+    paths = shard_paths(db_path)
+    if len(paths) == 1:
+        return {paths[0]: list(items)} if items else {}
+    groups: Dict[str, List] = {}
+    for item in items:
+        groups.setdefault(paths[shard_of(key(item), len(paths))], []).append(item)
+    return groups
+
+
+@contextmanager
+def shard_connections(db_path: str):
+    """One transaction per shard, committed together on exit"""
+    with ExitStack() as stack:
+        yield [stack.enter_context(get_connection(path)) for path in shard_paths(db_path)]
+
+
+def fan_out(db_path: str, query, *args) -> List:
+    """query(conn, *args) on every shard; results in shard order"""
+    with shard_connections(db_path) as conns:
+        return [query(conn, *args) for conn in conns]
+
+
+def migrate_database(conn: sqlite3.Connection) -> None:
+    """Bring an existing database up to the current schema"""
+    
+    for table, column, definition in COLUMN_MIGRATIONS:
+        existing = {row[1] for row in conn.execute(f"PRAGMA table_xinfo({table})")}
+        if column not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+            backfill = COLUMN_BACKFILLS.get((table, column))
+            if backfill:
+                conn.execute(backfill)
+    
+    for statement in MIGRATION_INDEXES:
+        conn.execute(statement)
+    
+    backfill_content_hashes(conn)
+    
+    for statement in counter_triggers():
+        conn.execute(statement)
+    if conn.execute("SELECT COUNT(*) FROM stats_counters").fetchone()[0] == 0:
+        rebuild_counters(conn)
+    
+    if not conn.execute("SELECT 1 FROM iab_mapping LIMIT 1").fetchone():
+        set_iab_mapping(conn, DEFAULT_IAB_MAPPING)
+    
+    if (not conn.execute("SELECT 1 FROM current_classification LIMIT 1").fetchone()
+            and conn.execute("SELECT 1 FROM classifications LIMIT 1").fetchone()):
+        # Databases from before current_classification: seed it from the history
+        conn.execute(f"""
+            INSERT INTO current_classification ({', '.join(CURRENT_COLUMNS)}, version)
+            SELECT {', '.join(CURRENT_COLUMNS).replace('classification_id', 'id')}, id
+            FROM classifications
+            WHERE id IN (SELECT MAX(id) FROM classifications GROUP BY domain_id)
+        """)
+
+
+def backfill_content_hashes(conn: sqlite3.Connection, batch_size: int = 10000) -> int:
+    """
+    Fingerprint successful fetches stored without a content_hash.
+
+    Rows from before the column existed would otherwise compare NULL with
+    the hash of their first re-fetch and be re-classified even when the
+    page did not change.
+    """
+    done = 0
+    last_id = 0
+    while True:
+        rows = conn.execute("""
+            SELECT id, http_data FROM domains
+            WHERE id > ? AND content_hash IS NULL AND fetch_status = 'success'
+            ORDER BY id LIMIT ?
+        """, (last_id, batch_size)).fetchall()
+        if not rows:
+            return done
+        conn.executemany("UPDATE domains SET content_hash = ? WHERE id = ?", [
+            (build_content_fingerprint(json.loads(http_data or '{}')), domain_id)
+            for domain_id, http_data in rows])
+        done += len(rows)
+        last_id = rows[-1][0]
+
+
+def _counter_delta(counters: Dict[str, str], terms: List[Tuple[str, str]]) -> str:
+    """UPDATE adding, per counter, sign * predicate(row) for each (sign, row) term"""
+    cases = []
+    for name, predicate in counters.items():
+        delta = " ".join(f"{sign} (CASE WHEN {predicate.format(r=row)} THEN 1 ELSE 0 END)"
+                         for sign, row in terms)
+        cases.append(f"WHEN '{name}' THEN {delta}")
+    names = ", ".join(f"'{name}'" for name in counters)
+    return (f"UPDATE stats_counters SET value = value + CASE name {' '.join(cases)} END "
+            f"WHERE name IN ({names});")
+
+
+def counter_triggers() -> List[str]:
+    """CREATE TRIGGER statements keeping stats_counters in step with the tables"""
+    domain_states = {k: v for k, v in DOMAIN_COUNTERS.items() if k != "domains_total"}
+    enriched = {k: v for k, v in CLASSIFICATION_COUNTERS.items() if k != "classifications_total"}
+    method_up = ("INSERT INTO stats_counters (name, value) VALUES ('method:' || NEW.method, 1) "
+                 "ON CONFLICT(name) DO UPDATE SET value = value + 1;")
+    method_down = "UPDATE stats_counters SET value = value - 1 WHERE name = 'method:' || OLD.method;"
+    return [
+        f"""CREATE TRIGGER IF NOT EXISTS trg_domains_count_insert AFTER INSERT ON domains
+            BEGIN {_counter_delta(DOMAIN_COUNTERS, [("+", "NEW")])} END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_domains_count_delete AFTER DELETE ON domains
+            BEGIN {_counter_delta(DOMAIN_COUNTERS, [("-", "OLD")])} END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_domains_count_update
+            AFTER UPDATE OF classified, fetch_status ON domains
+            WHEN OLD.classified IS NOT NEW.classified OR OLD.fetch_status IS NOT NEW.fetch_status
+            BEGIN {_counter_delta(domain_states, [("+", "NEW"), ("-", "OLD")])} END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_classifications_count_insert
+            AFTER INSERT ON classifications
+            BEGIN {_counter_delta(CLASSIFICATION_COUNTERS, [("+", "NEW")])} {method_up} END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_classifications_count_delete
+            AFTER DELETE ON classifications
+            BEGIN {_counter_delta(CLASSIFICATION_COUNTERS, [("-", "OLD")])} {method_down} END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_classifications_count_update
+            AFTER UPDATE OF iab_enriched, method ON classifications
+            WHEN OLD.iab_enriched IS NOT NEW.iab_enriched OR OLD.method IS NOT NEW.method
+            BEGIN {_counter_delta(enriched, [("+", "NEW"), ("-", "OLD")])}
+                  {method_down} {method_up} END""",
+    ]
+
+
+def rebuild_counters(conn: sqlite3.Connection) -> None:
+    """Recount stats_counters from the tables (first migration, or repair)"""
+    conn.execute("DELETE FROM stats_counters")
+    for table, counters in (("domains", DOMAIN_COUNTERS),
+                            ("classifications", CLASSIFICATION_COUNTERS)):
+        sums = ", ".join(f"SUM(CASE WHEN {predicate.format(r=table)} THEN 1 ELSE 0 END)"
+                         for predicate in counters.values())
+        values = conn.execute(f"SELECT {sums} FROM {table}").fetchone()
+        conn.executemany("INSERT INTO stats_counters (name, value) VALUES (?, ?)",
+                         [(name, value or 0) for name, value in zip(counters, values)])
+    conn.execute("""
+        INSERT INTO stats_counters (name, value)
+        SELECT 'method:' || method, COUNT(*) FROM classifications GROUP BY method
+    """)
 
 
 @contextmanager
 def get_connection(db_path: str = DEFAULT_DB_PATH):
-    """Context manager for database connections"""
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row  # Enable dict-like access
-    try:
+    """Context manager for a transaction on this thread's pooled connection"""
+    with get_manager(db_path).transaction() as conn:
         yield conn
-        conn.commit()
-    except Exception:
-        conn.rollback()
-        raise
-    finally:
-        conn.close()
+
+
+def build_content_fingerprint(http: Dict[str, Any]) -> str:
+    """Build content fingerprint"""
+    title = (http.get("title") or "").strip()
+    meta_desc = ((http.get("meta", {}) or {}).get("description") or "").strip()
+    snippet = (http.get("body_snippet") or "")[:500].strip()
+    
+    combined = f"{title}|{meta_desc}|{snippet}".lower()
+    combined = re.sub(r'\s+', ' ', combined)
+    
+    return hashlib.sha256(combined.encode('utf-8')).hexdigest()
 
 
 def insert_domain(conn: sqlite3.Connection, fqdn: str, dns_data: Dict, http_data: Dict, 
                   fetch_status: str = 'success', fetch_error: Optional[str] = None) -> int:
     """Insert or update a domain fetch result"""
     
+    ids = insert_domains_bulk(conn, [{
+        'fqdn': fqdn,
+        'dns_data': dns_data,
+        'http_data': http_data,
+        'fetch_status': fetch_status,
+        'fetch_error': fetch_error,
+    }])
+    return ids[fqdn]
+
+
+def get_domain_ids(conn: sqlite3.Connection, fqdns: List[str]) -> Dict[str, int]:
+    """Map fqdns to domain ids (chunked to stay under SQLite's variable limit)"""
+    
+    ids = {}
+    for i in range(0, len(fqdns), 500):
+        chunk = fqdns[i:i + 500]
+        placeholders = ",".join("?" * len(chunk))
+        cursor = conn.execute(
+            f"SELECT id, fqdn FROM domains WHERE fqdn IN ({placeholders})", chunk)
+        for row in cursor:
+            ids[row[1]] = row[0]
+    return ids
+
+
+# RETURNING (SQLite 3.35+) hands back ids from the write itself; older
+# libraries fall back to executemany plus a lookup
+SUPPORTS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Rows per multi-row INSERT; 500 x 12 columns stays well under the
+# 32766-variable limit of every SQLite that has RETURNING
+BULK_ROWS = 500
+
+DOMAIN_COLUMNS = ("fqdn", "dns_data", "http_data", "fetched_at", "fetch_status",
+                  "fetch_error", "fetch_attempts", "etag", "last_modified",
+                  "content_hash", "page_hash", "priority")
+
+# A failed or blocked re-fetch of a domain we already have content for
+# keeps that content (and its classification); fetched_at stays old, so the
+# next refresh tries again. dns_failed counts too: the fetcher cannot tell
+# a transient resolver error from NXDOMAIN.
+KEEP_STORED_FETCH = ("excluded.fetch_status IN ('http_failed', 'dns_failed', 'blocked') "
+                     "AND domains.fetch_status = 'success'")
+
+KEPT_FETCH_COLUMNS = ("dns_data", "http_data", "fetched_at", "fetch_status", "fetch_error",
+                      "fetch_attempts", "etag", "last_modified", "content_hash")
+
+# A re-fetch only sends the domain back to the classifier when the content
+# fingerprint (or fetch outcome) actually changed
+DOMAIN_UPSERT = f"""
+    INSERT INTO domains ({', '.join(DOMAIN_COLUMNS)})
+    VALUES {{values}}
+    ON CONFLICT(fqdn) DO UPDATE SET
+        {', '.join(f'{c} = CASE WHEN {KEEP_STORED_FETCH} THEN domains.{c} ELSE excluded.{c} END'
+                   for c in KEPT_FETCH_COLUMNS)},
+        page_hash = COALESCE(excluded.page_hash, domains.page_hash),
+        priority = COALESCE(excluded.priority, domains.priority),
+        classified = CASE
+            WHEN {KEEP_STORED_FETCH} THEN domains.classified
+            WHEN domains.content_hash IS excluded.content_hash
+                 AND domains.fetch_status = excluded.fetch_status
+            THEN domains.classified ELSE 0 END,
+        updated_at = datetime('now')
+"""
+
+IAB_COLUMNS = ("iab_tier1_id", "iab_tier1_name", "iab_tier2_id", "iab_tier2_name",
+               "is_sensitive", "sensitive_categories")
+
+# iab_enriched: 0 waiting for enrichment, 1 enriched, IAB_NO_MAPPING when the
+# category has no iab_mapping entry (re-queued by set_iab_mapping)
+IAB_NO_MAPPING = 2
+
+
+def iab_timestamp() -> str:
+    """iab_enriched_at / classified_at value: the format of SQLite's datetime('now')"""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+CLASSIFICATION_COLUMNS = ("domain_id", "fqdn", "method", "category", "confidence",
+                          "reason", "signals", "llm_raw", "content_hash", "classified_at",
+                          *IAB_COLUMNS, "iab_enriched", "iab_enriched_at")
+
+CLASSIFICATION_INSERT = f"""
+    INSERT INTO classifications ({', '.join(CLASSIFICATION_COLUMNS)})
+    VALUES {{values}}
+"""
+
+CURRENT_COLUMNS = ("domain_id", "classification_id", "fqdn", "method", "category",
+                   "confidence", "reason", "iab_tier1_id", "iab_tier1_name",
+                   "iab_tier2_id", "iab_tier2_name", "is_sensitive",
+                   "sensitive_categories", "iab_enriched", "content_hash", "classified_at")
+
+# Every write to a current row takes the next version, so consumers
+# (incremental exports, the lookup service) pick up IAB updates as well as
+# new classifications. Under executemany (CURRENT_UPSERT,
+# update_iab_taxonomy_bulk) it is evaluated per row, so versions increase
+# strictly within a batch; only a set-based UPDATE (_enrich_range) gives
+# its rows one shared version, which read_current_classifications allows for
+NEXT_CURRENT_VERSION = "(SELECT COALESCE(MAX(version), 0) + 1 FROM current_classification)"
+
+# A newer classification replaces the domain's current one, IAB fields included
+CURRENT_UPSERT = f"""
+    INSERT INTO current_classification ({', '.join(CURRENT_COLUMNS)}, version)
+    VALUES ({', '.join('?' * len(CURRENT_COLUMNS))}, {NEXT_CURRENT_VERSION})
+    ON CONFLICT(domain_id) DO UPDATE SET
+        {', '.join(f'{c} = excluded.{c}' for c in CURRENT_COLUMNS[1:])},
+        version = excluded.version
+    WHERE excluded.classification_id > current_classification.classification_id
+"""
+
+
+def _as_json(value: Any) -> Optional[str]:
+    return value if value is None or isinstance(value, str) else json.dumps(value)
+
+
+def _values_clause(columns: int, rows: int) -> str:
+    row = "(" + ",".join("?" * columns) + ")"
+    return ",".join([row] * rows)
+
+
+def _chunked(rows: List[Tuple], size: int = BULK_ROWS):
+    for i in range(0, len(rows), size):
+        yield rows[i:i + size]
+
+
+# Fetch outcomes whose HTTP error is also stored in fetch_error
+FAILED_STATUSES = ("http_failed", "dns_failed")
+
+
+class FetchRecord:
+    """
+    One fetch result, from fetch_domain through the writer.
+
+    Slotted because runs buffer hundreds of thousands of them (writer and
+    LLM queues, cross-process batches); dns / http stay dicts, they are
+    stored as JSON. raw_html, started, input_pos and classification are
+    transient and never stored.
+    """
+
+    __slots__ = ("fqdn", "dns", "http", "status", "etag", "last_modified",
+                 "content_hash", "page_hash", "attempts", "priority", "input_pos",
+                 "raw_html", "started", "classification")
+
+    def __init__(self, fqdn: str, dns: Optional[Dict] = None, http: Optional[Dict] = None,
+                 status: str = "unknown"):
+        self.fqdn = fqdn
+        self.dns = dns if dns is not None else {}
+        self.http = http if http is not None else {}
+        self.status = status
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+        self.content_hash: Optional[str] = None
+        self.page_hash: Optional[str] = None
+        self.attempts = 1
+        self.priority: Optional[int] = None
+        self.input_pos: Optional[Tuple[int, int, int]] = None
+        self.raw_html: Optional[bytes] = None
+        self.started: Optional[float] = None
+        self.classification: Optional["ClassificationRecord"] = None
+
+    def to_row(self, fetched_at: str) -> Tuple:
+        """DOMAIN_COLUMNS values"""
+        return (self.fqdn, json.dumps(self.dns), json.dumps(self.http), fetched_at,
+                self.status, self.http.get("error") if self.status in FAILED_STATUSES else None,
+                self.attempts, self.etag, self.last_modified, self.content_hash,
+                self.page_hash, self.priority)
+
+
+class ClassificationRecord:
+    """One classifier decision, as preclassify / classify_with_llm return it"""
+
+    __slots__ = ("domain_id", "fqdn", "method", "category", "confidence", "reason",
+                 "signals", "llm_raw", "content_hash", "redirect_host")
+
+    def __init__(self, domain_id: Optional[int], fqdn: str, method: str, category: str,
+                 confidence: float, reason: str, signals: Optional[Dict] = None,
+                 llm_raw: Optional[Dict] = None, content_hash: Optional[str] = None,
+                 redirect_host: Optional[str] = None):
+        self.domain_id = domain_id
+        self.fqdn = fqdn
+        self.method = method
+        self.category = category
+        self.confidence = confidence
+        self.reason = reason
+        self.signals = signals
+        self.llm_raw = llm_raw
+        self.content_hash = content_hash
+        self.redirect_host = redirect_host
+
+    def to_row(self, classified_at: str) -> Tuple:
+        """CLASSIFICATION_COLUMNS values up to the IAB columns"""
+        return (self.domain_id, self.fqdn, self.method, self.category, self.confidence,
+                self.reason, _as_json(self.signals or {}),
+                _as_json(self.llm_raw) if self.llm_raw else None,
+                self.content_hash, classified_at)
+
+
+def insert_domains_bulk(conn: sqlite3.Connection, domains: List) -> Dict[str, int]:
+    """
+    Upsert fetch results in multi-row statements; returns {fqdn: domain_id}.
+
+    Takes FetchRecords (stored as fetched now) or dicts with DOMAIN_COLUMNS
+    keys; in a dict dns_data / http_data may be dicts or JSON text,
+    fetched_at defaults to now and fetch_attempts to 1. A missing priority
+    keeps the one already stored.
+    """
+    if not domains:
+        return {}
     now = datetime.now(timezone.utc).isoformat()
+    rows = [d.to_row(now) if isinstance(d, FetchRecord) else
+            (d['fqdn'], _as_json(d.get('dns_data') or {}), _as_json(d.get('http_data') or {}),
+             d.get('fetched_at') or now, d.get('fetch_status', 'success'), d.get('fetch_error'),
+             d.get('fetch_attempts', 1), d.get('etag'), d.get('last_modified'),
+             d.get('content_hash'), d.get('page_hash'), d.get('priority'))
+            for d in domains]
+
+    if not SUPPORTS_RETURNING:
+        conn.executemany(DOMAIN_UPSERT.format(values=_values_clause(len(DOMAIN_COLUMNS), 1)), rows)
+        return get_domain_ids(conn, [r[0] for r in rows])
+
+    ids = {}
+    for chunk in _chunked(rows):
+        sql = DOMAIN_UPSERT.format(values=_values_clause(len(DOMAIN_COLUMNS), len(chunk)))
+        params = [v for row in chunk for v in row]
+        for domain_id, fqdn in conn.execute(sql + " RETURNING id, fqdn", params):
+            ids[fqdn] = domain_id
+    return ids
+
+
+def insert_classifications_bulk(conn: sqlite3.Connection, results: List,
+                                iab_mapping: Optional[Dict[str, Tuple]] = None) -> List[int]:
+    """
+    Write classifier results and mark their domains classified.
+
+    Results are ClassificationRecords or dicts of their fields. Each is
+    appended to the classifications history and upserted into
+    current_classification. With `iab_mapping` (load_iab_mapping) mapped
+    categories are written already IAB-enriched (the rest as
+    IAB_NO_MAPPING). LLM results with a content hash also refresh
+    content_hash_cache, and those with a redirect_host refresh
+    redirect_host_cache. Returns the new classification ids in input order.
+    """
+    if not results:
+        return []
+    results = [r if isinstance(r, ClassificationRecord) else ClassificationRecord(**r)
+               for r in results]
+    now = iab_timestamp()
+    if iab_mapping:
+        unmapped = (None, None, None, None, 0, None, IAB_NO_MAPPING, now)
+        iab = [iab_mapping[r.category] + (1, now) if r.category in iab_mapping else unmapped
+               for r in results]
+    else:
+        iab = [(None, None, None, None, 0, None, 0, None)] * len(results)
+    rows = [r.to_row(now) + taxonomy for r, taxonomy in zip(results, iab)]
+
+    ids: List[int] = []
+    if SUPPORTS_RETURNING:
+        for chunk in _chunked(rows):
+            sql = CLASSIFICATION_INSERT.format(
+                values=_values_clause(len(CLASSIFICATION_COLUMNS), len(chunk)))
+            # RETURNING order is unspecified, but rowids of one multi-row
+            # insert are allocated in VALUES order
+            ids.extend(sorted(row[0] for row in conn.execute(
+                sql + " RETURNING id", [v for row in chunk for v in row])))
+    else:
+        sql = CLASSIFICATION_INSERT.format(values=_values_clause(len(CLASSIFICATION_COLUMNS), 1))
+        for row in rows:
+            ids.append(conn.execute(sql, row).lastrowid)
+
+    conn.executemany(CURRENT_UPSERT, [
+        (r.domain_id, cid, r.fqdn, r.method, r.category, r.confidence,
+         r.reason) + taxonomy[:7] + (r.content_hash, now)
+        for r, cid, taxonomy in zip(results, ids, iab)])
     
-    cursor = conn.execute("""
-        INSERT INTO domains (fqdn, dns_data, http_data, fetched_at, fetch_status, fetch_error)
-        VALUES (?, ?, ?, ?, ?, ?)
-        ON CONFLICT(fqdn) DO UPDATE SET
-            dns_data = excluded.dns_data,
-            http_data = excluded.http_data,
-            fetched_at = excluded.fetched_at,
-            fetch_status = excluded.fetch_status,
-            fetch_error = excluded.fetch_error,
-            updated_at = datetime('now')
-    """, (
-        fqdn,
-        json.dumps(dns_data),
-        json.dumps(http_data),
-        now,
-        fetch_status,
-        fetch_error
-    ))
-    
-    # Get the domain_id
-    cursor = conn.execute("SELECT id FROM domains WHERE fqdn = ?", (fqdn,))
-    domain_id = cursor.fetchone()[0]
-    
-    return domain_id
-
-
-def get_domains_to_classify(conn: sqlite3.Connection, limit: Optional[int] = None) -> List[Dict]:
-    """Get domains that need classification"""
+    conn.executemany("""
+        UPDATE domains SET classified = 1, classified_at = ? WHERE id = ?
+    """, [(now, r.domain_id) for r in results])
+
+    conn.executemany("""
+        INSERT OR REPLACE INTO content_hash_cache
+        (content_hash, category, confidence, example_fqdn, cached_at)
+        VALUES (?, ?, ?, ?, ?)
+    """, [(r.content_hash, r.category, r.confidence, r.fqdn, now)
+          for r in results if r.content_hash and r.method == 'llm'])
+
+    conn.executemany("""
+        INSERT OR REPLACE INTO redirect_host_cache
+        (host, category, confidence, example_fqdn, cached_at)
+        VALUES (?, ?, ?, ?, ?)
+    """, [(r.redirect_host, r.category, r.confidence, r.fqdn, now)
+          for r in results if r.redirect_host and r.method == 'llm'])
+
+    return ids
+
+
+# Share of picks that go to the oldest waiting item instead of the highest
+# priority one, so unranked and low-priority domains still make progress
+DEFAULT_AGING_SHARE = 0.1
+
+
+def priority_order(items: List, priority, age, aging_share: float = DEFAULT_AGING_SHARE) -> List:
+    """
+    Order items by priority (lower first, None last) with aging.
+
+    `priority` and `age` are key functions (smaller age = older). Every
+    1/aging_share-th pick is the oldest item not yet taken; with no
+    priorities at all the result is plain age order.
+    """
+    by_priority = sorted(range(len(items)), key=lambda i: (priority(items[i]) is None,
+                                                          priority(items[i]) or 0,
+                                                          age(items[i])))
+    if aging_share <= 0:
+        return [items[i] for i in by_priority]
+    by_age = sorted(range(len(items)), key=lambda i: age(items[i]))
+
+    ordered = []
+    taken = bytearray(len(items))
+    credit = 0.0
+    next_priority = next_age = 0
+    while len(ordered) < len(items):
+        credit += aging_share
+        if credit >= 1.0:
+            credit -= 1.0
+            while taken[by_age[next_age]]:
+                next_age += 1
+            pick = by_age[next_age]
+        else:
+            while taken[by_priority[next_priority]]:
+                next_priority += 1
+            pick = by_priority[next_priority]
+        taken[pick] = 1
+        ordered.append(items[pick])
+    return ordered
+
+
+def feature_doc(row: sqlite3.Row) -> Dict[str, Any]:
+    """Classifier document (the dns/http shape the fetcher produces) from feature columns"""
+    return {
+        'domain_id': row['domain_id'],
+        'fqdn': row['fqdn'],
+        'dns': {'rcode': row['dns_rcode']},
+        'http': {
+            'status': row['http_status'] if row['http_status'] is not None else 0,
+            'blocked': bool(row['http_blocked']),
+            'title': row['title'],
+            'meta': {'description': row['meta_description']} if row['meta_description'] else {},
+            'body_snippet': row['body_snippet'],
+            'final_url': row['final_url'],
+        },
+        'fetched_at': row['fetched_at'],
+        'priority': row['priority'],
+    }
+
+
+def get_domains_to_classify(conn: sqlite3.Connection, limit: Optional[int] = None,
+                            aging_share: float = DEFAULT_AGING_SHARE) -> List[Dict]:
+    """Get domains that need classification, in priority_order (by priority, then id)"""
     
+    # Only the fields the classifier uses, via the typed feature columns;
+    # the JSON blobs are never parsed in Python
     query = """
-        SELECT id as domain_id, fqdn, dns_data, http_data, fetched_at
+        SELECT id as domain_id, fqdn, dns_rcode, http_status, http_blocked, title,
+               meta_description, body_snippet, final_url, fetched_at, priority
         FROM domains
         WHERE classified = 0 AND fetch_status = 'success'
-        ORDER BY id
     """
     
-    if limit:
-        query += f" LIMIT {limit}"
-    
-    cursor = conn.execute(query)
-    
-    domains = []
-    for row in cursor:
-        domains.append({
-            'domain_id': row['domain_id'],
-            'fqdn': row['fqdn'],
-            'dns': json.loads(row['dns_data']) if row['dns_data'] else {},
-            'http': json.loads(row['http_data']) if row['http_data'] else {},
-            'fetched_at': row['fetched_at']
-        })
+    if not limit:
+        docs = [feature_doc(row) for row in conn.execute(query)]
+    else:
+        # The first `limit` picks come from the `limit` best-ranked and the
+        # `limit` oldest domains; both are index range scans
+        # (idx_domains_pending_priority / idx_domains_pending)
+        limit = int(limit)
+        docs = {}
+        for order in ("AND priority IS NOT NULL ORDER BY priority, id", "ORDER BY id"):
+            for row in conn.execute(f"{query} {order} LIMIT {limit}"):
+                docs[row['domain_id']] = feature_doc(row)
+        docs = list(docs.values())
     
-    return domains
+    ordered = priority_order(docs, lambda d: d['priority'], lambda d: d['domain_id'], aging_share)
+    return ordered[:limit] if limit else ordered
 
 
 def insert_classification(conn: sqlite3.Connection, domain_id: int, fqdn: str,
@@ -171,26 +1152,17 @@ def insert_classification(conn: sqlite3.Connection, domain_id: int, fqdn: str,
                          content_hash: Optional[str] = None) -> int:
     """Insert a classification result"""
     
-    now = datetime.now(timezone.utc).isoformat()
-    
-    cursor = conn.execute("""
-        INSERT INTO classifications 
-        (domain_id, fqdn, method, category, confidence, reason, signals, llm_raw, content_hash, classified_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
-        domain_id,
-        fqdn,
-        method,
-        category,
-        confidence,
-        reason,
-        json.dumps(signals),
-        json.dumps(llm_raw) if llm_raw else None,
-        content_hash,
-        now
-    ))
-    
-    return cursor.lastrowid
+    return insert_classifications_bulk(conn, [{
+        'domain_id': domain_id,
+        'fqdn': fqdn,
+        'method': method,
+        'category': category,
+        'confidence': confidence,
+        'reason': reason,
+        'signals': signals,
+        'llm_raw': llm_raw,
+        'content_hash': content_hash,
+    }])[0]
 
 
 def get_content_hash_cache(conn: sqlite3.Connection, content_hash: str) -> Optional[Dict]:
@@ -240,9 +1212,28 @@ def update_iab_taxonomy(conn: sqlite3.Connection, classification_id: int,
                        is_sensitive: bool, sensitive_categories: List[str]) -> None:
     """Update classification with IAB taxonomy"""
     
-    now = datetime.now(timezone.utc).isoformat()
+    update_iab_taxonomy_bulk(conn, [{
+        'classification_id': classification_id,
+        'iab_tier1_id': iab_tier1_id,
+        'iab_tier1_name': iab_tier1_name,
+        'iab_tier2_id': iab_tier2_id,
+        'iab_tier2_name': iab_tier2_name,
+        'is_sensitive': is_sensitive,
+        'sensitive_categories': sensitive_categories,
+    }])
+
+
+def update_iab_taxonomy_bulk(conn: sqlite3.Connection, updates: List[Dict]) -> int:
+    """Apply IAB taxonomy to many classifications (and current rows); returns rows updated"""
     
-    conn.execute("""
+    if not updates:
+        return 0
+    now = iab_timestamp()
+    rows = [(u['iab_tier1_id'], u['iab_tier1_name'], u['iab_tier2_id'], u['iab_tier2_name'],
+             1 if u['is_sensitive'] else 0, _as_json(u.get('sensitive_categories') or []),
+             now, u['classification_id'])
+            for u in updates]
+    cursor = conn.executemany("""
         UPDATE classifications
         SET iab_tier1_id = ?,
             iab_tier1_name = ?,
@@ -253,82 +1244,548 @@ def update_iab_taxonomy(conn: sqlite3.Connection, classification_id: int,
             iab_enriched = 1,
             iab_enriched_at = ?
         WHERE id = ?
-    """, (
-        iab_tier1_id,
-        iab_tier1_name,
-        iab_tier2_id,
-        iab_tier2_name,
-        1 if is_sensitive else 0,
-        json.dumps(sensitive_categories),
-        now,
-        classification_id
-    ))
+    """, rows)
+    updated = cursor.rowcount
+    conn.executemany(f"""
+        UPDATE current_classification
+        SET iab_tier1_id = ?,
+            iab_tier1_name = ?,
+            iab_tier2_id = ?,
+            iab_tier2_name = ?,
+            is_sensitive = ?,
+            sensitive_categories = ?,
+            iab_enriched = 1,
+            version = {NEXT_CURRENT_VERSION}
+        WHERE classification_id = ?
+    """, [row[:6] + row[7:] for row in rows])
+    return updated
 
 
-def get_statistics(conn: sqlite3.Connection) -> Dict[str, Any]:
-    """Get database statistics"""
+def set_iab_mapping(conn: sqlite3.Connection, mapping: Dict[str, Tuple]) -> None:
+    """
+    Replace the iab_mapping table (values as in DEFAULT_IAB_MAPPING).
+    Classifications that had no mapping go back to the enrichment queue.
+    """
+    conn.execute("DELETE FROM iab_mapping")
+    conn.executemany(f"""
+        INSERT INTO iab_mapping (category, {', '.join(IAB_COLUMNS)})
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, [(category, t1_id, t1_name, t2_id, t2_name, 1 if sensitive else 0, json.dumps(sensitive_cats))
+          for category, (t1_id, t1_name, t2_id, t2_name, sensitive, sensitive_cats)
+          in mapping.items()])
+    conn.execute("""
+        UPDATE classifications SET iab_enriched = 0, iab_enriched_at = NULL
+        WHERE iab_enriched = ?
+    """, (IAB_NO_MAPPING,))
+    conn.execute("UPDATE current_classification SET iab_enriched = 0 WHERE iab_enriched = ?",
+                 (IAB_NO_MAPPING,))
+
+
+def load_iab_mapping(conn: sqlite3.Connection) -> Dict[str, Tuple]:
+    """category -> IAB column values (IAB_COLUMNS order), for inline enrichment"""
+    return {row[0]: tuple(row[1:]) for row in conn.execute(
+        f"SELECT category, {', '.join(IAB_COLUMNS)} FROM iab_mapping")}
+
+
+# UPDATE ... FROM needs SQLite 3.33; older libraries use correlated subqueries
+SUPPORTS_UPDATE_FROM = sqlite3.sqlite_version_info >= (3, 33, 0)
+
+
+def _enrich_range(conn: sqlite3.Connection, low: int, high: int, now: str) -> int:
+    """
+    Enrich unenriched classifications with low < id <= high; returns rows
+    enriched. The rest of the range has no mapping and is marked so.
+    """
+    if SUPPORTS_UPDATE_FROM:
+        cursor = conn.execute(f"""
+            UPDATE classifications
+            SET {', '.join(f'{c} = m.{c}' for c in IAB_COLUMNS)},
+                iab_enriched = 1,
+                iab_enriched_at = ?
+            FROM iab_mapping AS m
+            WHERE m.category = classifications.category
+              AND classifications.iab_enriched = 0
+              AND classifications.id > ? AND classifications.id <= ?
+        """, (now, low, high))
+    else:
+        lookups = ', '.join(f'{c} = (SELECT m.{c} FROM iab_mapping m '
+                            f'WHERE m.category = classifications.category)' for c in IAB_COLUMNS)
+        cursor = conn.execute(f"""
+            UPDATE classifications
+            SET {lookups}, iab_enriched = 1, iab_enriched_at = ?
+            WHERE iab_enriched = 0 AND id > ? AND id <= ?
+              AND category IN (SELECT category FROM iab_mapping)
+        """, (now, low, high))
+    enriched = cursor.rowcount
+    if enriched:
+        # Current rows follow their classification
+        conn.execute(f"""
+            UPDATE current_classification
+            SET {', '.join(f'{c} = (SELECT h.{c} FROM classifications h WHERE h.id = classification_id)'
+                           for c in IAB_COLUMNS)},
+                iab_enriched = 1,
+                version = {NEXT_CURRENT_VERSION}
+            WHERE iab_enriched = 0 AND classification_id > ? AND classification_id <= ?
+              AND classification_id IN (SELECT id FROM classifications
+                                        WHERE id > ? AND id <= ? AND iab_enriched = 1)
+        """, (low, high, low, high))
+    # IAB columns stay NULL, so current rows need no new version
+    if conn.execute("""
+        UPDATE classifications SET iab_enriched = ?, iab_enriched_at = ?
+        WHERE iab_enriched = 0 AND id > ? AND id <= ?
+    """, (IAB_NO_MAPPING, now, low, high)).rowcount:
+        conn.execute("""
+            UPDATE current_classification SET iab_enriched = ?
+            WHERE iab_enriched = 0 AND classification_id > ? AND classification_id <= ?
+              AND classification_id IN (SELECT id FROM classifications
+                                        WHERE id > ? AND id <= ? AND iab_enriched = ?)
+        """, (IAB_NO_MAPPING, low, high, low, high, IAB_NO_MAPPING))
+    return enriched
+
+
+def enrich_iab(db_path: str, chunk_size: int = 50000, progress=None) -> int:
+    """
+    Set-based IAB enrichment of every classification with iab_enriched = 0.
+
+    Works through id ranges of `chunk_size`, one short transaction each, so
+    the classifier can keep writing meanwhile. Categories missing from
+    iab_mapping are marked IAB_NO_MAPPING, so later passes skip them until
+    the mapping changes. Returns rows enriched (all shards).
+    """
+    total = 0
+    for path in shard_paths(db_path):
+        with get_connection(path) as conn:
+            low, last = conn.execute("""
+                SELECT MIN(id) - 1, MAX(id) FROM classifications WHERE iab_enriched = 0
+            """).fetchone()
+        if last is None:
+            continue
+        while low < last:
+            high = min(low + chunk_size, last)
+            now = iab_timestamp()
+            with get_connection(path) as conn:
+                total += _enrich_range(conn, low, high, now)
+            if progress is not None:
+                progress(path, high, last, total)
+            low = high
+    return total
+
+
+def create_fetch_run(conn: sqlite3.Connection, input_path: str, input_size: int,
+                     input_mtime: float, config: Dict) -> int:
+    """Start a new fetch run manifest at the beginning of the input file"""
     
     cursor = conn.execute("""
-        SELECT 
-            COUNT(*) as total_domains,
-            SUM(CASE WHEN classified = 1 THEN 1 ELSE 0 END) as classified,
-            SUM(CASE WHEN classified = 0 THEN 1 ELSE 0 END) as unclassified,
-            SUM(CASE WHEN fetch_status != 'success' THEN 1 ELSE 0 END) as failed_fetches
-        FROM domains
-    """)
+        INSERT INTO fetch_runs (input_path, input_size, input_mtime, config)
+        VALUES (?, ?, ?, ?)
+    """, (input_path, input_size, input_mtime, json.dumps(config)))
     
-    stats = dict(cursor.fetchone())
+    return cursor.lastrowid
+
+
+def get_latest_fetch_run(conn: sqlite3.Connection, input_path: str) -> Optional[Dict]:
+    """Get the most recent fetch run manifest for an input file"""
     
-    # Classification breakdown
     cursor = conn.execute("""
-        SELECT method, COUNT(*) as count
-        FROM classifications
-        GROUP BY method
-    """)
+        SELECT id, input_path, input_size, input_mtime, byte_offset, line_number,
+               config, status, started_at, updated_at
+        FROM fetch_runs
+        WHERE input_path = ?
+        ORDER BY id DESC
+        LIMIT 1
+    """, (input_path,))
     
-    stats['by_method'] = {row['method']: row['count'] for row in cursor}
+    row = cursor.fetchone()
+    if row is None:
+        return None
     
-    # IAB enrichment status
-    cursor = conn.execute("""
-        SELECT 
-            COUNT(*) as total_classifications,
-            SUM(CASE WHEN iab_enriched = 1 THEN 1 ELSE 0 END) as iab_enriched
-        FROM classifications
-    """)
+    run = dict(row)
+    run['config'] = json.loads(run['config']) if run['config'] else {}
+    return run
+
+
+def update_fetch_run_checkpoint(conn: sqlite3.Connection, run_id: int,
+                                byte_offset: int, line_number: int) -> None:
+    """Advance a run's checkpoint (call inside the transaction that wrote the results)"""
     
-    iab_stats = dict(cursor.fetchone())
-    stats.update(iab_stats)
+    conn.execute("""
+        UPDATE fetch_runs
+        SET byte_offset = ?, line_number = ?, updated_at = datetime('now')
+        WHERE id = ?
+    """, (byte_offset, line_number, run_id))
+
+
+def finish_fetch_run(conn: sqlite3.Connection, run_id: int, status: str = 'completed') -> None:
+    """Mark a fetch run as finished"""
     
-    return stats
+    conn.execute("""
+        UPDATE fetch_runs
+        SET status = ?, updated_at = datetime('now')
+        WHERE id = ?
+    """, (status, run_id))
 
 
-def export_to_csv(conn: sqlite3.Connection, output_path: str) -> None:
-    """Export classifications to CSV"""
+def get_retryable_domains(conn: sqlite3.Connection, max_attempts: Dict[str, int],
+                          limit: Optional[int] = None) -> List[Dict]:
+    """
+    Get earlier transient fetch failures that are still under their attempt cap.
     
-    import csv
+    Served by the partial index idx_domains_retry, so only http_failed rows
+    are touched.
+    """
     
-    cursor = conn.execute("""
+    if not max_attempts:
+        return []
+    
+    clauses = " OR ".join("(fetch_error = ? AND fetch_attempts < ?)" for _ in max_attempts)
+    params: List[Any] = []
+    for error, cap in max_attempts.items():
+        params.extend([error, cap])
+    
+    query = f"""
+        SELECT fqdn, fetch_error, fetch_attempts
+        FROM domains
+        WHERE fetch_status = 'http_failed' AND ({clauses})
+        ORDER BY id
+    """
+    
+    if limit:
+        query += f" LIMIT {int(limit)}"
+    
+    return [dict(row) for row in conn.execute(query, params)]
+
+
+def get_domains_to_refresh(conn: sqlite3.Connection, fetched_before: str,
+                           limit: Optional[int] = None) -> List[Dict]:
+    """
+    Get domains last fetched before `fetched_before` (ISO timestamp), oldest first,
+    with the validators needed for a conditional request and the stored
+    content_hash / classified state.
+    """
+    
+    query = """
+        SELECT fqdn, etag, last_modified, fetched_at, content_hash, classified
+        FROM domains
+        WHERE fetched_at < ?
+        ORDER BY fetched_at
+    """
+    
+    if limit:
+        query += f" LIMIT {int(limit)}"
+    
+    return [dict(row) for row in conn.execute(query, (fetched_before,))]
+
+
+def get_statistics(conn: sqlite3.Connection) -> Dict[str, Any]:
+    """Get database statistics (O(1): read from the trigger-maintained counters)"""
+    
+    counters = {row[0]: row[1] for row in conn.execute("SELECT name, value FROM stats_counters")}
+    
+    return {
+        'total_domains': counters.get('domains_total', 0),
+        'classified': counters.get('domains_classified', 0),
+        'unclassified': counters.get('domains_unclassified', 0),
+        'pending': counters.get('domains_pending', 0),
+        'failed_fetches': counters.get('domains_failed', 0),
+        'by_method': {name[len('method:'):]: value for name, value in sorted(counters.items())
+                      if name.startswith('method:') and value},
+        'total_classifications': counters.get('classifications_total', 0),
+        'iab_enriched': counters.get('classifications_iab_enriched', 0),
+    }
+
+
+def get_pending_count(conn: sqlite3.Connection) -> int:
+    """Successfully fetched domains still waiting for the classifier"""
+    row = conn.execute("SELECT value FROM stats_counters WHERE name = 'domains_pending'").fetchone()
+    return row[0] if row else 0
+
+
+def get_total_statistics(db_path: str) -> Dict[str, Any]:
+    """get_statistics summed over all shards"""
+    total: Dict[str, Any] = {}
+    for stats in fan_out(db_path, get_statistics):
+        for name, value in stats.items():
+            if isinstance(value, dict):
+                merged = total.setdefault(name, {})
+                for key, count in value.items():
+                    merged[key] = merged.get(key, 0) + count
+            else:
+                total[name] = total.get(name, 0) + value
+    total['by_method'] = dict(sorted(total.get('by_method', {}).items()))
+    return total
+
+
+def get_total_pending(db_path: str) -> int:
+    """get_pending_count summed over all shards"""
+    return sum(fan_out(db_path, get_pending_count))
+
+
+def get_current_classification(conn: sqlite3.Connection, fqdn: str) -> Optional[Dict]:
+    """A domain's latest classification, or None"""
+    row = conn.execute("SELECT * FROM current_classification WHERE fqdn = ?",
+                       (fqdn,)).fetchone()
+    return dict(row) if row else None
+
+
+CURRENT_LOOKUP_SELECT = """
+    SELECT version, fqdn, category, confidence,
+           iab_tier1_id, iab_tier1_name, iab_tier2_id, iab_tier2_name,
+           is_sensitive
+    FROM current_classification
+"""
+
+
+def iter_current_classifications(db_path: str, after: int = 0, batch_size: int = 50000):
+    """
+    Batches of (version, fqdn, category, confidence, iab_tier1_id,
+    iab_tier1_name, iab_tier2_id, iab_tier2_name, is_sensitive) from one
+    database file, for version > after, in version order
+    """
+    with get_connection(db_path) as conn:
+        cursor = conn.execute(CURRENT_LOOKUP_SELECT + """
+            WHERE version > ?
+            ORDER BY version
+        """, (after,))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield [tuple(r) for r in rows]
+
+
+def read_current_classifications(db_path: str, after: int = 0,
+                                 limit: int = 10000) -> List[Tuple]:
+    """
+    One batch of iter_current_classifications rows with version > after,
+    read in a single call (for pollers running it in an executor).
+
+    About `limit` rows: rows sharing a version are never split, so the
+    last version returned is a safe watermark for the next call.
+    """
+    with get_connection(db_path) as conn:
+        return [tuple(r) for r in conn.execute(CURRENT_LOOKUP_SELECT + """
+            WHERE version > ? AND version <= COALESCE(
+                (SELECT version FROM current_classification WHERE version > ?
+                 ORDER BY version LIMIT 1 OFFSET ?),
+                (SELECT MAX(version) FROM current_classification))
+            ORDER BY version
+        """, (after, after, limit - 1))]
+
+
+def prune_classification_history(conn: sqlite3.Connection, keep_versions: int = 1,
+                                 max_age_days: Optional[float] = None) -> int:
+    """
+    Delete superseded classifications; returns rows deleted.
+
+    Per domain the newest `keep_versions` classifications survive (the
+    current one always does); with `max_age_days`, superseded rows older
+    than that go even when within `keep_versions`.
+    """
+    keep_versions = max(1, keep_versions)
+    age_clause = ""
+    params: List[Any] = [keep_versions]
+    if max_age_days is not None:
+        age_clause = "OR datetime(classified_at) < datetime('now', ?)"
+        params.append(f"-{max_age_days} days")
+    cursor = conn.execute(f"""
+        DELETE FROM classifications WHERE id IN (
+            SELECT id FROM (
+                SELECT id, classified_at,
+                       ROW_NUMBER() OVER (PARTITION BY domain_id ORDER BY id DESC) AS version
+                FROM classifications
+            )
+            WHERE (version > ? {age_clause})
+              AND id NOT IN (SELECT classification_id FROM current_classification)
+        )
+    """, params)
+    return cursor.rowcount
+
+
+EXPORT_COLUMNS = ['fqdn', 'category', 'confidence', 'method',
+                  'iab_tier1', 'iab_tier2', 'sensitive', 'classified_at']
+EXPORT_FORMATS = ("csv", "jsonl", "parquet", "arrow")
+
+
+class _CsvExport:
+    def __init__(self, path: str):
+        import csv
+        self.f = open(path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.f)
+        self.writer.writerow(EXPORT_COLUMNS)
+    
+    def write(self, rows: List[Tuple]):
+        self.writer.writerows(rows)
+    
+    def close(self):
+        self.f.close()
+
+
+class _JsonlExport:
+    def __init__(self, path: str):
+        self.f = open(path, 'w', encoding='utf-8')
+    
+    def write(self, rows: List[Tuple]):
+        self.f.write(''.join(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + '\n'
+                             for row in rows))
+    
+    def close(self):
+        self.f.close()
+
+
+class _ArrowExport:
+    """Parquet or Arrow IPC file, one record batch per fetched chunk"""
+    
+    def __init__(self, path: str, parquet: bool):
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise RuntimeError("Parquet/Arrow export needs pyarrow: pip install pyarrow")
+        self.pa = pa
+        self.schema = pa.schema([
+            ('fqdn', pa.string()), ('category', pa.string()), ('confidence', pa.float64()),
+            ('method', pa.string()), ('iab_tier1', pa.string()), ('iab_tier2', pa.string()),
+            ('sensitive', pa.bool_()), ('classified_at', pa.string()),
+        ])
+        if parquet:
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(path, self.schema, compression='zstd')
+        else:
+            self.writer = pa.ipc.new_file(path, self.schema)
+    
+    def write(self, rows: List[Tuple]):
+        columns = [list(col) for col in zip(*rows)]
+        columns[6] = [None if v is None else bool(v) for v in columns[6]]
+        self.writer.write_batch(self.pa.RecordBatch.from_arrays(
+            [self.pa.array(col, type=field.type) for col, field in zip(columns, self.schema)],
+            schema=self.schema))
+    
+    def close(self):
+        self.writer.close()
+
+
+def _export_bounds(conn: sqlite3.Connection, incremental: Optional[str]) -> Tuple[int, int]:
+    """(low, high] range of current_classification versions to export"""
+    low = 0
+    if incremental:
+        row = conn.execute("SELECT last_id FROM export_watermarks WHERE name = ?",
+                           (incremental,)).fetchone()
+        low = row[0] if row else 0
+    # Upper bound fixed up front: rows committed during the export go to the next delta
+    high = conn.execute(
+        "SELECT COALESCE(MAX(version), 0) FROM current_classification").fetchone()[0]
+    return low, high
+
+
+def _export_batches(conn: sqlite3.Connection, low: int, high: int, sort: bool,
+                    batch_size: int):
+    cursor = conn.execute(f"""
         SELECT 
-            d.fqdn,
-            c.category,
-            c.confidence,
-            c.method,
-            c.iab_tier1_name,
-            c.iab_tier2_name,
-            c.is_sensitive,
-            c.classified_at
-        FROM domains d
-        JOIN classifications c ON d.id = c.domain_id
-        ORDER BY d.fqdn
-    """)
+            fqdn,
+            category,
+            confidence,
+            method,
+            iab_tier1_name,
+            iab_tier2_name,
+            is_sensitive,
+            classified_at
+        FROM current_classification
+        WHERE version > ? AND version <= ?
+        ORDER BY {'fqdn' if sort else 'version'}
+    """, (low, high))
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield [tuple(r) for r in rows]
+
+
+def _merged_batches(streams: List, batch_size: int):
+    """Re-batch fqdn-sorted per-shard batch streams into one sorted stream"""
+    rows = heapq.merge(*[(row for batch in stream for row in batch) for stream in streams],
+                       key=lambda row: row[0])
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def export_classifications(conn, output_path: str, fmt: Optional[str] = None,
+                           batch_size: int = 50000, sort: bool = False,
+                           incremental: Optional[str] = None) -> int:
+    """
+    Stream current classifications (one per domain) to CSV, JSONL, Parquet
+    or Arrow IPC; returns rows written.
+
+    `conn` is a connection, or a list of them (shard_connections) for a
+    sharded database, whose rows are concatenated - or merged by fqdn with
+    `sort`. Rows are fetched and written `batch_size` at a time, so memory
+    stays flat. Without `sort` rows come out in version (last change) order;
+    both orders are served by an index. With `incremental` (a consumer name)
+    only domains classified or IAB-enriched since that consumer's watermark
+    are exported; the watermark (one per shard) moves forward once the file
+    is complete. The file is written under a temporary name and renamed into
+    place at the end. Without `fmt` the format follows the file extension,
+    falling back to CSV.
+    """
+    if not fmt:
+        fmt = Path(output_path).suffix.lstrip('.').lower()
+        if fmt not in EXPORT_FORMATS:
+            fmt = "csv"
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {fmt!r} (choose from {', '.join(EXPORT_FORMATS)})")
     
-    with open(output_path, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow(['fqdn', 'category', 'confidence', 'method', 
-                        'iab_tier1', 'iab_tier2', 'sensitive', 'classified_at'])
-        
-        for row in cursor:
-            writer.writerow(row)
+    conns = conn if isinstance(conn, list) else [conn]
+    bounds = [_export_bounds(c, incremental) for c in conns]
+    written = [0] * len(conns)
+    
+    def counted(i: int):
+        for batch in _export_batches(conns[i], *bounds[i], sort, batch_size):
+            written[i] += len(batch)
+            yield batch
+    
+    streams = [counted(i) for i in range(len(conns))]
+    if sort and len(streams) > 1:
+        batches = _merged_batches(streams, batch_size)
+    else:
+        batches = (batch for stream in streams for batch in stream)
+    
+    tmp_path = f"{output_path}.tmp"
+    if fmt == "csv":
+        writer = _CsvExport(tmp_path)
+    elif fmt == "jsonl":
+        writer = _JsonlExport(tmp_path)
+    else:
+        writer = _ArrowExport(tmp_path, parquet=(fmt == "parquet"))
+    
+    try:
+        for batch in batches:
+            writer.write(batch)
+    except BaseException:
+        writer.close()
+        os.remove(tmp_path)
+        raise
+    writer.close()
+    os.replace(tmp_path, output_path)
+    
+    if incremental:
+        for c, (_, high), rows in zip(conns, bounds, written):
+            c.execute("""
+                INSERT INTO export_watermarks (name, last_id, last_rows, updated_at)
+                VALUES (?, ?, ?, datetime('now'))
+                ON CONFLICT(name) DO UPDATE SET
+                    last_id = excluded.last_id,
+                    last_rows = excluded.last_rows,
+                    updated_at = excluded.updated_at
+            """, (incremental, high, rows))
+    
+    return sum(written)
+
+
+def export_to_csv(conn: sqlite3.Connection, output_path: str) -> None:
+    """Export classifications to CSV"""
+    
+    export_classifications(conn, output_path, "csv", sort=True)
     
     print(f"✓ Exported to {output_path}")
 
@@ -341,31 +1798,86 @@ def main():
     parser = argparse.ArgumentParser(description="wxawebcat database utilities")
     parser.add_argument('--init', action='store_true', help='Initialize database')
     parser.add_argument('--stats', action='store_true', help='Show statistics')
-    parser.add_argument('--export', help='Export to CSV')
+    parser.add_argument('--export', help='Export classifications to this file')
+    parser.add_argument('--format', choices=EXPORT_FORMATS,
+                        help='Export format (default: from the file extension, else csv)')
+    parser.add_argument('--sort', action='store_true',
+                        help='Sort the export by fqdn (needs a full sort; default: change order)')
+    parser.add_argument('--incremental', metavar='NAME',
+                        help='Only export classifications changed since the watermark of '
+                             'consumer NAME, then advance it')
+    parser.add_argument('--batch-size', type=int, default=50000,
+                        help='Rows per fetch / record batch when exporting (default: 50000)')
     parser.add_argument('--db', default=DEFAULT_DB_PATH, help='Database path')
+    parser.add_argument('--config', help='TOML file with a [database] section')
+    parser.add_argument('--rebuild-counters', action='store_true',
+                        help='Recount the statistics counters from the tables')
+    parser.add_argument('--prune-history', action='store_true',
+                        help='Delete superseded classifications (see --keep-versions, --max-age-days)')
+    parser.add_argument('--keep-versions', type=int, default=1,
+                        help='With --prune-history: classifications kept per domain, '
+                             'current included (default: 1)')
+    parser.add_argument('--max-age-days', type=float,
+                        help='With --prune-history: also delete superseded classifications '
+                             'older than this')
+    parser.add_argument('--shards', type=int, metavar='N',
+                        help='With --init: split domains over N shard files (new databases only)')
     
     args = parser.parse_args()
     
+    if args.config:
+        configure_database(args.db, DatabaseConfig.from_toml(args.config))
+    
+    if args.shards and not args.init:
+        parser.error("--shards needs --init")
+    
     if args.init:
+        if args.shards and args.shards > 1:
+            try:
+                paths = create_shards(args.db, args.shards)
+            except ValueError as e:
+                parser.error(str(e))
+            print(f"✓ {len(paths)} shards: {', '.join(paths)}")
+        else:
+            init_database(args.db)
+    elif os.path.exists(args.db):
+        # Bring older files up to the current schema before using them
         init_database(args.db)
     
+    if args.rebuild_counters:
+        fan_out(args.db, rebuild_counters)
+        print("✓ Counters rebuilt")
+    
+    if args.prune_history:
+        deleted = sum(fan_out(args.db, prune_classification_history,
+                              args.keep_versions, args.max_age_days))
+        print(f"✓ Pruned {deleted:,} superseded classifications")
+    
     if args.stats:
-        with get_connection(args.db) as conn:
-            stats = get_statistics(conn)
-            print("\n=== DATABASE STATISTICS ===")
-            print(f"Total domains:        {stats['total_domains']}")
-            print(f"Classified:           {stats['classified']}")
-            print(f"Unclassified:         {stats['unclassified']}")
-            print(f"Failed fetches:       {stats['failed_fetches']}")
-            print(f"\nTotal classifications: {stats['total_classifications']}")
-            print(f"IAB enriched:         {stats['iab_enriched']}")
-            print(f"\nBy method:")
-            for method, count in stats['by_method'].items():
-                print(f"  {method:15} {count}")
+        stats = get_total_statistics(args.db)
+        shards = len(shard_paths(args.db))
+        print("\n=== DATABASE STATISTICS ===")
+        if shards > 1:
+            print(f"Shards:               {shards}")
+        print(f"Total domains:        {stats['total_domains']}")
+        print(f"Classified:           {stats['classified']}")
+        print(f"Unclassified:         {stats['unclassified']} ({stats['pending']} awaiting classification)")
+        print(f"Failed fetches:       {stats['failed_fetches']}")
+        print(f"\nTotal classifications: {stats['total_classifications']}")
+        print(f"IAB enriched:         {stats['iab_enriched']}")
+        print(f"\nBy method:")
+        for method, count in stats['by_method'].items():
+            print(f"  {method:15} {count}")
     
     if args.export:
-        with get_connection(args.db) as conn:
-            export_to_csv(conn, args.export)
+        try:
+            with shard_connections(args.db) as conns:
+                rows = export_classifications(conns, args.export, args.format, args.batch_size,
+                                              args.sort, args.incremental)
+        except (RuntimeError, ValueError) as e:
+            parser.error(str(e))
+        print(f"✓ Exported {rows:,} classifications to {args.export}"
+              + (f" (incremental: {args.incremental})" if args.incremental else ""))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+"""
+wxawebcat_fetch_bench.py - Offline fetcher benchmark
+
+Runs the real fetcher (main_async) against a local aiohttp server farm and
+a stub resolver, so throughput changes can be measured and compared without
+touching the internet or a DNS server.
+
+Every synthetic host is named after its behaviour:
+  ok-000001.bench.test        HTML page after --latency-ms
+  slow-...                    20x the latency
+  big-...                     20x the body size
+  redirect-...                chain of --redirects 302s, then a page
+  timeout-...                 never answers (exercises timeouts / slow lane)
+  blocked-...                 403 Cloudflare challenge page
+  latin1-...                  ISO-8859-1 encoded page
+  nxdomain-...                does not resolve
+
+Example:
+  python3 wxawebcat_fetch_bench.py --domains 5000 --save-baseline bench.json
+  python3 wxawebcat_fetch_bench.py --domains 5000 --baseline bench.json
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import resource
+import socket
+import sys
+import tempfile
+import time
+import zlib
+from pathlib import Path
+from typing import Dict, List
+
+from aiohttp import web
+from aiohttp.abc import AbstractResolver
+
+import wxawebcat_web_fetcher_db as fetcher
+
+
+DEFAULT_MIX = "ok=80,slow=5,big=3,redirect=4,timeout=1,blocked=3,latin1=2,nxdomain=2"
+HOST_SUFFIX = ".bench.test"
+
+# Metrics compared against a baseline: name -> True if higher is better
+BASELINE_METRICS = {
+    "domains_per_s": True,
+    "p50_ms": False,
+    "p99_ms": False,
+    "cpu_ms_per_domain": False,
+    "peak_rss_mb": False,
+}
+
+WORDS = ("news sports weather travel finance health recipes music video games "
+         "shopping cars homes jobs education science technology movies books "
+         "fashion beauty fitness pets garden family business market local world").split()
+
+
+def parse_mix(mix: str) -> Dict[str, int]:
+    weights = {}
+    for part in mix.split(','):
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in FarmHandler.KINDS:
+            raise ValueError(f"Unknown host kind: {kind}")
+        weights[kind] = int(weight or 1)
+    return weights
+
+
+def generate_domains(count: int, mix: Dict[str, int], seed: int) -> List[str]:
+    rng = random.Random(seed)
+    kinds = list(mix)
+    weights = [mix[k] for k in kinds]
+    return [f"{rng.choices(kinds, weights)[0]}-{i:06d}{HOST_SUFFIX}" for i in range(count)]
+
+
+class FarmHandler:
+    """Request handler of one farm process; behaviour is keyed off the host name"""
+
+    KINDS = ("ok", "slow", "big", "redirect", "timeout", "blocked", "latin1", "nxdomain")
+
+    def __init__(self, latency_ms: float, body_kb: int, redirects: int, seed: int):
+        self.latency = latency_ms / 1000.0
+        self.redirects = redirects
+        self.rng = random.Random(seed)
+        words = random.Random(seed)
+        filler = ' '.join(words.choice(WORDS) for _ in range(body_kb * 160))
+        self.body = filler[:body_kb * 1024]
+        self.big_body = ' '.join([self.body] * 20)
+
+    def page(self, host: str, body: str, title_extra: str = "") -> str:
+        topic = WORDS[zlib.crc32(host.encode()) % len(WORDS)]
+        return (f"<html><head><title>{host} - {topic}{title_extra}</title>"
+                f'<meta name="description" content="All about {topic} on {host}">'
+                f"</head><body><h1>{topic}</h1><p>{body}</p></body></html>")
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        host = request.host.split(':')[0]
+        kind = host.split('-', 1)[0]
+
+        # +/-50% jitter around the configured latency
+        delay = self.latency * (0.5 + self.rng.random())
+        if kind == "slow":
+            delay *= 20
+        elif kind == "timeout":
+            delay = 3600
+        await asyncio.sleep(delay)
+
+        if kind == "redirect":
+            hop = int(request.query.get("hop", 0))
+            if hop < self.redirects:
+                raise web.HTTPFound(f"/?hop={hop + 1}")
+        if kind == "blocked":
+            return web.Response(
+                status=403, content_type="text/html",
+                text="<html><title>Attention Required! | Cloudflare</title>"
+                     "<body>Please complete the captcha to continue</body></html>")
+        if kind == "latin1":
+            html = self.page(host, self.body, " - caf\xe9 cr\xe8me br\xfbl\xe9e")
+            return web.Response(body=html.encode("latin-1"),
+                                headers={"Content-Type": "text/html; charset=iso-8859-1"})
+        body = self.big_body if kind == "big" else self.body
+        return web.Response(text=self.page(host, body), content_type="text/html")
+
+
+def _farm_process(index: int, latency_ms: float, body_kb: int, redirects: int,
+                  seed: int, ports, ready):
+    """Entry point of one farm process: serve on an ephemeral port forever"""
+    async def serve():
+        handler = FarmHandler(latency_ms, body_kb, redirects, seed + index)
+        app = web.Application()
+        app.router.add_route('*', '/{path:.*}', handler.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("127.0.0.1", 0))
+        site = web.SockSite(runner, sock, backlog=1024)
+        await site.start()
+
+        ports[index] = sock.getsockname()[1]
+        ready.release()
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+class ServerFarm:
+    """N aiohttp server processes on ephemeral localhost ports"""
+
+    def __init__(self, procs: int, latency_ms: float, body_kb: int, redirects: int, seed: int):
+        self.ctx = multiprocessing.get_context("spawn")
+        self.ports = self.ctx.Array('i', procs)
+        self.ready = self.ctx.Semaphore(0)
+        self.procs = [
+            self.ctx.Process(target=_farm_process, daemon=True,
+                             args=(i, latency_ms, body_kb, redirects, seed, self.ports, self.ready))
+            for i in range(procs)
+        ]
+
+    def start(self) -> List[int]:
+        for proc in self.procs:
+            proc.start()
+        for _ in self.procs:
+            if not self.ready.acquire(timeout=30):
+                self.stop()
+                raise RuntimeError("Server farm failed to start")
+        return list(self.ports)
+
+    def stop(self):
+        for proc in self.procs:
+            if proc.is_alive():
+                proc.terminate()
+        for proc in self.procs:
+            proc.join(5)
+
+
+def closed_port() -> int:
+    """A localhost port nothing listens on (HTTPS attempts fail fast there)"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class BenchResolver(AbstractResolver):
+    """Resolve every bench host to a farm port; nxdomain-* hosts fail"""
+
+    def __init__(self, farm_ports: List[int], https_port: int):
+        self.farm_ports = farm_ports
+        self.https_port = https_port
+
+    async def resolve(self, host: str, port: int = 0, family: int = socket.AF_INET):
+        if host.startswith("nxdomain-"):
+            raise OSError(socket.EAI_NONAME, "Name or service not known")
+        if port == 80:
+            port = self.farm_ports[zlib.crc32(host.encode()) % len(self.farm_ports)]
+        else:
+            port = self.https_port
+        return [{"hostname": host, "host": "127.0.0.1", "port": port,
+                 "family": socket.AF_INET, "proto": 0, "flags": 0}]
+
+    async def close(self):
+        pass
+
+
+def run_bench(args) -> Dict:
+    mix = parse_mix(args.mix)
+    domains = generate_domains(args.domains, mix, args.seed)
+
+    farm = ServerFarm(args.server_procs, args.latency_ms, args.body_kb, args.redirects, args.seed)
+    ports = farm.start()
+    try:
+        with tempfile.TemporaryDirectory(prefix="wxawebcat-bench-") as tmp:
+            csv_path = Path(tmp) / "domains.csv"
+            csv_path.write_text("rank,domain\n" + ''.join(
+                f"{i},{d}\n" for i, d in enumerate(domains, 1)))
+
+            fetch_args = fetcher.build_arg_parser().parse_args([
+                "--input", str(csv_path),
+                "--db", str(Path(tmp) / "bench.db"),
+                "--workers", str(args.workers),
+                "--rate", str(args.rate),
+                "--timeout", str(args.timeout),
+            ] + (["--uvloop"] if args.uvloop else []))
+
+            resolver = BenchResolver(ports, closed_port())
+            before = resource.getrusage(resource.RUSAGE_SELF)
+            started = time.monotonic()
+            stats = asyncio.run(fetcher.main_async(fetch_args, resolver=resolver))
+            wall = time.monotonic() - started
+            after = resource.getrusage(resource.RUSAGE_SELF)
+    finally:
+        farm.stop()
+
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    latency = stats.latency.summary()
+    return {
+        "params": {k: getattr(args, k) for k in (
+            "domains", "mix", "latency_ms", "body_kb", "redirects", "seed",
+            "server_procs", "workers", "rate", "timeout", "uvloop")},
+        "domains_per_s": round(stats.completed / wall, 2),
+        "p50_ms": latency["p50"],
+        "p99_ms": latency["p99"],
+        "cpu_ms_per_domain": round(cpu * 1000 / max(stats.completed, 1), 3),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": round(after.ru_maxrss / 1024, 1),
+        "wall_s": round(wall, 2),
+        "success": stats.success,
+        "failed": stats.failed,
+        "blocked": stats.blocked,
+    }
+
+
+def compare_to_baseline(result: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Print a comparison table and return the names of regressed metrics"""
+    if baseline.get("params") != result["params"]:
+        print("Warning: baseline was recorded with different parameters")
+
+    regressions = []
+    print(f"\n{'Metric':<20} {'Baseline':>12} {'Current':>12} {'Change':>9}")
+    for name, higher_is_better in BASELINE_METRICS.items():
+        old, new = baseline.get(name), result[name]
+        if not old:
+            continue
+        change = (new - old) / old
+        worse = -change if higher_is_better else change
+        flag = ""
+        if worse > tolerance:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:<20} {old:>12,.2f} {new:>12,.2f} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def print_result(result: Dict):
+    print(f"\n{'='*70}")
+    print(f"BENCHMARK")
+    print(f"{'='*70}")
+    print(f"Throughput:   {result['domains_per_s']:,.1f} domains/s ({result['wall_s']:.1f}s wall)")
+    print(f"Latency:      p50 {result['p50_ms']:.0f}ms | p99 {result['p99_ms']:.0f}ms")
+    print(f"CPU:          {result['cpu_ms_per_domain']:.2f} ms/domain")
+    print(f"Peak RSS:     {result['peak_rss_mb']:.1f} MB")
+    print(f"Outcomes:     {result['success']:,} ok | {result['failed']:,} failed | "
+          f"{result['blocked']:,} blocked")
+    print(f"{'='*70}")
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Benchmark the fetcher against a local server farm")
+    p.add_argument("--domains", "-n", type=int, default=2000,
+                   help="Synthetic domains to fetch (default: 2000)")
+    p.add_argument("--mix", default=DEFAULT_MIX,
+                   help=f"Host kind weights (default: {DEFAULT_MIX})")
+    p.add_argument("--latency-ms", type=float, default=50.0,
+                   help="Mean server response latency (default: 50)")
+    p.add_argument("--body-kb", type=int, default=20,
+                   help="Page body size (default: 20)")
+    p.add_argument("--redirects", type=int, default=2,
+                   help="Redirect chain length for redirect-* hosts (default: 2)")
+    p.add_argument("--seed", type=int, default=1,
+                   help="Seed for the domain mix and server jitter (default: 1)")
+    p.add_argument("--server-procs", type=int, default=2,
+                   help="Server farm processes (default: 2)")
+    p.add_argument("--workers", "-w", type=int, default=50)
+    p.add_argument("--rate", "-r", type=float, default=1000.0,
+                   help="Fetcher rate limit (default: 1000, effectively unlimited)")
+    p.add_argument("--timeout", "-t", type=float, default=5.0)
+    p.add_argument("--uvloop", action="store_true")
+    p.add_argument("--save-baseline", metavar="FILE",
+                   help="Write the results to FILE as the new baseline")
+    p.add_argument("--baseline", metavar="FILE",
+                   help="Compare against a saved baseline; exit 1 on regression")
+    p.add_argument("--tolerance", type=float, default=0.10,
+                   help="Allowed relative regression per metric (default: 0.10)")
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.uvloop and not fetcher.install_uvloop():
+        print("uvloop not installed - using the default event loop")
+        args.uvloop = False
+
+    result = run_bench(args)
+    print_result(result)
+
+    if args.save_baseline:
+        Path(args.save_baseline).write_text(json.dumps(result, indent=2) + "\n")
+        print(f"Baseline saved to {args.save_baseline}")
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        regressions = compare_to_baseline(result, baseline, args.tolerance)
+        if regressions:
+            print(f"\nRegressed beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+        print("\nNo regressions")
+
+
+if __name__ == "__main__":
+    main()
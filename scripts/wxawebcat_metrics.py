@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+wxawebcat_metrics.py - Latency histograms shared by the wxawebcat tools
+
+Log-bucketed histograms with ~5% resolution: constant memory, cheap to
+record into, mergeable across processes and cheap to ship as a snapshot.
+"""
+
+import math
+from typing import Dict, List, Optional
+
+
+class LatencyHistogram:
+    """Histogram of durations in seconds with log-spaced buckets"""
+
+    MIN_VALUE = 1e-5        # 10 µs; anything faster lands in bucket 0
+    GROWTH = 1.05           # Bucket width ratio (~5% relative error)
+
+    __slots__ = ("buckets", "count", "total", "max")
+
+    def __init__(self):
+        self.buckets: Dict[int, int] = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    @classmethod
+    def _index(cls, value: float) -> int:
+        if value <= cls.MIN_VALUE:
+            return 0
+        return int(math.log(value / cls.MIN_VALUE) / math.log(cls.GROWTH)) + 1
+
+    @classmethod
+    def _upper_bound(cls, index: int) -> float:
+        return cls.MIN_VALUE * cls.GROWTH ** index
+
+    def record(self, value: float):
+        idx = self._index(value)
+        self.buckets[idx] = self.buckets.get(idx, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: "LatencyHistogram"):
+        for idx, n in other.buckets.items():
+            self.buckets[idx] = self.buckets.get(idx, 0) + n
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile (0 if empty)"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for idx in sorted(self.buckets):
+            seen += self.buckets[idx]
+            if seen >= rank:
+                return min(self._upper_bound(idx), self.max)
+        return self.max
+
+    def percentiles(self, qs: List[float]) -> List[float]:
+        return [self.percentile(q) for q in qs]
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def summary(self, unit: float = 1000.0) -> Dict[str, float]:
+        """Compact dict (milliseconds by default) for reports and metrics files"""
+        p50, p90, p99 = self.percentiles([0.50, 0.90, 0.99])
+        return {
+            "count": self.count,
+            "mean": round(self.mean * unit, 3),
+            "p50": round(p50 * unit, 3),
+            "p90": round(p90 * unit, 3),
+            "p99": round(p99 * unit, 3),
+            "max": round(self.max * unit, 3),
+        }
+
+    def to_dict(self) -> Dict:
+        return {"buckets": dict(self.buckets), "count": self.count,
+                "total": self.total, "max": self.max}
+
+    @classmethod
+    def from_dict(cls, data: Optional[Dict]) -> "LatencyHistogram":
+        hist = cls()
+        if data:
+            hist.buckets = {int(k): v for k, v in data["buckets"].items()}
+            hist.count = data["count"]
+            hist.total = data["total"]
+            hist.max = data["max"]
+        return hist
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self.buckets = state["buckets"]
+        self.count = state["count"]
+        self.total = state["total"]
+        self.max = state["max"]
+
+    def __deepcopy__(self, memo):
+        return LatencyHistogram.from_dict(self.to_dict())
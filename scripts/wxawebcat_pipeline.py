@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+wxawebcat_pipeline.py - Fused fetch-and-classify streaming mode
+
+Fetch results flow through an in-process queue straight into the rule
+stage and the content hash cache; only domains that still need the LLM go
+to a bounded LLM stage. The fetch result and its classification are
+committed together in one write, so there is no DB round trip and no
+watch-mode polling delay between the two stages.
+"""
+
+import asyncio
+import threading
+import time
+from collections import deque
+from functools import partial
+from typing import List
+
+import httpx
+
+import wxawebcat_classifier_db as classifier
+import wxawebcat_web_fetcher_db as fetcher
+from wxawebcat_archive import PageArchive
+from wxawebcat_classifier_db import ClassifierConfig, Metrics
+from wxawebcat_db import (
+    DatabaseConfig,
+    FetchRecord,
+    configure_database,
+    finish_fetch_run,
+    get_connection,
+    init_database,
+)
+
+
+class LatencyWindow:
+    """Recent end-to-end latencies (fetch start -> commit), thread-safe"""
+
+    def __init__(self, maxlen: int = 50000):
+        self.samples: deque = deque(maxlen=maxlen)
+        self.lock = threading.Lock()
+
+    def add_many(self, values: List[float]):
+        with self.lock:
+            self.samples.extend(values)
+
+    def percentiles(self, *qs: float) -> List[float]:
+        with self.lock:
+            ordered = sorted(self.samples)
+        if not ordered:
+            return [0.0 for _ in qs]
+        return [ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in qs]
+
+
+def write_batch(conn, results: List[FetchRecord], inline_iab: bool = False):
+    """Write fetch results and their classifications in one transaction"""
+    ids = fetcher.batch_insert(conn, results)
+
+    rows = []
+    for r in results:
+        row = r.classification
+        if row:
+            row.domain_id = ids[r.fqdn]
+            rows.append(row)
+    classifier.batch_insert(conn, rows, inline_iab)
+
+
+async def main_async(args):
+    fcfg = fetcher.config_from_args(args)
+    if fcfg.processes > 1:
+        print("Pipeline mode classifies in-process - ignoring --processes")
+        fcfg.processes = 1
+
+    if args.config:
+        ccfg = ClassifierConfig.from_toml(args.config, db_path=args.db)
+        configure_database(fcfg.db_path, DatabaseConfig.from_toml(args.config))
+    else:
+        ccfg = ClassifierConfig(db_path=args.db)
+    if args.inline_iab:
+        ccfg.inline_iab = True
+
+    init_database(fcfg.db_path)
+
+    work_items, run_id, input_exhausted = fetcher.load_work_items(args, fcfg)
+    if work_items is None:
+        return
+
+    total = len(work_items)
+    if total == 0:
+        if input_exhausted:
+            with get_connection(fcfg.db_path) as conn:
+                finish_fetch_run(conn, run_id)
+        print("Nothing to fetch!")
+        return
+
+    # Refreshed pages whose fingerprint matches the stored, classified one
+    # keep their classification (the upsert leaves classified alone)
+    classified_hashes = {item[0]: item[3]["content_hash"] for item in work_items
+                         if item[3] and item[3].get("content_hash")}
+    content_hash_cache = classifier.load_content_hash_cache(ccfg.db_path)
+    redirect_cache = classifier.load_redirect_cache(ccfg) if ccfg.enable_redirect_cache else None
+    llm_queue_size = args.llm_queue or ccfg.llm_concurrency * 4
+
+    print(f"\n{'='*70}")
+    print(f"FETCH + CLASSIFY PIPELINE")
+    print(f"{'='*70}")
+    print(f"To fetch:         {total:,}")
+    print(f"Workers:          {fcfg.workers}")
+    print(f"Rate limit:       {fcfg.rate_limit}/s")
+    print(f"LLM endpoint:     {ccfg.vllm_base_url}")
+    print(f"LLM concurrency:  {ccfg.llm_concurrency} (queue {llm_queue_size})")
+    print(f"Content hashes:   {len(content_hash_cache):,} cached")
+    if redirect_cache is not None:
+        print(f"Redirect hosts:   {len(redirect_cache):,} cached")
+    print(f"{'='*70}\n")
+
+    stats = fetcher.Stats(total=total)
+    metrics = Metrics()
+    latencies = LatencyWindow()
+
+    def on_commit(results: List[FetchRecord]):
+        now = time.monotonic()
+        latencies.add_many([now - r.started for r in results if r.started is not None])
+
+    archive = PageArchive(fcfg.archive_dir) if fcfg.archive_dir else None
+    writer = fetcher.DBWriter(fcfg.db_path, fcfg.writer_batch_size,
+                              fcfg.writer_flush_interval, fcfg.writer_queue_size,
+                              run_id, write_batch=partial(write_batch, inline_iab=ccfg.inline_iab),
+                              on_commit=on_commit,
+                              archive=archive)
+
+    # Bounded: when the LLM falls behind, fetch workers wait here
+    llm_queue: asyncio.Queue = asyncio.Queue(maxsize=llm_queue_size)
+
+    async def emit(result: FetchRecord):
+        """Classify what rules and the redirect / hash caches can decide, inline"""
+        if (result.status == "success"
+                and classified_hashes.get(result.fqdn) != result.content_hash):
+            doc = {
+                'domain_id': None,
+                'fqdn': result.fqdn,
+                'dns': result.dns,
+                'http': result.http,
+            }
+            metrics.total += 1
+            decision = classifier.preclassify(doc, ccfg, content_hash_cache, metrics,
+                                              redirect_cache)
+            if decision is None:
+                await llm_queue.put((result, doc))
+                return
+            result.classification = decision
+        await writer.put(result)
+
+    async def llm_worker(client: httpx.AsyncClient, llm_sem: asyncio.Semaphore):
+        while True:
+            item = await llm_queue.get()
+            if item is None:
+                return
+            result, doc = item
+            try:
+                decision = await classifier.classify_with_llm(
+                    doc, ccfg, llm_sem, client, content_hash_cache, metrics, redirect_cache)
+            except Exception as e:
+                metrics.errors += 1
+                print(f"Error processing {doc['fqdn']}: {e}")
+                decision = None
+            # Without a decision the domain stays unclassified for the
+            # standalone classifier to pick up later
+            if decision:
+                result.classification = decision
+            await writer.put(result)
+
+    async def reporter():
+        while True:
+            await asyncio.sleep(2.0)
+            p50, p99 = latencies.percentiles(0.50, 0.99)
+            print(f"[{stats.completed:,}/{stats.total:,}] fetched | "
+                  f"rules {metrics.rule} | redirect {metrics.redirect_cache_hits} | "
+                  f"hash {metrics.hash_cache_hits} | "
+                  f"llm {metrics.llm} (queue {llm_queue.qsize()}) | errors {metrics.errors} | "
+                  f"e2e p50 {p50:.2f}s p99 {p99:.2f}s")
+            print(f"  └─ Phases p50/p99 ms: {stats.phase_summary()}")
+            fetcher.write_metrics(args.metrics_file, stats)
+
+    writer.start()
+    reporter_task = asyncio.create_task(reporter())
+
+    timeout = httpx.Timeout(ccfg.request_timeout_s)
+    async with httpx.AsyncClient(timeout=timeout) as client:
+        llm_sem = asyncio.Semaphore(ccfg.llm_concurrency)
+        llm_tasks = [asyncio.create_task(llm_worker(client, llm_sem))
+                     for _ in range(ccfg.llm_concurrency)]
+
+        await fetcher.fetch_all(fcfg, work_items, stats,
+                                fetcher.RateLimiter(fcfg.rate_limit), emit)
+
+        for _ in llm_tasks:
+            await llm_queue.put(None)
+        await asyncio.gather(*llm_tasks)
+
+    await asyncio.get_running_loop().run_in_executor(None, writer.close)
+
+    if input_exhausted:
+        with get_connection(fcfg.db_path) as conn:
+            finish_fetch_run(conn, run_id)
+
+    reporter_task.cancel()
+
+    fetcher.print_summary(stats)
+    if archive is not None:
+        print(f"Page archive: {archive.summary()}")
+    fetcher.write_metrics(args.metrics_file, stats, final=True)
+    p50, p90, p99 = latencies.percentiles(0.50, 0.90, 0.99)
+    print(f"CLASSIFICATION")
+    print(f"{'='*70}")
+    classified = (metrics.rule + metrics.redirect_cache_hits + metrics.hash_cache_hits
+                  + metrics.llm)
+    print(f"Classified:   {classified:,} "
+          f"of {metrics.total:,} successful fetches")
+    print(f"Rule-based:   {metrics.rule:,} (TLD {metrics.tld_classified:,})")
+    print(f"Redirects:    {metrics.redirect_cache_hits:,}")
+    print(f"Hash cache:   {metrics.hash_cache_hits:,}")
+    print(f"LLM:          {metrics.llm:,}")
+    print(f"Errors:       {metrics.errors:,}")
+    print(f"End-to-end:   p50 {p50:.2f}s | p90 {p90:.2f}s | p99 {p99:.2f}s")
+    print(f"{'='*70}")
+
+
+def parse_args():
+    # --config (shared with the fetcher) also carries the classifier settings
+    p = fetcher.build_arg_parser("Fetch and classify domains in one streaming pass")
+    p.add_argument("--llm-queue", type=int,
+                   help="Max domains waiting for the LLM (default: 4 x llm_concurrency)")
+    p.add_argument("--inline-iab", action="store_true",
+                   help="Write the IAB taxonomy with each classification")
+    return fetcher.check_args(p, p.parse_args())
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.uvloop and not fetcher.install_uvloop():
+        print("uvloop not installed - using the default event loop")
+    asyncio.run(main_async(args))
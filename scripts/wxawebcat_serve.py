@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+"""
+wxawebcat_serve.py - Domain category lookup service
+
+Loads the current classification of every domain into an in-memory index
+and answers lookups over HTTP. A host that was not classified itself falls
+back to its parent domains (a.b.example.com -> b.example.com ->
+example.com). New classifications and IAB updates are picked up by
+polling the database for higher current_classification versions; domains
+deleted from it stay served until the next restart.
+
+  python3 wxawebcat_serve.py --db wxawebcat.db --port 8080
+
+  GET  /lookup?host=www.example.com
+  POST /lookup   {"hosts": ["a.example.com", "b.example.org"]}
+  GET  /stats    index size, hit rates, latency percentiles
+
+Batch lookups amortise the HTTP overhead; --bench-lookups N measures the
+index itself without the network.
+
+With --snapshot FILE the service maps a compiled snapshot (see
+wxawebcat_snapshot.py) instead of loading the database, and reopens it
+whenever a new snapshot is moved over the file.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import Dict, List, Optional, Tuple, Union
+
+from aiohttp import web
+
+from wxawebcat_db import (
+    DatabaseConfig,
+    configure_database,
+    get_connection,
+    init_database,
+    iter_current_classifications,
+    read_current_classifications,
+    shard_paths,
+)
+from wxawebcat_metrics import LatencyHistogram
+from wxawebcat_snapshot import SnapshotIndex, normalize_host, parent_domains
+
+
+# Confidence is packed into the entry with 1/1000 resolution
+CONFIDENCE_SCALE = 1001
+
+
+class LookupLatency(LatencyHistogram):
+    """LatencyHistogram resolving down to 0.1 µs (lookups are far below 10 µs)"""
+    MIN_VALUE = 1e-7
+    __slots__ = ()
+
+
+class LookupIndex:
+    """
+    fqdn -> category index.
+
+    Each entry is one int packing an interned label (category, IAB tier 1
+    and tier 2 ids and names, sensitive) with the confidence, so millions of domains cost
+    little more than the dict and its keys.
+    """
+
+    def __init__(self):
+        self.entries: Dict[str, int] = {}
+        self.labels: List[Tuple] = []
+        self._label_ids: Dict[Tuple, int] = {}
+        # Shard path -> highest current_classification version loaded from it
+        self.watermarks: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def add(self, fqdn: str, category: str, confidence: float, tier1_id: Optional[str],
+            tier1: Optional[str], tier2_id: Optional[str], tier2: Optional[str],
+            sensitive: bool):
+        label = (category, tier1_id, tier1, tier2_id, tier2, bool(sensitive))
+        label_id = self._label_ids.get(label)
+        if label_id is None:
+            label_id = self._label_ids[label] = len(self.labels)
+            self.labels.append(label)
+        confidence = min(max(confidence or 0.0, 0.0), 1.0)
+        self.entries[fqdn] = label_id * CONFIDENCE_SCALE + round(confidence * (CONFIDENCE_SCALE - 1))
+
+    def find(self, host: str) -> Tuple[Optional[str], int]:
+        """(matched name, packed entry) for host or its nearest classified parent"""
+        entries = self.entries
+        for name in parent_domains(normalize_host(host)):
+            packed = entries.get(name)
+            if packed is not None:
+                return name, packed
+        return None, -1
+
+    def describe(self, host: str, matched: Optional[str], packed: int) -> Dict:
+        if matched is None:
+            return {"host": host, "found": False}
+        category, tier1_id, tier1, tier2_id, tier2, sensitive = \
+            self.labels[packed // CONFIDENCE_SCALE]
+        return {
+            "host": host,
+            "found": True,
+            "matched": matched,
+            "category": category,
+            "confidence": (packed % CONFIDENCE_SCALE) / (CONFIDENCE_SCALE - 1),
+            "iab_tier1_id": tier1_id,
+            "iab_tier1": tier1,
+            "iab_tier2_id": tier2_id,
+            "iab_tier2": tier2,
+            "sensitive": sensitive,
+        }
+
+    def lookup(self, host: str) -> Dict:
+        matched, packed = self.find(host)
+        return self.describe(host, matched, packed)
+
+
+def apply_rows(index: LookupIndex, path: str, rows: List[Tuple]) -> int:
+    add = index.add
+    for _, fqdn, category, confidence, tier1_id, tier1, tier2_id, tier2, sensitive in rows:
+        add(fqdn, category, confidence, tier1_id, tier1, tier2_id, tier2, sensitive)
+    index.watermarks[path] = rows[-1][0]
+    return len(rows)
+
+
+def load_index(db_path: str) -> LookupIndex:
+    """Full load of every shard's current classifications"""
+    index = LookupIndex()
+    for path in shard_paths(db_path):
+        index.watermarks[path] = 0
+        for rows in iter_current_classifications(path, 0):
+            apply_rows(index, path, rows)
+    return index
+
+
+class LookupService:
+    """HTTP handlers plus the reload loop around one LookupIndex or SnapshotIndex"""
+
+    def __init__(self, db_path: str, index: Union[LookupIndex, SnapshotIndex],
+                 reload_interval: float,
+                 max_batch: int):
+        self.db_path = db_path
+        self.index = index
+        self.reload_interval = reload_interval
+        self.max_batch = max_batch
+        self.latency = LookupLatency()
+        self.requests = 0
+        self.lookups = 0
+        self.exact = 0
+        self.fallback = 0
+        self.misses = 0
+        self.started = time.time()
+        self.last_reload = time.time()
+        self.reloaded = 0
+        self._reloader: Optional[asyncio.Task] = None
+
+    def _lookup(self, host: str) -> Dict:
+        matched, packed = self.index.find(host)
+        if matched is None:
+            self.misses += 1
+        elif matched == normalize_host(host):
+            self.exact += 1
+        else:
+            self.fallback += 1
+        return self.index.describe(host, matched, packed)
+
+    async def handle_get(self, request: web.Request) -> web.Response:
+        started = time.perf_counter()
+        host = request.query.get("host")
+        if not host:
+            return web.json_response({"error": "missing ?host="}, status=400)
+        body = json.dumps(self._lookup(host))
+        self.requests += 1
+        self.lookups += 1
+        self.latency.record(time.perf_counter() - started)
+        return web.Response(text=body, content_type="application/json")
+
+    async def handle_post(self, request: web.Request) -> web.Response:
+        started = time.perf_counter()
+        try:
+            payload = await request.json()
+        except ValueError:
+            return web.json_response({"error": "body must be JSON"}, status=400)
+        hosts = payload.get("hosts") if isinstance(payload, dict) else payload
+        if not isinstance(hosts, list) or not all(isinstance(h, str) for h in hosts):
+            return web.json_response({"error": 'expected {"hosts": [...]}'}, status=400)
+        if len(hosts) > self.max_batch:
+            return web.json_response({"error": f"at most {self.max_batch} hosts per request"},
+                                     status=413)
+        body = json.dumps({"results": [self._lookup(h) for h in hosts]})
+        self.requests += 1
+        self.lookups += len(hosts)
+        self.latency.record(time.perf_counter() - started)
+        return web.Response(text=body, content_type="application/json")
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        uptime = time.time() - self.started
+        return web.json_response({
+            "domains": len(self.index),
+            "labels": len(self.index.labels),
+            "watermarks": self.index.watermarks,
+            "uptime_s": round(uptime, 1),
+            "last_reload_age_s": round(time.time() - self.last_reload, 1),
+            "reloaded": self.reloaded,
+            "requests": self.requests,
+            "lookups": self.lookups,
+            "lookups_per_s": round(self.lookups / uptime, 1) if uptime else 0,
+            "exact": self.exact,
+            "fallback": self.fallback,
+            "misses": self.misses,
+            # Per request, lookup and JSON encoding included
+            "latency_us": self.latency.summary(unit=1e6),
+        })
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        return web.Response(text="ok")
+
+    async def reload(self) -> int:
+        """Apply current rows changed since the last load; returns rows applied"""
+        if isinstance(self.index, SnapshotIndex):
+            return self.reopen_snapshot()
+        loop = asyncio.get_running_loop()
+        applied = 0
+        for path in shard_paths(self.db_path):
+            while True:
+                # Each batch is read off the loop in one executor call (the
+                # pooled connection belongs to that thread); applying it is short
+                rows = await loop.run_in_executor(
+                    None, read_current_classifications, path,
+                    self.index.watermarks.get(path, 0), 10000)
+                if not rows:
+                    break
+                applied += apply_rows(self.index, path, rows)
+                await asyncio.sleep(0)
+        self.last_reload = time.time()
+        self.reloaded += applied
+        return applied
+
+    def reopen_snapshot(self) -> int:
+        """Map the snapshot file again if a new one replaced it; returns its size"""
+        if not self.index.replaced():
+            return 0
+        # Requests already running keep the old mapping until they finish
+        self.index = SnapshotIndex(self.index.path)
+        self.last_reload = time.time()
+        self.reloaded += len(self.index)
+        return len(self.index)
+
+    async def _reload_loop(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                applied = await self.reload()
+            except Exception as e:
+                print(f"Reload failed: {e}")
+                continue
+            if applied:
+                print(f"Reloaded {applied:,} classifications ({len(self.index):,} domains)")
+
+    async def on_startup(self, app: web.Application):
+        if self.reload_interval > 0:
+            self._reloader = asyncio.create_task(self._reload_loop())
+
+    async def on_cleanup(self, app: web.Application):
+        if self._reloader is not None:
+            self._reloader.cancel()
+
+    def build_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_get("/lookup", self.handle_get)
+        app.router.add_post("/lookup", self.handle_post)
+        app.router.add_get("/stats", self.handle_stats)
+        app.router.add_get("/healthz", self.handle_health)
+        app.on_startup.append(self.on_startup)
+        app.on_cleanup.append(self.on_cleanup)
+        return app
+
+
+def sample_hosts(db_path: str, count: int) -> List[str]:
+    """Up to `count` random classified fqdns from each shard"""
+    hosts = []
+    for path in shard_paths(db_path):
+        with get_connection(path) as conn:
+            hosts.extend(r[0] for r in conn.execute(
+                "SELECT fqdn FROM current_classification ORDER BY random() LIMIT ?", (count,)))
+    return hosts
+
+
+def bench_lookups(index: Union[LookupIndex, SnapshotIndex], known: List[str], count: int,
+                  seed: int = 1):
+    """In-process lookups/s and latency over a mix of exact, subdomain and unknown hosts"""
+    if not known:
+        print("Index is empty - nothing to benchmark")
+        return
+    rng = random.Random(seed)
+    hosts = []
+    for i in range(min(count, 100000)):
+        kind = i % 4
+        if kind == 0:
+            hosts.append(f"unknown-{i}.example.invalid")
+        elif kind == 1:
+            hosts.append(f"www.cdn.{rng.choice(known)}")
+        else:
+            hosts.append(rng.choice(known))
+
+    lookup = index.lookup
+    started = time.perf_counter()
+    done = 0
+    while done < count:
+        for host in hosts[:count - done]:
+            lookup(host)
+        done += min(len(hosts), count - done)
+    elapsed = time.perf_counter() - started
+
+    # Separate timed pass: the timer costs about as much as a lookup
+    latency = LookupLatency()
+    clock = time.perf_counter
+    for host in hosts:
+        t = clock()
+        lookup(host)
+        latency.record(clock() - t)
+    lat = latency.summary(unit=1e6)
+    print(f"{done:,} lookups in {elapsed:.2f}s: {done / elapsed:,.0f}/s per core | "
+          f"p50 {lat['p50']:.2f}µs p99 {lat['p99']:.2f}µs")
+
+
+def main():
+    p = argparse.ArgumentParser(description="Serve domain category lookups over HTTP")
+    p.add_argument("--db", default="wxawebcat.db", help="Database path")
+    p.add_argument("--config", help="TOML file with a [database] section")
+    p.add_argument("--host", default="127.0.0.1", help="Listen address (default: 127.0.0.1)")
+    p.add_argument("--port", type=int, default=8080, help="Listen port (default: 8080)")
+    p.add_argument("--reload-interval", type=float, default=5.0,
+                   help="Seconds between checks for new classifications "
+                        "or a new --snapshot (0: never)")
+    p.add_argument("--max-batch", type=int, default=10000,
+                   help="Max hosts per POST /lookup (default: 10000)")
+    p.add_argument("--snapshot", metavar="FILE",
+                   help="Serve a compiled snapshot instead of loading the database")
+    p.add_argument("--uvloop", action="store_true", help="Use uvloop if installed")
+    p.add_argument("--bench-lookups", type=int, metavar="N",
+                   help="Time N in-process lookups against the loaded index and exit")
+    args = p.parse_args()
+
+    if args.config:
+        configure_database(args.db, DatabaseConfig.from_toml(args.config))
+
+    started = time.time()
+    if args.snapshot:
+        try:
+            index = SnapshotIndex(args.snapshot)
+        except (OSError, ValueError) as e:
+            p.error(str(e))
+        print(f"Mapped {len(index):,} domains ({len(index.labels)} distinct labels) "
+              f"from {args.snapshot} created {index.created}")
+    else:
+        init_database(args.db)
+        index = load_index(args.db)
+        print(f"Loaded {len(index):,} domains ({len(index.labels)} distinct labels) "
+              f"in {time.time() - started:.1f}s")
+
+    if args.bench_lookups:
+        if args.snapshot:
+            init_database(args.db)
+            known = sample_hosts(args.db, 10000)
+        else:
+            known = random.Random(1).sample(list(index.entries), min(len(index), 10000))
+        bench_lookups(index, known, args.bench_lookups)
+        return
+
+    if args.uvloop:
+        from wxawebcat_web_fetcher_db import install_uvloop
+        if not install_uvloop():
+            print("uvloop not installed - using the default event loop")
+
+    service = LookupService(args.db, index, args.reload_interval, args.max_batch)
+    web.run_app(service.build_app(), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
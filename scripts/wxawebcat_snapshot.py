@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+wxawebcat_snapshot.py - Memory-mappable snapshot of current classifications
+
+Compiles every shard's current classifications into one read-only file that
+readers mmap and binary-search in place: nothing is parsed per domain at
+load time, so a reader starts in milliseconds whatever the snapshot size,
+and any number of processes on a host share one copy in the page cache.
+
+Layout (little-endian; n domains):
+
+  header   64 bytes   magic, version, n, offset / length of the metadata
+  hashes   n x u64    blake2b-64 of each fqdn, sorted ascending
+  buckets  65537 x u32  position of the first hash with each top-16-bit
+                      prefix, narrowing the binary search to a few steps
+  labels   n x u16    index into the metadata's label table
+  scores   n x u16    confidence in 1/1000 steps
+  metadata JSON       label table (category + IAB ids / names + sensitive),
+                      creation time and the source watermarks
+
+Only hashes are stored, not names: a lookup for a host that was never
+classified can match with probability ~n / 2^64.
+
+A new snapshot is written next to the target and moved over it with
+os.replace, so readers see either the old file or the new one, never a
+partial write; an open reader keeps the file it mapped until it reopens.
+
+  python3 wxawebcat_snapshot.py --db wxawebcat.db --output wxawebcat.snap
+  python3 wxawebcat_snapshot.py --info wxawebcat.snap --lookup www.example.com
+"""
+
+import argparse
+import array
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+from bisect import bisect_left
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+MAGIC = b"WXSNAP\x00\x01"
+VERSION = 1
+# magic, version, domains, metadata offset, metadata length
+HEADER = struct.Struct("<8sIxxxxQQQ")
+HEADER_SIZE = 64
+CONFIDENCE_STEPS = 1000
+MAX_LABELS = 0xFFFF
+BUCKET_BITS = 16
+BUCKETS_SIZE = ((1 << BUCKET_BITS) + 1) * 4
+
+
+def normalize_host(host: str) -> str:
+    """Lower-case host without port, trailing dot or surrounding whitespace"""
+    host = host.strip().lower()
+    if host.startswith('['):
+        return host
+    return host.split(':', 1)[0].rstrip('.')
+
+
+def parent_domains(name: str) -> Iterator[str]:
+    """name, then each parent down to two labels: example.com, never com"""
+    while True:
+        yield name
+        dot = name.find('.')
+        if dot < 0 or name.find('.', dot + 1) < 0:
+            return
+        name = name[dot + 1:]
+
+
+def fqdn_hash(name: str) -> int:
+    return int.from_bytes(hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest(),
+                          'little')
+
+
+def compile_snapshot(db_path: str, output: str, batch_size: int = 50000) -> Dict:
+    """Write a snapshot of every shard's current classifications; returns its metadata"""
+    # Imported here: readers only need this module, not SQLite
+    from wxawebcat_db import iter_current_classifications, shard_paths
+
+    labels: List[Tuple] = []
+    label_ids: Dict[Tuple, int] = {}
+    # (hash << 32 | label << 16 | score): one int per domain sorts as a unit
+    packed: List[int] = []
+    watermarks: Dict[str, int] = {}
+    for path in shard_paths(db_path):
+        watermarks[path] = 0
+        for rows in iter_current_classifications(path, 0, batch_size):
+            for (_, fqdn, category, confidence, tier1_id, tier1, tier2_id, tier2,
+                 sensitive) in rows:
+                label = (category, tier1_id, tier1, tier2_id, tier2, bool(sensitive))
+                label_id = label_ids.get(label)
+                if label_id is None:
+                    if len(labels) == MAX_LABELS:
+                        raise ValueError(f"More than {MAX_LABELS} distinct labels")
+                    label_id = label_ids[label] = len(labels)
+                    labels.append(label)
+                score = round(min(max(confidence or 0.0, 0.0), 1.0) * CONFIDENCE_STEPS)
+                packed.append(fqdn_hash(fqdn) << 32 | label_id << 16 | score)
+            watermarks[path] = rows[-1][0]
+    packed.sort()
+
+    hashes = array.array('Q')
+    label_array = array.array('H')
+    scores = array.array('H')
+    collisions = 0
+    previous = None
+    for value in packed:
+        h = value >> 32
+        if h == previous:
+            collisions += 1
+            continue
+        previous = h
+        hashes.append(h)
+        label_array.append((value >> 16) & 0xFFFF)
+        scores.append(value & 0xFFFF)
+    del packed
+    if collisions:
+        print(f"Warning: {collisions} fqdn hash collision(s) - kept one domain of each")
+    counts = [0] * (1 << BUCKET_BITS)
+    shift = 64 - BUCKET_BITS
+    for h in hashes:
+        counts[h >> shift] += 1
+    buckets = array.array('I', [0])
+    for c in counts:
+        buckets.append(buckets[-1] + c)
+    if sys.byteorder != 'little':
+        for a in (hashes, buckets, label_array, scores):
+            a.byteswap()
+
+    meta = {
+        "labels": labels,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "source": os.path.abspath(db_path),
+        "watermarks": watermarks,
+    }
+    meta_bytes = json.dumps(meta).encode('utf-8')
+    meta_offset = HEADER_SIZE + BUCKETS_SIZE + len(hashes) * 12
+
+    directory = os.path.dirname(os.path.abspath(output))
+    fd, tmp_path = tempfile.mkstemp(prefix=".snapshot-", dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(hashes), meta_offset,
+                                len(meta_bytes)).ljust(HEADER_SIZE, b'\0'))
+            hashes.tofile(f)
+            buckets.tofile(f)
+            label_array.tofile(f)
+            scores.tofile(f)
+            f.write(meta_bytes)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, output)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    meta["domains"] = len(hashes)
+    return meta
+
+
+class SnapshotIndex:
+    """
+    Read-only lookups over a mapped snapshot.
+
+    Same find / describe / lookup interface as the serve module's
+    LookupIndex; the packed entry returned by find is the domain's position
+    in the arrays.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mmap) < HEADER_SIZE:
+            raise ValueError(f"{path}: not a classification snapshot")
+        magic, version, count, meta_offset, meta_length = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path}: not a version {VERSION} classification snapshot")
+        if sys.byteorder != 'little':
+            raise ValueError("Snapshots are little-endian; this host is not")
+        if meta_offset + meta_length > len(self._mmap):
+            raise ValueError(f"{path}: truncated snapshot")
+        view = memoryview(self._mmap)
+        self.count = count
+        offset = HEADER_SIZE + 8 * count
+        self.hashes = view[HEADER_SIZE:offset].cast('Q')
+        self.buckets = view[offset:offset + BUCKETS_SIZE].cast('I')
+        offset += BUCKETS_SIZE
+        self.label_ids = view[offset:offset + 2 * count].cast('H')
+        self.scores = view[offset + 2 * count:offset + 4 * count].cast('H')
+        meta = json.loads(bytes(view[meta_offset:meta_offset + meta_length]))
+        self.labels = [tuple(label) for label in meta["labels"]]
+        self.created = meta["created"]
+        self.source = meta.get("source")
+        self.watermarks = meta.get("watermarks", {})
+
+    def __len__(self) -> int:
+        return self.count
+
+    def position(self, name: str) -> int:
+        """Array position of an already-normalized name, or -1"""
+        h = fqdn_hash(name)
+        bucket = h >> (64 - BUCKET_BITS)
+        hashes = self.hashes
+        pos = bisect_left(hashes, h, self.buckets[bucket], self.buckets[bucket + 1])
+        if pos < self.count and hashes[pos] == h:
+            return pos
+        return -1
+
+    def find(self, host: str) -> Tuple[Optional[str], int]:
+        """(matched name, position) for host or its nearest classified parent"""
+        for name in parent_domains(normalize_host(host)):
+            pos = self.position(name)
+            if pos >= 0:
+                return name, pos
+        return None, -1
+
+    def describe(self, host: str, matched: Optional[str], pos: int) -> Dict:
+        if matched is None:
+            return {"host": host, "found": False}
+        category, tier1_id, tier1, tier2_id, tier2, sensitive = self.labels[self.label_ids[pos]]
+        return {
+            "host": host,
+            "found": True,
+            "matched": matched,
+            "category": category,
+            "confidence": self.scores[pos] / CONFIDENCE_STEPS,
+            "iab_tier1_id": tier1_id,
+            "iab_tier1": tier1,
+            "iab_tier2_id": tier2_id,
+            "iab_tier2": tier2,
+            "sensitive": sensitive,
+        }
+
+    def lookup(self, host: str) -> Dict:
+        matched, pos = self.find(host)
+        return self.describe(host, matched, pos)
+
+    def replaced(self) -> bool:
+        """True once a different file has been moved over self.path"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size) != self.identity
+
+
+def print_info(snapshot: SnapshotIndex):
+    size = os.path.getsize(snapshot.path)
+    print(f"\n{'='*70}")
+    print(f"SNAPSHOT {snapshot.path}")
+    print(f"{'='*70}")
+    print(f"Domains:      {len(snapshot):,}")
+    print(f"Labels:       {len(snapshot.labels):,}")
+    print(f"Size:         {size / 1e6:,.1f} MB")
+    print(f"Created:      {snapshot.created}")
+    print(f"Source:       {snapshot.source}")
+    for path, watermark in snapshot.watermarks.items():
+        print(f"  {path}: version <= {watermark:,}")
+    print(f"{'='*70}")
+
+
+def main():
+    p = argparse.ArgumentParser(description="Compile or inspect a classification snapshot")
+    p.add_argument("--db", default="wxawebcat.db", help="Database path")
+    p.add_argument("--config", help="TOML file with a [database] section")
+    p.add_argument("--output", help="Compile the database into this snapshot file")
+    p.add_argument("--info", metavar="SNAPSHOT", help="Show a snapshot's header")
+    p.add_argument("--lookup", nargs="+", metavar="HOST",
+                   help="Look hosts up in the snapshot (from --output or --info)")
+    args = p.parse_args()
+
+    if not args.output and not args.info:
+        p.error("need --output (compile) or --info SNAPSHOT")
+
+    if args.output:
+        from wxawebcat_db import DatabaseConfig, configure_database, init_database
+        if args.config:
+            configure_database(args.db, DatabaseConfig.from_toml(args.config))
+        init_database(args.db)
+        started = time.time()
+        meta = compile_snapshot(args.db, args.output)
+        print(f"✓ Wrote {meta['domains']:,} domains ({len(meta['labels'])} labels) "
+              f"to {args.output} in {time.time() - started:.1f}s")
+
+    path = args.info or args.output
+    if args.info or args.lookup:
+        started = time.perf_counter()
+        try:
+            snapshot = SnapshotIndex(path)
+        except (OSError, ValueError) as e:
+            p.error(str(e))
+        opened = time.perf_counter() - started
+        if args.info:
+            print_info(snapshot)
+            print(f"Opened in {opened * 1000:.2f} ms")
+        for host in args.lookup or []:
+            print(json.dumps(snapshot.lookup(host)))
+
+
+if __name__ == "__main__":
+    main()
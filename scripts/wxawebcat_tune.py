@@ -0,0 +1,529 @@
+#!/usr/bin/env python3
+"""
+wxawebcat_tune.py - Find concurrency / rate / batch settings for this machine
+
+Ramps one setting at a time against a workload and stops at the throughput
+knee: the last step that still gained --min-gain throughput without the
+error rate or p90 latency degrading. The knees are written out as a TOML
+profile (usable with --config by the fetcher, classifier and pipeline),
+with every measured step as a comment.
+
+  fetch   fetcher workers against the local server farm of
+          wxawebcat_fetch_bench.py, or a slice of a real input file per step
+          (--input); the rate limit is then set to the knee throughput plus
+          --rate-headroom and confirmed with one more run
+  llm     llm_concurrency against --llm-url, or a stub LLM that serves
+          --stub-slots requests at a time (queueing beyond that)
+  batch   classifier batch_size: classification writes per commit, on a
+          scratch database with the --config [database] tuning
+
+  python3 wxawebcat_tune.py --output configs/wxawebcat_tuned.toml
+  python3 wxawebcat_tune.py --stages llm --llm-url http://127.0.0.1:8000/v1 \\
+      --model Qwen/Qwen2.5-7B-Instruct --output tuned.toml
+  python3 wxawebcat_tune.py --stages fetch --input top1M.csv --sample 2000
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import httpx
+from aiohttp import web
+
+import wxawebcat_classifier_db as classifier
+import wxawebcat_fetch_bench as bench
+import wxawebcat_web_fetcher_db as fetcher
+from wxawebcat_classifier_db import ClassifierConfig
+from wxawebcat_cpu_bench import build_corpus
+from wxawebcat_db import (
+    ClassificationRecord,
+    DatabaseConfig,
+    configure_database,
+    get_connection,
+    get_manager,
+    init_database,
+    insert_domains_bulk,
+)
+from wxawebcat_metrics import LatencyHistogram
+
+
+STAGES = ("fetch", "llm", "batch")
+
+
+def parse_steps(text: str) -> List[int]:
+    steps = sorted({int(s) for s in text.split(',') if s.strip()})
+    if not steps or steps[0] < 1:
+        raise argparse.ArgumentTypeError(f"expected positive integers, got {text!r}")
+    return steps
+
+
+class Ramp:
+    """
+    Knee detection over steps of increasing value.
+
+    A step degrades when its error rate rises more than `max_error_rise`
+    above the first step's or its p90 exceeds `max_latency_factor` times
+    the first step's; the ramp ends there, or once `patience` + 1 steps in
+    a row gained less than `min_gain` throughput over the best so far.
+    """
+
+    def __init__(self, name: str, min_gain: float, max_error_rise: float,
+                 max_latency_factor: float, patience: int = 1):
+        self.name = name
+        self.min_gain = min_gain
+        self.max_error_rise = max_error_rise
+        self.max_latency_factor = max_latency_factor
+        self.patience = patience
+        self.steps: List[Dict] = []
+        self.best: Optional[Dict] = None
+        self.flat = 0
+        self.reason = "ramp exhausted"
+
+    def add(self, step: Dict) -> bool:
+        """Record a measured step; False once ramping further is pointless"""
+        self.steps.append(step)
+        first = self.steps[0]
+        if self.best is None:
+            self.best = step
+            return True
+        if step["error_rate"] > first["error_rate"] + self.max_error_rise:
+            self.reason = f"errors rose to {step['error_rate']:.1%} at {step['value']}"
+            return False
+        if (step.get("p90") and first.get("p90")
+                and step["p90"] > first["p90"] * self.max_latency_factor):
+            self.reason = f"p90 rose to {step['p90']:,.0f} ms at {step['value']}"
+            return False
+        gain = step["throughput"] / self.best["throughput"] - 1 if self.best["throughput"] else 1
+        if gain < self.min_gain:
+            self.flat += 1
+            self.reason = f"{step['value']} gained only {gain:+.1%} over {self.best['value']}"
+            return self.flat <= self.patience
+        self.best = step
+        self.flat = 0
+        self.reason = "ramp exhausted"
+        return True
+
+    def table(self, unit: str) -> List[str]:
+        width = max(10, len(self.name))
+        lines = [f"{self.name:>{width}} {unit:>14} {'p90 ms':>10} {'errors':>8}"]
+        for step in self.steps:
+            p90 = f"{step['p90']:,.0f}" if step.get("p90") is not None else "-"
+            mark = "  <- knee" if step is self.best else ""
+            lines.append(f"{step['value']:>{width}} {step['throughput']:>14,.1f} {p90:>10} "
+                         f"{step['error_rate']:>8.1%}{mark}")
+        return lines
+
+
+def print_step(ramp: Ramp, step: Dict, unit: str):
+    p90 = f"p90 {step['p90']:,.0f} ms | " if step.get("p90") is not None else ""
+    print(f"  {ramp.name} {step['value']:>6}: {step['throughput']:,.1f} {unit} | "
+          f"{p90}errors {step['error_rate']:.1%}")
+
+
+@contextlib.contextmanager
+def quiet(verbose: bool):
+    """Swallow the progress output of the tools being measured"""
+    if verbose:
+        yield
+        return
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+# Fetch stage
+
+def run_fetch_step(domains: List[str], workers: int, rate: float, args,
+                   resolver_factory: Callable) -> Dict:
+    """One fetcher run over `domains` into a scratch database"""
+    with tempfile.TemporaryDirectory(prefix="wxawebcat-tune-") as tmp:
+        csv_path = Path(tmp) / "domains.csv"
+        csv_path.write_text("rank,domain\n" + ''.join(
+            f"{i},{d}\n" for i, d in enumerate(domains, 1)))
+        db_path = str(Path(tmp) / "tune.db")
+        fetch_args = fetcher.build_arg_parser().parse_args([
+            "--input", str(csv_path),
+            "--db", db_path,
+            "--workers", str(workers),
+            "--rate", str(rate),
+            "--timeout", str(args.timeout),
+            # Retry backoff and the slow lane add a tail of idle waiting that
+            # says nothing about the worker count
+            "--retry-workers", "0",
+            "--slow-workers", "0",
+            "--fixed-timeout",
+        ] + (["--dns-server", args.dns_server] if args.dns_server else []))
+
+        started = time.monotonic()
+        with quiet(args.verbose):
+            stats = asyncio.run(fetcher.main_async(fetch_args, resolver=resolver_factory()))
+        wall = time.monotonic() - started
+        get_manager(db_path).close_all()
+
+    return {
+        "value": workers,
+        "throughput": stats.completed / wall,
+        "p90": stats.latency.summary()["p90"],
+        "error_rate": stats.failed / max(stats.completed, 1),
+    }
+
+
+def tune_fetch(args) -> Dict:
+    ramp = Ramp("workers", args.min_gain, args.max_error_rise, args.max_latency_factor,
+                args.patience)
+    farm = None
+    if args.input:
+        # A fresh slice per step: nothing is cached from the previous one
+        needed = args.sample * (len(args.workers) + 1)
+        pool = list(fetcher.stream_domains(args.input, set(), needed))
+        if len(pool) < needed:
+            print(f"Note: {args.input} has {len(pool):,} domains, "
+                  f"steps will reuse some ({needed:,} wanted)")
+        slices = (list(itertools.islice(itertools.cycle(pool), i * args.sample,
+                                        (i + 1) * args.sample))
+                  for i in itertools.count())
+        resolver_factory = lambda: None
+        workload = f"{args.sample:,} domains per step from {args.input}"
+    else:
+        farm = bench.ServerFarm(args.server_procs, args.latency_ms, args.body_kb,
+                                args.redirects, args.seed)
+        ports = farm.start()
+        https_port = bench.closed_port()
+        mix = bench.parse_mix(args.mix)
+        slices = (bench.generate_domains(args.sample, mix, args.seed + i)
+                  for i in itertools.count())
+        resolver_factory = lambda: bench.BenchResolver(ports, https_port)
+        workload = (f"bench farm, {args.sample:,} domains per step, "
+                    f"latency {args.latency_ms:g} ms, mix {args.mix}")
+
+    print(f"\nFetch stage: {workload}")
+    try:
+        unlimited = 1e6
+        for workers in args.workers:
+            step = run_fetch_step(next(slices), workers, unlimited, args, resolver_factory)
+            print_step(ramp, step, "domains/s")
+            if not ramp.add(step):
+                break
+        knee = ramp.best
+        rate = round(knee["throughput"] * (1 + args.rate_headroom), 1)
+        confirm = run_fetch_step(next(slices), knee["value"], rate, args, resolver_factory)
+    finally:
+        if farm is not None:
+            farm.stop()
+    print(f"  knee: {knee['value']} workers ({ramp.reason}); rate {rate:g}/s confirmed at "
+          f"{confirm['throughput']:,.1f} domains/s, p90 {confirm['p90']:,.0f} ms, "
+          f"errors {confirm['error_rate']:.1%}")
+    return {"ramp": ramp, "workload": workload, "workers": knee["value"], "rate": rate,
+            "confirm": confirm}
+
+
+# LLM stage
+
+class StubLLM:
+    """
+    OpenAI-style chat endpoint that answers `slots` requests at a time after
+    `latency_ms` (+/-25%), queues the rest and rejects with 503 past
+    `max_queue`: roughly how a GPU-bound server saturates.
+    """
+
+    def __init__(self, latency_ms: float, slots: int, max_queue: int):
+        self.latency = latency_ms / 1000.0
+        self.slots = slots
+        self.max_queue = max_queue
+        self.waiting = 0
+        self.rng = random.Random(1)
+        self._sem: Optional[asyncio.Semaphore] = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.slots)
+        await request.read()
+        if self.waiting >= self.slots + self.max_queue:
+            return web.Response(status=503, text="queue full")
+        self.waiting += 1
+        try:
+            async with self._sem:
+                await asyncio.sleep(self.latency * (0.75 + self.rng.random() / 2))
+        finally:
+            self.waiting -= 1
+        content = json.dumps({"category": "Technology", "confidence": 0.8,
+                              "rationale": "stub"})
+        return web.json_response({"choices": [{"message": {"content": content}}]})
+
+
+def _stub_llm_process(latency_ms: float, slots: int, max_queue: int, port, ready):
+    async def serve():
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions",
+                            StubLLM(latency_ms, slots, max_queue).handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("127.0.0.1", 0))
+        await web.SockSite(runner, sock, backlog=1024).start()
+        port.value = sock.getsockname()[1]
+        ready.release()
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+async def run_llm_step(cfg: ClassifierConfig, docs: List[Dict], concurrency: int) -> Dict:
+    """Classify `docs` through the LLM with `concurrency` requests in flight"""
+    sem = asyncio.Semaphore(concurrency)
+    latency = LatencyHistogram()
+    errors = 0
+
+    async def one(client: httpx.AsyncClient, doc: Dict):
+        nonlocal errors
+        async with sem:
+            started = time.monotonic()
+            result = await classifier.llm_classify(client, cfg, doc)
+            latency.record(time.monotonic() - started)
+        if not result.get("ok"):
+            errors += 1
+
+    # Same client setup as the classifier and pipeline
+    async with httpx.AsyncClient(timeout=httpx.Timeout(cfg.request_timeout_s)) as client:
+        started = time.monotonic()
+        await asyncio.gather(*(one(client, doc) for doc in docs))
+        wall = time.monotonic() - started
+    return {
+        "value": concurrency,
+        "throughput": (len(docs) - errors) / wall,
+        "p90": latency.summary()["p90"],
+        "error_rate": errors / len(docs),
+    }
+
+
+def tune_llm(args) -> Dict:
+    ramp = Ramp("llm_concurrency", args.min_gain, args.max_error_rise,
+                args.max_latency_factor, args.patience)
+    stub = None
+    if args.llm_url:
+        base_url = args.llm_url.rstrip('/')
+        workload = f"{args.llm_requests:,} requests per step to {base_url}"
+    else:
+        ctx = multiprocessing.get_context("spawn")
+        port, ready = ctx.Value('i', 0), ctx.Semaphore(0)
+        stub = ctx.Process(target=_stub_llm_process, daemon=True,
+                           args=(args.stub_latency_ms, args.stub_slots, args.stub_queue,
+                                 port, ready))
+        stub.start()
+        if not ready.acquire(timeout=30):
+            stub.terminate()
+            raise RuntimeError("Stub LLM failed to start")
+        base_url = f"http://127.0.0.1:{port.value}/v1"
+        workload = (f"stub LLM, {args.llm_requests:,} requests per step, "
+                    f"{args.stub_slots} slots at {args.stub_latency_ms:g} ms")
+
+    cfg = ClassifierConfig(vllm_base_url=base_url, model=args.model,
+                           request_timeout_s=args.llm_timeout)
+    docs = build_corpus(5, args.llm_requests, args.seed)["docs"]
+    print(f"\nLLM stage: {workload}")
+    try:
+        for concurrency in args.llm_concurrency:
+            step = asyncio.run(run_llm_step(cfg, docs, concurrency))
+            print_step(ramp, step, "req/s")
+            if not ramp.add(step):
+                break
+    finally:
+        if stub is not None:
+            stub.terminate()
+            stub.join(5)
+    print(f"  knee: llm_concurrency {ramp.best['value']} ({ramp.reason})")
+    return {"ramp": ramp, "workload": workload, "llm_concurrency": ramp.best["value"],
+            "base_url": base_url if args.llm_url else None}
+
+
+# Batch stage
+
+def run_batch_step(batch_size: int, rows: int, db_config: Optional[DatabaseConfig],
+                   seed: int) -> Dict:
+    """Write `rows` classifications in commits of `batch_size` to a scratch database"""
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory(prefix="wxawebcat-tune-") as tmp:
+        db_path = str(Path(tmp) / "tune.db")
+        if db_config is not None:
+            configure_database(db_path, db_config)
+        with quiet(False):
+            init_database(db_path)
+        with get_connection(db_path) as conn:
+            ids = insert_domains_bulk(conn, [
+                {"fqdn": f"tune{i}.example.com", "dns": {"rcode": "NOERROR"},
+                 "http": {"status": 200}, "fetch_status": "success"} for i in range(rows)])
+        results = [ClassificationRecord(
+            domain_id, fqdn, "llm", rng.choice(("News", "Shopping", "Technology", "Business")),
+            rng.random(), "tune", signals={"http_status": 200}, llm_raw={"choices": []},
+            content_hash=f"{rng.getrandbits(128):032x}",
+        ) for fqdn, domain_id in ids.items()]
+
+        cfg = ClassifierConfig(db_path=db_path, batch_size=batch_size)
+        started = time.monotonic()
+        for i in range(0, len(results), batch_size):
+            classifier.write_results(cfg, results[i:i + batch_size])
+        wall = time.monotonic() - started
+        get_manager(db_path).close_all()
+    return {"value": batch_size, "throughput": rows / wall, "p90": None, "error_rate": 0.0}
+
+
+def tune_batch(args) -> Dict:
+    ramp = Ramp("batch_size", args.min_gain, args.max_error_rise, args.max_latency_factor,
+                args.patience)
+    db_config = DatabaseConfig.from_toml(args.config) if args.config else None
+    workload = (f"{args.batch_rows:,} classification writes per step"
+                + (f", [database] from {args.config}" if args.config else ""))
+    print(f"\nBatch stage: {workload}")
+    for batch_size in args.batch_sizes:
+        # Best of three: single commits are at the mercy of fsync jitter
+        step = max((run_batch_step(batch_size, args.batch_rows, db_config, args.seed)
+                    for _ in range(3)), key=lambda s: s["throughput"])
+        print_step(ramp, step, "rows/s")
+        if not ramp.add(step):
+            break
+    print(f"  knee: batch_size {ramp.best['value']} ({ramp.reason})")
+    return {"ramp": ramp, "workload": workload, "batch_size": ramp.best["value"]}
+
+
+# Profile
+
+def render_profile(results: Dict[str, Dict], args) -> str:
+    lines = [
+        "# wxawebcat tuned profile",
+        f"# Generated by wxawebcat_tune.py on {datetime.now().strftime('%Y-%m-%d %H:%M')}",
+        f"# Host: {platform.node()} ({platform.machine()}, {os.cpu_count()} CPUs, "
+        f"Python {platform.python_version()})",
+        f"# Knee: last step gaining >= {args.min_gain:.0%} throughput with errors "
+        f"< first step + {args.max_error_rise:.0%} and p90 < {args.max_latency_factor:g}x first step",
+        "",
+    ]
+    units = {"fetch": "domains/s", "llm": "req/s", "batch": "rows/s"}
+    for stage in STAGES:
+        if stage not in results:
+            continue
+        result = results[stage]
+        lines.append(f"# {stage}: {result['workload']}")
+        lines += [f"#   {line}" for line in result["ramp"].table(units[stage])]
+        lines.append(f"#   stopped: {result['ramp'].reason}")
+        if stage == "fetch":
+            confirm = result["confirm"]
+            lines.append(f"#   confirmed at rate {result['rate']:g}/s: "
+                         f"{confirm['throughput']:,.1f} domains/s, p90 {confirm['p90']:,.0f} ms, "
+                         f"errors {confirm['error_rate']:.1%}")
+        lines.append("")
+
+    if "fetch" in results:
+        lines += [
+            "[fetcher]",
+            f"fetch_concurrency = {results['fetch']['workers']}",
+            f"rate = {results['fetch']['rate']}",
+            "",
+        ]
+    if "llm" in results:
+        lines.append("[llm]")
+        if results["llm"]["base_url"]:
+            lines.append(f'base_url = "{results["llm"]["base_url"]}"')
+            lines.append(f'model = "{args.model}"')
+        lines += [f"llm_concurrency = {results['llm']['llm_concurrency']}", ""]
+    if "batch" in results:
+        lines += ["[classifier]", f"batch_size = {results['batch']['batch_size']}", ""]
+    return "\n".join(lines)
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Tune fetcher / classifier concurrency for this machine")
+    p.add_argument("--stages", default=",".join(STAGES),
+                   help=f"Comma-separated stages to tune (default: {','.join(STAGES)})")
+    p.add_argument("--output", default="wxawebcat_tuned.toml",
+                   help="Profile to write (default: wxawebcat_tuned.toml)")
+    p.add_argument("--config", help="TOML whose [database] section the batch stage uses")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--verbose", action="store_true", help="Show the fetcher's own output")
+
+    knee = p.add_argument_group("knee")
+    knee.add_argument("--min-gain", type=float, default=0.10,
+                      help="Throughput gain a step needs over the best so far (default: 0.10)")
+    knee.add_argument("--max-error-rise", type=float, default=0.02,
+                      help="Allowed error rate rise over the first step (default: 0.02)")
+    knee.add_argument("--max-latency-factor", type=float, default=2.0,
+                      help="Allowed p90 growth over the first step (default: 2.0)")
+    knee.add_argument("--patience", type=int, default=1,
+                      help="Extra steps tried after one that did not gain (default: 1)")
+
+    fetch = p.add_argument_group("fetch stage")
+    fetch.add_argument("--workers", type=parse_steps, default=parse_steps("25,50,100,200,400,800"),
+                       help="Worker counts to try (default: 25,50,100,200,400,800)")
+    fetch.add_argument("--sample", type=int, default=2000, help="Domains per step (default: 2000)")
+    fetch.add_argument("--input", help="Real input CSV to sample instead of the bench farm")
+    fetch.add_argument("--dns-server", help="Passed to the fetcher with --input")
+    fetch.add_argument("--timeout", type=float, default=5.0, help="Fetch timeout (default: 5)")
+    fetch.add_argument("--rate-headroom", type=float, default=0.25,
+                       help="Rate limit above the knee throughput (default: 0.25)")
+    fetch.add_argument("--mix", default=bench.DEFAULT_MIX, help="Bench farm host mix")
+    fetch.add_argument("--latency-ms", type=float, default=50.0, help="Bench farm latency")
+    fetch.add_argument("--body-kb", type=int, default=20, help="Bench farm page size")
+    fetch.add_argument("--redirects", type=int, default=2, help="Bench farm redirect chain")
+    fetch.add_argument("--server-procs", type=int, default=2, help="Bench farm processes")
+
+    llm = p.add_argument_group("llm stage")
+    llm.add_argument("--llm-concurrency", type=parse_steps,
+                     default=parse_steps("4,8,16,32,64,128"),
+                     help="Concurrency levels to try (default: 4,8,16,32,64,128)")
+    llm.add_argument("--llm-requests", type=int, default=400,
+                     help="Requests per step (default: 400)")
+    llm.add_argument("--llm-url", help="LLM base URL (default: a local stub)")
+    llm.add_argument("--model", default=ClassifierConfig.model)
+    llm.add_argument("--llm-timeout", type=float, default=60.0)
+    llm.add_argument("--stub-latency-ms", type=float, default=200.0,
+                     help="Stub LLM response time (default: 200)")
+    llm.add_argument("--stub-slots", type=int, default=24,
+                     help="Requests the stub LLM serves at once (default: 24)")
+    llm.add_argument("--stub-queue", type=int, default=256,
+                     help="Requests the stub LLM queues before answering 503 (default: 256)")
+
+    batch = p.add_argument_group("batch stage")
+    batch.add_argument("--batch-sizes", type=parse_steps,
+                       default=parse_steps("25,50,100,200,500,1000,2000"),
+                       help="Batch sizes to try (default: 25,50,100,200,500,1000,2000)")
+    batch.add_argument("--batch-rows", type=int, default=20000,
+                       help="Classifications written per step (default: 20000)")
+
+    args = p.parse_args()
+    args.stages = [s.strip() for s in args.stages.split(',') if s.strip()]
+    unknown = set(args.stages) - set(STAGES)
+    if unknown or not args.stages:
+        p.error(f"--stages takes {', '.join(STAGES)}")
+    if min(args.sample, args.llm_requests, args.batch_rows) < 1:
+        p.error("--sample, --llm-requests and --batch-rows must be at least 1")
+    return args
+
+
+def main():
+    args = parse_args()
+    tuners = {"fetch": tune_fetch, "llm": tune_llm, "batch": tune_batch}
+    results = {stage: tuners[stage](args) for stage in STAGES if stage in args.stages}
+
+    profile = render_profile(results, args)
+    Path(args.output).write_text(profile)
+    print(f"\n{'='*70}")
+    print(f"✓ Profile written to {args.output}")
+    print(f"{'='*70}")
+    print('\n'.join(line for line in profile.splitlines()
+                    if not line.startswith('#')).strip())
+
+
+if __name__ == "__main__":
+    main()
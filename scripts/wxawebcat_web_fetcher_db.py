@@ -7,18 +7,88 @@ wxawebcat_web_fetcher_simple.py - Ultra-simple fetcher by WXA (WHOIS API Inc)
 import argparse
 import asyncio
 import csv
+import heapq
 import json
+import multiprocessing
+import queue
+import random
 import re
+import sqlite3
+import threading
 import time
-from dataclasses import dataclass, field
-from datetime import datetime, timezone
-from typing import Any, Dict, List, Set, Optional
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Set, Optional, Tuple
 from collections import deque
 
 import aiohttp
 from aiohttp.resolver import AsyncResolver
 
-from wxawebcat_db import get_connection, init_database
+from wxawebcat_archive import PageArchive
+from wxawebcat_metrics import LatencyHistogram
+from wxawebcat_db import (
+    DEFAULT_AGING_SHARE,
+    DatabaseConfig,
+    FetchRecord,
+    build_content_fingerprint,
+    configure_database,
+    create_fetch_run,
+    fan_out,
+    finish_fetch_run,
+    get_connection,
+    get_domains_to_refresh,
+    get_latest_fetch_run,
+    get_manager,
+    get_retryable_domains,
+    init_database,
+    insert_domains_bulk,
+    partition,
+    priority_order,
+    read_toml,
+    shard_of,
+    shard_paths,
+    update_fetch_run_checkpoint,
+)
+
+
+# Transient errors worth retrying, with the total attempt cap for each
+TRANSIENT_ERROR_ATTEMPTS = {
+    "timeout": 3,
+    "disconnected": 3,
+    "connect": 2,
+    "ClientOSError": 2,
+    "ClientPayloadError": 2,
+}
+
+# [fetcher] keys of a --config TOML -> the options they default
+FETCHER_TOML_KEYS = {
+    "fetch_concurrency": "workers",
+    "rate": "rate",
+    "timeout": "timeout",
+    "batch_size": "batch_size",
+    "aging_share": "aging_share",
+}
+
+# Defaults of those options. The parser leaves them None so that a value
+# given on the command line is never mistaken for one left at its default;
+# config_from_args fills in whatever neither source set.
+FETCHER_ARG_DEFAULTS = {
+    "workers": 50,
+    "rate": 50.0,
+    "timeout": 5.0,
+    "batch_size": 500,
+    "aging_share": DEFAULT_AGING_SHARE,
+}
+
+# Request phases timed per fetch (see build_trace_config):
+#   pool     waiting for a free connector slot
+#   dns      resolver time
+#   connect  TCP connect, plus the TLS handshake for https
+#   ttfb     request sent -> response headers, summed over redirect hops
+#   body     reading the body
+#   parse    title / meta / text extraction
+PHASES = ("pool", "dns", "connect", "ttfb", "body", "parse")
 
 
 @dataclass
@@ -32,6 +102,22 @@ class FetchConfig:
     dns_server: str = "165.232.131.164"  # Custom DNS server
     user_agent: str = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
     max_body_bytes: int = 65536
+    writer_batch_size: int = 500       # Commit after this many results...
+    writer_flush_interval: float = 2.0  # ...or after this many seconds
+    writer_queue_size: int = 10000     # Bounded hand-off to the writer thread
+    slow_workers: int = 10             # Concurrency cap for the slow-host lane
+    slow_timeout: float = 15.0         # Timeout for demoted (slow) hosts
+    adaptive_timeout: bool = True      # Derive fast-lane timeout from observed latencies
+    min_timeout: float = 1.5           # Floor for the adaptive timeout
+    retry_workers: int = 10            # Separate workers for the retry lane (0 = off)
+    retry_base_delay: float = 5.0      # First backoff, doubled per attempt
+    retry_max_delay: float = 120.0
+    retry_max_attempts: Dict[str, int] = field(
+        default_factory=lambda: dict(TRANSIENT_ERROR_ATTEMPTS))
+    processes: int = 1                 # Fetcher processes, sharded by fqdn hash
+    use_uvloop: bool = False
+    archive_dir: Optional[str] = None  # Keep compressed raw HTML here (wxawebcat_archive)
+    aging_share: float = DEFAULT_AGING_SHARE  # Share of input taken in file order, not by rank
 
 
 class RateLimiter:
@@ -62,6 +148,32 @@ class RateLimiter:
             self.last_update = time.time()
 
 
+class SharedRateLimiter:
+    """
+    Token bucket shared by all fetcher processes (one global rate budget).
+
+    Each acquire reserves a token under a cross-process lock, letting the
+    bucket go into debt, and then sleeps off the debt outside the lock.
+    """
+    def __init__(self, rate: float, state):
+        self.rate = rate
+        self.lock, self.tokens, self.last_update = state
+    
+    @staticmethod
+    def create_state(ctx, rate: float):
+        return (ctx.Lock(), ctx.RawValue('d', rate), ctx.RawValue('d', time.time()))
+    
+    async def acquire(self):
+        with self.lock:
+            now = time.time()
+            elapsed = now - self.last_update.value
+            tokens = min(self.rate, self.tokens.value + elapsed * self.rate) - 1
+            self.tokens.value = tokens
+            self.last_update.value = now
+        if tokens < 0:
+            await asyncio.sleep(-tokens / self.rate)
+
+
 @dataclass 
 class Stats:
     """Statistics"""
@@ -70,8 +182,47 @@ class Stats:
     success: int = 0
     failed: int = 0
     blocked: int = 0
+    retried: int = 0
+    recovered: int = 0
+    demoted: int = 0
+    not_modified: int = 0
     start_time: float = field(default_factory=time.time)
     error_counts: Dict[str, int] = field(default_factory=dict)
+    lane_time: Dict[str, float] = field(default_factory=dict)  # Worker-seconds per lane
+    latency: LatencyHistogram = field(default_factory=LatencyHistogram)  # Per request
+    phases: Dict[str, LatencyHistogram] = field(
+        default_factory=lambda: {p: LatencyHistogram() for p in PHASES})
+    # Gauges, refreshed by fetch_all
+    current_timeout: float = 0.0
+    slow_waiting: int = 0
+    retry_waiting: int = 0
+    
+    _COUNTERS = ("completed", "success", "failed", "blocked", "retried", "recovered",
+                 "demoted", "not_modified")
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """Picklable copy for sending to the parent process"""
+        return asdict(self)
+    
+    def absorb(self, snapshots: List[Dict[str, Any]]):
+        """Replace counters with the sum over per-process snapshots"""
+        snapshots = list(snapshots)
+        for name in self._COUNTERS + ("slow_waiting", "retry_waiting"):
+            setattr(self, name, sum(snap[name] for snap in snapshots))
+        self.error_counts = {}
+        self.lane_time = {}
+        self.latency = LatencyHistogram()
+        self.phases = {p: LatencyHistogram() for p in PHASES}
+        for snap in snapshots:
+            self.latency.merge(snap["latency"])
+            for p, hist in snap["phases"].items():
+                self.phases[p].merge(hist)
+            for k, v in snap["error_counts"].items():
+                self.error_counts[k] = self.error_counts.get(k, 0) + v
+            for k, v in snap["lane_time"].items():
+                self.lane_time[k] = self.lane_time.get(k, 0.0) + v
+        if snapshots:
+            self.current_timeout = sum(snap["current_timeout"] for snap in snapshots) / len(snapshots)
     
     def record_error(self, error_type: str):
         if error_type:
@@ -82,6 +233,65 @@ class Stats:
             error_type = error_type.replace("ClientResponseError", "bad_response")
             self.error_counts[error_type] = self.error_counts.get(error_type, 0) + 1
     
+    def record_result(self, result: FetchRecord):
+        if result.status == "success":
+            self.success += 1
+        elif result.status == "not_modified":
+            self.success += 1
+            self.not_modified += 1
+        elif result.status == "blocked":
+            self.blocked += 1
+        else:
+            self.failed += 1
+            self.record_error(result.http.get("error", "unknown"))
+    
+    def record_phases(self, timing: Optional[Dict[str, float]]):
+        """Add a compact timing record (milliseconds) to the phase histograms"""
+        if not timing:
+            return
+        for p in PHASES:
+            if p in timing:
+                self.phases[p].record(timing[p] / 1000.0)
+    
+    def phase_summary(self, qs: Tuple[str, ...] = ("p50", "p99")) -> str:
+        parts = []
+        for p in PHASES:
+            hist = self.phases[p]
+            if hist.count:
+                s = hist.summary()
+                parts.append(f"{p} " + "/".join(f"{s[q]:.0f}" for q in qs))
+        return " | ".join(parts) or "none"
+    
+    def metrics(self) -> Dict[str, Any]:
+        """Point-in-time metrics record for --metrics-file"""
+        return {
+            "time": datetime.now(timezone.utc).isoformat(),
+            "elapsed": round(self.elapsed, 1),
+            "total": self.total,
+            "completed": self.completed,
+            "rate": round(self.rate, 2),
+            "success": self.success,
+            "failed": self.failed,
+            "blocked": self.blocked,
+            "retried": self.retried,
+            "demoted": self.demoted,
+            "timeout": round(self.current_timeout, 2),
+            "errors": dict(self.error_counts),
+            "lane_time": {k: round(v, 1) for k, v in self.lane_time.items()},
+            "latency_ms": self.latency.summary(),
+            "phases_ms": {p: hist.summary() for p, hist in self.phases.items() if hist.count},
+        }
+    
+    def record_lane_time(self, lane: str, seconds: float):
+        self.lane_time[lane] = self.lane_time.get(lane, 0.0) + seconds
+    
+    def lane_share(self) -> str:
+        busy = sum(self.lane_time.values())
+        if busy <= 0:
+            return "none"
+        return " | ".join(f"{lane} {secs / busy * 100:.0f}%"
+                          for lane, secs in sorted(self.lane_time.items(), key=lambda x: -x[1]))
+    
     @property
     def elapsed(self) -> float:
         return time.time() - self.start_time
@@ -108,6 +318,65 @@ class Stats:
         return " | ".join(f"{k}:{v}" for k, v in sorted_errors)
 
 
+class AdaptiveTimeout:
+    """
+    Fast-lane timeout derived from observed TTFB and body-rate distributions.
+
+    The timeout allows a p95 time-to-first-byte (scaled by `ttfb_factor`) plus
+    the time to read `max_body_bytes` at a p10 body rate, clamped between
+    `min_timeout` and the configured `http_timeout`. Until enough samples
+    have been seen, the configured timeout is used as-is.
+    """
+
+    def __init__(self, cfg: "FetchConfig", window: int = 2000, min_samples: int = 100,
+                 ttfb_factor: float = 2.0, min_body_sample: int = 4096):
+        self.cfg = cfg
+        self.min_samples = min_samples
+        self.ttfb_factor = ttfb_factor
+        self.min_body_sample = min_body_sample
+        self.ttfb: deque = deque(maxlen=window)
+        self.body_rate: deque = deque(maxlen=window)
+        self._cached: Optional[float] = None
+        self._since_update = 0
+
+    def observe(self, timing: Optional[Dict[str, float]]):
+        """Add a compact timing record (milliseconds, see compact_timing)"""
+        if not timing or "ttfb" not in timing:
+            return
+        # Everything the total timeout covers up to the response headers
+        headers_ms = sum(timing.get(p, 0.0) for p in ("pool", "dns", "connect", "ttfb"))
+        self.ttfb.append(headers_ms / 1000)
+        if timing.get("bytes", 0) >= self.min_body_sample and timing.get("body", 0) > 0:
+            self.body_rate.append(timing["bytes"] / (timing["body"] / 1000))
+        self._since_update += 1
+
+    def observe_timeout(self, timeout: float):
+        """
+        A request that got no response within `timeout`: its TTFB is at
+        least that long. Recording the bound keeps p95 from being estimated
+        from successes alone.
+        """
+        self.ttfb.append(timeout)
+        self._since_update += 1
+
+    @staticmethod
+    def _percentile(samples, q: float) -> float:
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def current(self) -> float:
+        if not self.cfg.adaptive_timeout or len(self.ttfb) < self.min_samples:
+            return self.cfg.http_timeout
+        # Percentiles are recomputed every few dozen samples, not per request
+        if self._cached is None or self._since_update >= 50:
+            budget = self._percentile(self.ttfb, 0.95) * self.ttfb_factor
+            if len(self.body_rate) >= self.min_samples // 4:
+                budget += self.cfg.max_body_bytes / self._percentile(self.body_rate, 0.10)
+            self._cached = max(self.cfg.min_timeout, min(self.cfg.http_timeout, budget))
+            self._since_update = 0
+        return self._cached
+
+
 def sanitize_domain(domain: str) -> str:
     domain = domain.strip().lower()
     domain = re.sub(r'^https?://', '', domain)
@@ -146,34 +415,146 @@ def extract_visible_text(html: str, max_chars: int = 1000) -> str:
     return text.strip()[:max_chars]
 
 
+def extract_page(html: str, max_chars: int = 65536) -> Dict[str, Any]:
+    """The http_data content fields (title, meta, body_snippet) of a page"""
+    html = html[:max_chars]
+    meta = {}
+    description = extract_meta_description(html)
+    if description:
+        meta["description"] = description
+    return {
+        "title": extract_title(html),
+        "meta": meta,
+        "body_snippet": extract_visible_text(html),
+    }
+
+
+def build_trace_config() -> aiohttp.TraceConfig:
+    """
+    aiohttp tracing hooks that time each request's phases.
+
+    Timings (seconds) accumulate into the dict passed to the request as
+    `trace_request_ctx`; fetch_domain adds body and parse itself.
+    """
+    def add(phases: Dict[str, float], name: str, seconds: float):
+        phases[name] = phases.get(name, 0.0) + seconds
+
+    async def on_queued_start(session, ctx, params):
+        ctx.queued = time.monotonic()
+
+    async def on_queued_end(session, ctx, params):
+        add(ctx.trace_request_ctx, "pool", time.monotonic() - ctx.queued)
+
+    async def on_dns_start(session, ctx, params):
+        ctx.dns_started = time.monotonic()
+
+    async def on_dns_end(session, ctx, params):
+        add(ctx.trace_request_ctx, "dns", time.monotonic() - ctx.dns_started)
+
+    async def on_connect_start(session, ctx, params):
+        # Resolution happens inside connection setup; it is subtracted below
+        ctx.connect_started = time.monotonic()
+        ctx.dns_before = ctx.trace_request_ctx.get("dns", 0.0)
+
+    async def on_connect_end(session, ctx, params):
+        dns = ctx.trace_request_ctx.get("dns", 0.0) - ctx.dns_before
+        add(ctx.trace_request_ctx, "connect",
+            time.monotonic() - ctx.connect_started - dns)
+
+    async def on_headers_sent(session, ctx, params):
+        ctx.sent = time.monotonic()
+
+    async def on_response(session, ctx, params):
+        if hasattr(ctx, "sent"):
+            add(ctx.trace_request_ctx, "ttfb", time.monotonic() - ctx.sent)
+
+    async def on_redirect(session, ctx, params):
+        await on_response(session, ctx, params)
+        add(ctx.trace_request_ctx, "redirects", 1)
+
+    trace = aiohttp.TraceConfig()
+    trace.on_connection_queued_start.append(on_queued_start)
+    trace.on_connection_queued_end.append(on_queued_end)
+    trace.on_dns_resolvehost_start.append(on_dns_start)
+    trace.on_dns_resolvehost_end.append(on_dns_end)
+    trace.on_connection_create_start.append(on_connect_start)
+    trace.on_connection_create_end.append(on_connect_end)
+    trace.on_request_headers_sent.append(on_headers_sent)
+    trace.on_request_end.append(on_response)
+    trace.on_request_redirect.append(on_redirect)
+    return trace
+
+
+def compact_timing(phases: Dict[str, float], total: float) -> Dict[str, float]:
+    """
+    Phase timings in milliseconds (0.1ms resolution), plus the redirect
+    count and body size, as stored in http_data
+    """
+    timing = {p: round(phases[p] * 1000, 1) for p in PHASES if p in phases}
+    if phases.get("redirects"):
+        timing["redirects"] = int(phases["redirects"])
+    if phases.get("bytes"):
+        timing["bytes"] = int(phases["bytes"])
+    timing["total"] = round(total * 1000, 1)
+    return timing
+
+
 async def fetch_domain(domain: str, session: aiohttp.ClientSession, 
-                       cfg: FetchConfig) -> Dict:
+                       cfg: FetchConfig, total_timeout: Optional[float] = None,
+                       validators: Optional[Dict[str, str]] = None) -> FetchRecord:
     """
     Fetch a single domain. aiohttp handles DNS internally.
+
+    `total_timeout` overrides `cfg.http_timeout` (adaptive and slow lanes).
+
+    With `validators` (stored "etag"/"last_modified") the request is
+    conditional; a 304 yields status "not_modified" and no content.
+
+    http["timing"] holds the phase timings of the last attempt (see
+    compact_timing) when the session was built with build_trace_config();
+    it also feeds the adaptive timeout.
+    With cfg.archive_dir set, successful HTML fetches also carry the
+    truncated raw body as raw_html for the page archive.
     """
-    result = {
-        "fqdn": domain,
-        "dns": {"rcode": "NOERROR", "a": []},  # We won't have detailed DNS info
-        "http": {"status": 0, "error": None, "title": None, "body_snippet": None, 
-                 "meta": {}, "blocked": False, "content_type": None, "final_url": None},
-        "status": "unknown"
-    }
+    result = FetchRecord(
+        domain,
+        dns={"rcode": "NOERROR", "a": []},  # We won't have detailed DNS info
+        http={"status": 0, "error": None, "title": None, "body_snippet": None, 
+              "meta": {}, "blocked": False, "content_type": None, "final_url": None},
+    )
     
+    total_timeout = total_timeout or cfg.http_timeout
     timeout = aiohttp.ClientTimeout(
-        total=cfg.http_timeout, 
-        connect=cfg.connect_timeout,
-        sock_connect=cfg.connect_timeout,
+        total=total_timeout, 
+        connect=min(cfg.connect_timeout, total_timeout),
+        sock_connect=min(cfg.connect_timeout, total_timeout),
     )
     
+    headers = {}
+    if validators:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+    
     # Try HTTPS first, then HTTP
+    fetch_started = time.monotonic()
     for scheme in ["https", "http"]:
         url = f"{scheme}://{domain}"
+        phases: Dict[str, float] = {}
         try:
             async with session.get(url, timeout=timeout, allow_redirects=True, 
-                                   ssl=False) as resp:
-                result["http"]["status"] = resp.status
-                result["http"]["final_url"] = str(resp.url)
-                result["http"]["content_type"] = resp.headers.get("content-type", "")
+                                   ssl=False, headers=headers,
+                                   trace_request_ctx=phases) as resp:
+                result.http["status"] = resp.status
+                result.http["final_url"] = str(resp.url)
+                result.http["content_type"] = resp.headers.get("content-type", "")
+                result.etag = resp.headers.get("etag")
+                result.last_modified = resp.headers.get("last-modified")
+                
+                if resp.status == 304:
+                    result.status = "not_modified"
+                    return result
                 
                 # Check for blocking
                 if resp.status in [403, 429]:
@@ -181,62 +562,69 @@ async def fetch_domain(domain: str, session: aiohttp.ClientSession,
                         text = await resp.text(encoding='utf-8', errors='ignore')
                         if any(kw in text.lower()[:2000] for kw in 
                                ["cloudflare", "captcha", "blocked", "access denied"]):
-                            result["http"]["blocked"] = True
-                            result["status"] = "blocked"
+                            result.http["blocked"] = True
+                            result.status = "blocked"
                             return result
                     except:
                         pass
                 
                 # Extract content if HTML
-                if "text/html" in result["http"]["content_type"]:
+                if "text/html" in result.http["content_type"]:
                     try:
-                        html = await resp.text(encoding='utf-8', errors='ignore')
-                        html = html[:cfg.max_body_bytes]
-                        result["http"]["title"] = extract_title(html)
-                        meta = extract_meta_description(html)
-                        if meta:
-                            result["http"]["meta"]["description"] = meta
-                        result["http"]["body_snippet"] = extract_visible_text(html)
+                        body_started = time.monotonic()
+                        body = await resp.read()
+                        parse_started = time.monotonic()
+                        phases["body"] = parse_started - body_started
+                        phases["bytes"] = len(body)
+                        html = body.decode('utf-8', errors='ignore')
+                        result.http.update(extract_page(html, cfg.max_body_bytes))
+                        phases["parse"] = time.monotonic() - parse_started
+                        if cfg.archive_dir:
+                            result.raw_html = body[:cfg.max_body_bytes]
                     except:
                         pass
                 
-                result["status"] = "success"
+                result.status = "success"
+                result.content_hash = build_content_fingerprint(result.http)
                 return result
                 
         except asyncio.TimeoutError:
-            result["http"]["error"] = "timeout"
+            result.http["error"] = "timeout"
         except aiohttp.ClientConnectorError as e:
             # This includes DNS failures
             err_str = str(e).lower()
             if "getaddrinfo" in err_str or "name or service not known" in err_str:
-                result["http"]["error"] = "dns_failed"
-                result["dns"]["rcode"] = "NXDOMAIN"
+                result.http["error"] = "dns_failed"
+                result.dns["rcode"] = "NXDOMAIN"
             elif "connection refused" in err_str:
-                result["http"]["error"] = "refused"
+                result.http["error"] = "refused"
             else:
-                result["http"]["error"] = "connect"
+                result.http["error"] = "connect"
         except aiohttp.ServerDisconnectedError:
-            result["http"]["error"] = "disconnected"
+            result.http["error"] = "disconnected"
         except aiohttp.ClientError as e:
-            result["http"]["error"] = type(e).__name__
+            result.http["error"] = type(e).__name__
         except Exception as e:
-            result["http"]["error"] = type(e).__name__
+            result.http["error"] = type(e).__name__
+        finally:
+            result.http["timing"] = compact_timing(phases, time.monotonic() - fetch_started)
     
     # If we get here, both HTTPS and HTTP failed
-    if result["http"]["error"] == "dns_failed":
-        result["status"] = "dns_failed"
+    if result.http["error"] == "dns_failed":
+        result.status = "dns_failed"
     else:
-        result["status"] = "http_failed"
+        result.status = "http_failed"
     return result
 
 
 def get_existing_domains(db_path: str) -> Set[str]:
     existing = set()
     try:
-        with get_connection(db_path) as conn:
-            cursor = conn.execute("SELECT fqdn FROM domains")
-            for row in cursor:
-                existing.add(row[0])
+        for path in shard_paths(db_path):
+            with get_connection(path) as conn:
+                cursor = conn.execute("SELECT fqdn FROM domains")
+                for row in cursor:
+                    existing.add(row[0])
     except:
         pass
     return existing
@@ -250,197 +638,655 @@ def extract_domain_from_row(row: List[str]) -> str:
     return sanitize_domain(row[0])
 
 
-def stream_domains(csv_path: str, skip: Set[str], limit: Optional[int] = None):
+def extract_rank_from_row(row: List[str]) -> Optional[int]:
+    """The rank column of a "rank,domain" row (top-1M lists), if there is one"""
+    if len(row) >= 2:
+        rank = row[0].strip().replace(',', '')
+        if rank.isdigit():
+            return int(rank)
+    return None
+
+
+def stream_domains_with_offsets(csv_path: str, skip: Set[str], limit: Optional[int] = None,
+                                start_offset: int = 0, start_line: int = 0):
+    """
+    Yield (domain, byte_offset, line_number, rank) for each domain to fetch.
+
+    The offset/line point just past the domain's input line, so seeking to a
+    committed checkpoint resumes with the next line.
+    """
     count = 0
-    with open(csv_path, 'r', encoding='utf-8', errors='ignore') as f:
-        reader = csv.reader(f)
-        for i, row in enumerate(reader):
+    offset = start_offset
+    line_no = start_line
+    with open(csv_path, 'rb') as f:
+        f.seek(start_offset)
+        for raw in f:
+            offset += len(raw)
+            line_no += 1
+            row = next(csv.reader([raw.decode('utf-8', errors='ignore')]), None)
             if not row or not row[0].strip() or row[0].startswith('#'):
                 continue
-            if i == 0 and row[0].strip().lower() in ['rank', 'domain', 'fqdn']:
+            if line_no == 1 and row[0].strip().lower() in ['rank', 'domain', 'fqdn']:
                 continue
             domain = extract_domain_from_row(row)
             if domain and domain not in skip:
-                yield domain
+                yield domain, offset, line_no, extract_rank_from_row(row)
                 count += 1
                 if limit and count >= limit:
                     break
 
 
-def batch_insert(conn, results: List[Dict]):
+def stream_domains(csv_path: str, skip: Set[str], limit: Optional[int] = None):
+    for domain, _, _, _ in stream_domains_with_offsets(csv_path, skip, limit):
+        yield domain
+
+
+def batch_insert(conn, results: List[FetchRecord]) -> Dict[str, int]:
+    """Write fetch results; returns {fqdn: domain_id} for the upserted ones"""
     now = datetime.now(timezone.utc).isoformat()
-    conn.executemany("""
-        INSERT INTO domains (fqdn, dns_data, http_data, fetched_at, fetch_status)
-        VALUES (?, ?, ?, ?, ?)
-        ON CONFLICT(fqdn) DO UPDATE SET
-            dns_data = excluded.dns_data,
-            http_data = excluded.http_data,
-            fetched_at = excluded.fetched_at,
-            fetch_status = excluded.fetch_status,
-            updated_at = datetime('now')
-    """, [(r["fqdn"], json.dumps(r["dns"]), json.dumps(r["http"]), 
-           now, r["status"]) for r in results])
-
-
-async def main_async(args):
-    cfg = FetchConfig(
-        workers=args.workers,
-        rate_limit=args.rate,
-        http_timeout=args.timeout,
-        connect_timeout=min(args.timeout, 3.0),
-        db_path=args.db,
-        dns_server=args.dns_server,
-    )
-    
-    init_database(cfg.db_path)
-    
-    print("Loading existing domains...")
-    existing = get_existing_domains(cfg.db_path)
-    print(f"Found {len(existing)} already fetched")
-    
-    print(f"Loading domains from {args.input}...")
-    domains = list(stream_domains(args.input, existing, args.limit))
-    total = len(domains)
-    
-    if total == 0:
-        print("Nothing to fetch!")
-        return
     
-    print(f"\n{'='*70}")
-    print(f"SIMPLE FETCHER (custom DNS: {cfg.dns_server})")
-    print(f"{'='*70}")
-    print(f"To fetch:         {total:,}")
-    print(f"Workers:          {cfg.workers}")
-    print(f"Rate limit:       {cfg.rate_limit}/s")
-    print(f"Timeout:          {cfg.http_timeout}s")
-    print(f"DNS server:       {cfg.dns_server}")
-    print(f"Expected time:    {total / cfg.rate_limit / 3600:.1f} hours")
-    print(f"{'='*70}\n")
-    
-    stats = Stats(total=total)
-    rate_limiter = RateLimiter(cfg.rate_limit)
-    
-    # Results buffer for batch DB writes
-    results_buffer = []
-    buffer_lock = asyncio.Lock()
+    # 304s keep their stored content (and classification); only the fetch
+    # time moves forward
+    conn.executemany("""
+        UPDATE domains
+        SET fetched_at = ?, fetch_attempts = ?, updated_at = datetime('now')
+        WHERE fqdn = ?
+    """, [(now, r.attempts, r.fqdn) for r in results if r.status == "not_modified"])
     
-    # Work queue
-    work_queue = asyncio.Queue()
-    for domain in domains:
-        await work_queue.put(domain)
+    return insert_domains_bulk(conn, [r for r in results if r.status != "not_modified"])
+
+
+class RetryLane:
+    """
+    Delayed lane for transient fetch failures.
+
+    Failed domains wait out an exponential backoff with jitter in a heap and
+    are picked up by their own small pool of retry workers, so first-time
+    domains never lose primary workers to retries.
+    """
+
+    def __init__(self, base_delay: float, max_delay: float,
+                 max_attempts: Dict[str, int]):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.heap: List[Tuple[float, int, str, int, float]] = []
+        self.active = 0
+        self.closed = False
+        self._counter = 0
+        self._wakeup = asyncio.Event()
+
+    def should_retry(self, error: Optional[str], attempts: int) -> bool:
+        return attempts < self.max_attempts.get(error or "", 0)
+
+    def backoff(self, attempts: int) -> float:
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def schedule(self, domain: str, attempts: int, timeout: float):
+        """Retry `domain` after a backoff, with the timeout of the lane that failed"""
+        due = time.monotonic() + self.backoff(attempts)
+        heapq.heappush(self.heap, (due, self._counter, domain, attempts, timeout))
+        self._counter += 1
+        self._wakeup.set()
+
+    def close(self):
+        """No more first attempts will arrive; retry workers exit once drained"""
+        self.closed = True
+        self._wakeup.set()
+
+    async def get(self) -> Optional[Tuple[str, int, float]]:
+        """Next due (domain, attempts so far, timeout), or None when the lane is finished"""
+        while True:
+            now = time.monotonic()
+            if self.heap and self.heap[0][0] <= now:
+                _, _, domain, attempts, timeout = heapq.heappop(self.heap)
+                self.active += 1
+                return domain, attempts, timeout
+            if self.closed and not self.heap and self.active == 0:
+                return None
+            self._wakeup.clear()
+            timeout = self.heap[0][0] - now if self.heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def done(self):
+        self.active -= 1
+        self._wakeup.set()
+
+
+class CheckpointTracker:
+    """
+    Low-watermark over input positions.
+
+    Workers finish out of order, so the checkpoint may only move past a
+    domain once it and every domain before it have been committed.
+    """
+
+    def __init__(self):
+        self.next_seq = 0
+        self.done: Dict[int, Tuple[int, int]] = {}
+
+    def complete(self, seq: int, offset: int, line: int):
+        self.done[seq] = (offset, line)
+
+    def advance(self) -> Optional[Tuple[int, int]]:
+        """Return the new (byte_offset, line_number) watermark, if it moved"""
+        position = None
+        while self.next_seq in self.done:
+            position = self.done.pop(self.next_seq)
+            self.next_seq += 1
+        return position
+
+
+class DBWriter:
+    """
+    Dedicated writer thread for fetch results.
+
+    Uses its thread's pooled connection (WAL, tuned pragmas) for the whole
+    run, so flushes never block the event loop and readers (the classifier)
+    are not locked out; the checkpoint policy runs after each commit.
+    Results arrive through a bounded queue and are committed when either
+    `batch_size` results are pending or `flush_interval` seconds have passed.
+    An optional PageArchive stores raw pages in the same thread, ahead of
+    the rows that reference them.
+
+    On a sharded database each batch is split by shard and committed shard
+    by shard, before the run checkpoint in the main file; a crash in between
+    only means re-fetching (idempotently) from the older checkpoint.
+    """
+
+    _STOP = object()
+
+    def __init__(self, db_path: str, batch_size: int = 500,
+                 flush_interval: float = 2.0, queue_size: int = 10000,
+                 run_id: Optional[int] = None, write_batch=None, on_commit=None,
+                 archive: Optional[PageArchive] = None):
+        self.db_path = db_path
+        self.manager = get_manager(db_path)
+        self.sharded = shard_paths(db_path) != [db_path]
+        self.run_id = run_id
+        self.archive = archive
+        self.write_batch = write_batch or batch_insert
+        self.on_commit = on_commit
+        self.checkpoint = CheckpointTracker()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        self.committed = 0
+        self.batches = 0
+        self.error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def submit(self, result: FetchRecord):
+        """Blocking hand-off for non-async callers (the shard collector thread)"""
+        self.queue.put(result)
+
+    async def put(self, result: FetchRecord):
+        """Hand a result to the writer; waits off-loop only if the queue is full"""
+        try:
+            self.queue.put_nowait(result)
+        except queue.Full:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.queue.put, result)
+
+    def close(self):
+        """Drain everything queued so far, commit it and stop the thread"""
+        self.queue.put(self._STOP)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _write(self, conn: sqlite3.Connection, results: List[FetchRecord]):
+        if self.archive is not None:
+            self.archive.store_batch(conn, results)
+        self.write_batch(conn, results)
+
+    def _flush(self, conn: sqlite3.Connection, pending: List[FetchRecord]):
+        shard_conns = []
+        try:
+            if self.sharded:
+                for path, results in partition(self.db_path, pending,
+                                               key=lambda r: r.fqdn).items():
+                    manager = get_manager(path)
+                    shard_conn = manager.connection()
+                    shard_conns.append(shard_conn)
+                    self._write(shard_conn, results)
+                    shard_conn.commit()
+                    manager.maybe_checkpoint(shard_conn)
+            else:
+                self._write(conn, pending)
+            # The checkpoint commits in the same transaction as the results
+            # it covers; after any failed batch it stops advancing
+            if self.run_id is not None and self.error is None:
+                for r in pending:
+                    if r.input_pos is not None:
+                        self.checkpoint.complete(*r.input_pos)
+                position = self.checkpoint.advance()
+                if position:
+                    update_fetch_run_checkpoint(conn, self.run_id, *position)
+            conn.commit()
+            self.manager.maybe_checkpoint(conn)
+            self.committed += len(pending)
+            self.batches += 1
+            if self.on_commit is not None:
+                self.on_commit(pending)
+        except Exception as e:
+            # Keep draining so workers never block on a full queue; the
+            # error is re-raised from close()
+            for c in shard_conns + [conn]:
+                c.rollback()
+            self.error = e
+            print(f"DB writer error ({len(pending)} results lost): {e}")
+
+    def _truncate_wal(self, conn: sqlite3.Connection):
+        if self.sharded:
+            for path in shard_paths(self.db_path):
+                get_manager(path).truncate_wal()
+        self.manager.truncate_wal(conn)
+
+    def _run(self):
+        conn = self.manager.connection()
+        pending: List[FetchRecord] = []
+        deadline = time.monotonic() + self.flush_interval
+        try:
+            while True:
+                try:
+                    item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    item = None
+
+                if item is self._STOP:
+                    break
+                if item is not None:
+                    pending.append(item)
+
+                if len(pending) >= self.batch_size or time.monotonic() >= deadline:
+                    if pending:
+                        self._flush(conn, pending)
+                        pending = []
+                    elif item is None:
+                        # A whole interval without results: shrink the WAL now
+                        self._truncate_wal(conn)
+                    deadline = time.monotonic() + self.flush_interval
+
+            if pending:
+                self._flush(conn, pending)
+            self._truncate_wal(conn)
+        finally:
+            self.manager.release()
+            if self.sharded:
+                for path in shard_paths(self.db_path):
+                    get_manager(path).release()
+            if self.archive is not None:
+                self.archive.close()
+
+
+def load_input(args, cfg: FetchConfig):
+    """
+    Build the work list from the input CSV, resuming from a checkpoint if asked.
+
+    Returns (work_items, run_id, input_exhausted); work_items is None when
+    there is nothing to do for this input.
+    """
+    input_path = str(Path(args.input).resolve())
+    input_stat = Path(input_path).stat()
     
-    # Recent rate tracking
-    recent_rates = deque(maxlen=10)
-    last_completed = 0
+    # Resume from the last committed checkpoint when the input is unchanged
+    run = None
+    if args.resume:
+        with get_connection(cfg.db_path) as conn:
+            run = get_latest_fetch_run(conn, input_path)
+        # A changed input means a new run, even after a completed one
+        if run and (run['input_size'] != input_stat.st_size
+                    or run['input_mtime'] != input_stat.st_mtime):
+            print(f"Input changed since run {run['id']} - starting a new run")
+            run = None
+        if run and run['status'] == 'completed':
+            print(f"Run {run['id']} for {args.input} already completed. Nothing to resume.")
+            return None, None, False
     
-    # Create aiohttp session with custom DNS resolver
-    # This uses aiodns under the hood but aiohttp manages it
-    resolver = AsyncResolver(nameservers=[cfg.dns_server])
+    if run:
+        print(f"Resuming run {run['id']} at line {run['line_number']:,} "
+              f"(byte {run['byte_offset']:,})")
+        existing = set()
+        start_offset, start_line = run['byte_offset'], run['line_number']
+        run_id = run['id']
+    else:
+        print("Loading existing domains...")
+        existing = get_existing_domains(cfg.db_path)
+        print(f"Found {len(existing)} already fetched")
+        start_offset, start_line = 0, 0
+        with get_connection(cfg.db_path) as conn:
+            run_id = create_fetch_run(conn, input_path, input_stat.st_size,
+                                      input_stat.st_mtime, asdict(cfg))
     
-    connector = aiohttp.TCPConnector(
+    print(f"Loading domains from {args.input}...")
+    domains = list(stream_domains_with_offsets(args.input, existing, args.limit,
+                                               start_offset, start_line))
+    # --priority applies to the whole file; otherwise the rank column, if any
+    work_items = [(domain, (seq, offset, line_no), 0, None,
+                   args.priority if args.priority is not None else rank)
+                  for seq, (domain, offset, line_no, rank) in enumerate(domains)]
+    # Best-ranked first, with a share in file order so the checkpoint (the
+    # committed input prefix) keeps advancing during long runs
+    work_items = priority_order(work_items, lambda item: item[4], lambda item: item[1][0],
+                                cfg.aging_share)
+    input_exhausted = not args.limit or len(domains) < args.limit
+    return work_items, run_id, input_exhausted
+
+
+def build_connector(cfg: FetchConfig, resolver=None) -> aiohttp.TCPConnector:
+    # Custom DNS resolver: uses aiodns under the hood but aiohttp manages it
+    if resolver is None:
+        resolver = AsyncResolver(nameservers=[cfg.dns_server])
+
+    return aiohttp.TCPConnector(
         resolver=resolver,           # Use our custom DNS server
-        limit=cfg.workers,           # Match worker count
+        limit=cfg.workers + cfg.slow_workers + cfg.retry_workers,  # Match worker count
         limit_per_host=3,            # Don't hammer single hosts
         ttl_dns_cache=300,           # Cache DNS for 5 minutes
         enable_cleanup_closed=True,
         force_close=False,
     )
-    
+
+
+async def fetch_all(cfg: FetchConfig, work_items: List[Tuple], stats: Stats,
+                    rate_limiter, emit, resolver=None):
+    """
+    Fetch every work item through the fast, slow and retry lanes.
+
+    work_items are (domain, input_pos, prior_attempts, validators, priority)
+    tuples, fetched in list order; each final FetchRecord is passed to the
+    async callable `emit`. `resolver` replaces the aiodns resolver (used by
+    the offline benchmark).
+    """
+    # Work queue for first attempts, plus the delayed lane for retries
+    work_queue = asyncio.Queue()
+    for item in work_items:
+        work_queue.put_nowait(item)
+    retry_lane = RetryLane(cfg.retry_base_delay, cfg.retry_max_delay,
+                           cfg.retry_max_attempts if cfg.retry_workers > 0 else {})
+
+    # Hosts that time out under a shortened adaptive timeout are demoted to a
+    # small slow lane with a generous timeout, so tar pits can't occupy the
+    # main pool. At the full http_timeout a timeout is final.
+    adaptive = AdaptiveTimeout(cfg)
+    slow_queue: asyncio.Queue = asyncio.Queue()
+
+    async def fetch_in_lane(lane: str, domain: str, timeout: float,
+                            validators: Optional[Dict[str, str]] = None) -> FetchRecord:
+        await rate_limiter.acquire()
+        started = time.monotonic()
+        result = await fetch_domain(domain, session, cfg, timeout, validators)
+        result.started = started
+        elapsed = time.monotonic() - started
+        stats.record_lane_time(lane, elapsed)
+        stats.latency.record(elapsed)
+        stats.record_phases(result.http.get("timing"))
+        if result.http["error"] == "timeout" and result.http["status"] == 0:
+            adaptive.observe_timeout(timeout)
+        else:
+            adaptive.observe(result.http.get("timing"))
+        stats.current_timeout = adaptive.current()
+        stats.slow_waiting = slow_queue.qsize()
+        stats.retry_waiting = len(retry_lane.heap)
+        return result
+
+    async def finish_first_attempt(result: FetchRecord, input_pos, prior_attempts: int,
+                                   priority: Optional[int], timeout: float):
+        result.attempts = prior_attempts + 1
+        result.priority = priority
+
+        # Update stats
+        stats.completed += 1
+        stats.record_result(result)
+
+        # Transient failures are written now and overwritten if a retry
+        # succeeds, so the checkpoint never waits on the retry lane
+        if (result.status == "http_failed"
+                and retry_lane.should_retry(result.http["error"], result.attempts)):
+            retry_lane.schedule(result.fqdn, result.attempts, timeout)
+
+        # Hand off to the writer
+        if input_pos is not None:
+            result.input_pos = input_pos
+        await emit(result)
+
     async def worker():
         """Worker: grab domain, fetch it, save result"""
         while True:
             try:
-                domain = work_queue.get_nowait()
+                item = work_queue.get_nowait()
             except asyncio.QueueEmpty:
                 return
-            
-            # Rate limit before making request
-            await rate_limiter.acquire()
-            
-            result = await fetch_domain(domain, session, cfg)
-            
-            # Update stats
-            stats.completed += 1
-            if result["status"] == "success":
-                stats.success += 1
-            elif result["status"] == "blocked":
-                stats.blocked += 1
+            domain, input_pos, prior_attempts, validators, priority = item
+
+            timeout = adaptive.current()
+            result = await fetch_in_lane("fast", domain, timeout, validators)
+
+            if (result.http["error"] == "timeout" and result.http["status"] == 0
+                    and cfg.adaptive_timeout and timeout < cfg.http_timeout
+                    and cfg.slow_workers > 0):
+                stats.demoted += 1
+                slow_queue.put_nowait(item)
             else:
-                stats.failed += 1
-                stats.record_error(result["http"].get("error", "unknown"))
-            
-            # Buffer result
-            async with buffer_lock:
-                results_buffer.append(result)
-            
+                await finish_first_attempt(result, input_pos, prior_attempts, priority, timeout)
+
             work_queue.task_done()
-    
-    async def db_writer():
-        """Periodically flush results to database"""
-        nonlocal results_buffer
-        while stats.completed < stats.total:
-            await asyncio.sleep(2.0)
-            
-            async with buffer_lock:
-                if results_buffer:
-                    to_write = results_buffer.copy()
-                    results_buffer = []
-                else:
-                    to_write = []
-            
-            if to_write:
-                with get_connection(cfg.db_path) as conn:
-                    batch_insert(conn, to_write)
-    
-    async def reporter():
-        """Report progress"""
-        nonlocal last_completed
-        while stats.completed < stats.total:
-            await asyncio.sleep(2.0)
-            
-            delta = stats.completed - last_completed
-            recent_rates.append(delta / 2.0)
-            last_completed = stats.completed
-            avg_rate = sum(recent_rates) / len(recent_rates) if recent_rates else 0
-            
-            pct = stats.completed / stats.total * 100
-            success_pct = (stats.success / stats.completed * 100) if stats.completed > 0 else 0
-            
-            print(f"[{stats.completed:,}/{stats.total:,}] {pct:.1f}% | "
-                  f"{avg_rate:.0f}/s | "
-                  f"✓{stats.success} ({success_pct:.0f}%) ✗{stats.failed} 🛡{stats.blocked} | "
-                  f"ETA: {stats.eta()}")
-            
-            if stats.failed > 0:
-                print(f"  └─ Errors: {stats.top_errors()}")
-    
+
+    async def slow_worker():
+        """Slow-lane worker: demoted hosts get the long timeout, few at a time"""
+        while True:
+            item = await slow_queue.get()
+            if item is None:
+                return
+            domain, input_pos, prior_attempts, validators, priority = item
+            result = await fetch_in_lane("slow", domain, cfg.slow_timeout, validators)
+            await finish_first_attempt(result, input_pos, prior_attempts, priority,
+                                       cfg.slow_timeout)
+
+    async def retry_worker():
+        """Retry worker: fetch domains from the delayed lane as they come due"""
+        while True:
+            item = await retry_lane.get()
+            if item is None:
+                return
+            domain, attempts, timeout = item
+
+            try:
+                result = await fetch_in_lane("retry", domain, timeout)
+                result.attempts = attempts + 1
+
+                stats.retried += 1
+                if result.status in ("success", "blocked"):
+                    stats.recovered += 1
+                    stats.failed -= 1
+                    if result.status == "success":
+                        stats.success += 1
+                    else:
+                        stats.blocked += 1
+                elif (result.status == "http_failed"
+                        and retry_lane.should_retry(result.http["error"], result.attempts)):
+                    retry_lane.schedule(domain, result.attempts, timeout)
+
+                await emit(result)
+            finally:
+                retry_lane.done()
+
     async with aiohttp.ClientSession(
-        connector=connector,
+        connector=build_connector(cfg, resolver),
         headers={"User-Agent": cfg.user_agent},
+        trace_configs=[build_trace_config()],
     ) as session:
-        
-        print(f"Starting {cfg.workers} workers...")
-        
-        # Start background tasks
-        db_task = asyncio.create_task(db_writer())
-        reporter_task = asyncio.create_task(reporter())
-        
+
         # Start workers
         workers = [asyncio.create_task(worker()) for _ in range(cfg.workers)]
-        
-        # Wait for all work to complete
+        slow_workers = [asyncio.create_task(slow_worker())
+                        for _ in range(cfg.slow_workers)]
+        retry_workers = [asyncio.create_task(retry_worker())
+                         for _ in range(cfg.retry_workers)]
+
+        # Wait for all first attempts (fast, then slow lane), then let the
+        # retry lane drain
         await asyncio.gather(*workers)
-        
-        # Final DB flush
-        if results_buffer:
-            with get_connection(cfg.db_path) as conn:
-                batch_insert(conn, results_buffer)
-        
-        # Cancel background tasks
-        db_task.cancel()
-        reporter_task.cancel()
-    
-    # Final stats
+        for _ in slow_workers:
+            slow_queue.put_nowait(None)
+        await asyncio.gather(*slow_workers)
+        retry_lane.close()
+        await asyncio.gather(*retry_workers)
+
+
+def install_uvloop() -> bool:
+    try:
+        import uvloop
+    except ImportError:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
+def _shard_process(shard: int, cfg: FetchConfig, work_items: List[Tuple],
+                   rate_state, results_queue):
+    """Entry point of one fetcher process: its own loop, connector and resolver"""
+    if cfg.use_uvloop:
+        install_uvloop()
+    asyncio.run(_shard_async(shard, cfg, work_items, rate_state, results_queue))
+
+
+async def _shard_async(shard: int, cfg: FetchConfig, work_items: List[Tuple],
+                       rate_state, results_queue):
+    stats = Stats(total=len(work_items))
+    batch: List[FetchRecord] = []
+    last_sent = time.monotonic()
+
+    def send_results():
+        nonlocal batch, last_sent
+        if batch:
+            results_queue.put(("results", shard, batch))
+            batch = []
+        last_sent = time.monotonic()
+
+    async def emit(result: FetchRecord):
+        # Results cross the process boundary in small batches
+        batch.append(result)
+        if len(batch) >= 100 or time.monotonic() - last_sent >= 0.5:
+            send_results()
+
+    async def send_stats():
+        while True:
+            await asyncio.sleep(1.0)
+            send_results()
+            results_queue.put(("stats", shard, stats.snapshot()))
+
+    stats_task = asyncio.create_task(send_stats())
+    try:
+        await fetch_all(cfg, work_items, stats,
+                        SharedRateLimiter(cfg.rate_limit, rate_state), emit)
+    finally:
+        stats_task.cancel()
+        send_results()
+        results_queue.put(("stats", shard, stats.snapshot()))
+        results_queue.put(("done", shard, None))
+
+
+async def fetch_sharded(cfg: FetchConfig, work_items: List[Tuple], stats: Stats,
+                        writer: DBWriter):
+    """
+    Shard work by fqdn hash across cfg.processes fetcher processes.
+
+    The processes share one token bucket and send results to this process,
+    where a collector thread feeds the single DB writer and folds per-process
+    stats into `stats`.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    rate_state = SharedRateLimiter.create_state(ctx, cfg.rate_limit)
+    results_queue = ctx.Queue()
+
+    shards: List[List[Tuple]] = [[] for _ in range(cfg.processes)]
+    for item in work_items:
+        shards[shard_of(item[0], cfg.processes)].append(item)
+
+    procs = [ctx.Process(target=_shard_process, name=f"fetcher-{i}", daemon=True,
+                         args=(i, cfg, shards[i], rate_state, results_queue))
+             for i in range(cfg.processes)]
+    for proc in procs:
+        proc.start()
+
+    def collect():
+        snapshots: Dict[int, Dict] = {}
+        finished: Set[int] = set()
+        while len(finished) < len(procs):
+            try:
+                kind, shard, payload = results_queue.get(timeout=1.0)
+            except queue.Empty:
+                for i, proc in enumerate(procs):
+                    if i not in finished and not proc.is_alive():
+                        print(f"Fetcher process {i} exited with code {proc.exitcode}")
+                        finished.add(i)
+                continue
+            if kind == "results":
+                for result in payload:
+                    writer.submit(result)
+            elif kind == "stats":
+                snapshots[shard] = payload
+                stats.absorb(snapshots.values())
+            elif kind == "done":
+                finished.add(shard)
+
+    await asyncio.get_running_loop().run_in_executor(None, collect)
+    for proc in procs:
+        proc.join()
+
+
+def write_metrics(path: Optional[str], stats: Stats, final: bool = False):
+    """Append one JSON metrics record to `path` (no-op without a path)"""
+    if not path:
+        return
+    record = stats.metrics()
+    if final:
+        record["final"] = True
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + "\n")
+
+
+async def report_progress(stats: Stats, metrics_file: Optional[str] = None):
+    """Report progress every 2 seconds until cancelled"""
+    recent_rates = deque(maxlen=10)
+    last_completed = 0
+    while True:
+        await asyncio.sleep(2.0)
+
+        delta = stats.completed - last_completed
+        recent_rates.append(delta / 2.0)
+        last_completed = stats.completed
+        avg_rate = sum(recent_rates) / len(recent_rates) if recent_rates else 0
+
+        pct = stats.completed / stats.total * 100
+        success_pct = (stats.success / stats.completed * 100) if stats.completed > 0 else 0
+
+        print(f"[{stats.completed:,}/{stats.total:,}] {pct:.1f}% | "
+              f"{avg_rate:.0f}/s | "
+              f"✓{stats.success} ({success_pct:.0f}%) ✗{stats.failed} 🛡{stats.blocked} | "
+              f"ETA: {stats.eta()}")
+
+        if stats.failed > 0:
+            print(f"  └─ Errors: {stats.top_errors()}")
+        print(f"  └─ Timeout: {stats.current_timeout:.1f}s | slow lane: {stats.slow_waiting} waiting, "
+              f"{stats.demoted} demoted | worker time: {stats.lane_share()}")
+        if stats.retry_waiting or stats.retried:
+            print(f"  └─ Retry lane: {stats.retry_waiting} waiting, "
+                  f"{stats.retried} retried, {stats.recovered} recovered")
+        print(f"  └─ Phases p50/p99 ms: {stats.phase_summary()}")
+        write_metrics(metrics_file, stats)
+
+
+def print_summary(stats: Stats):
     success_pct = (stats.success / stats.completed * 100) if stats.completed > 0 else 0
     print(f"\n{'='*70}")
     print(f"COMPLETE")
@@ -449,9 +1295,25 @@ async def main_async(args):
     print(f"Success:      {stats.success:,} ({success_pct:.1f}%)")
     print(f"Failed:       {stats.failed:,}")
     print(f"Blocked:      {stats.blocked:,}")
+    if stats.not_modified:
+        print(f"Not modified: {stats.not_modified:,} (kept stored content)")
+    print(f"Retried:      {stats.retried:,} ({stats.recovered:,} recovered)")
+    print(f"Slow lane:    {stats.demoted:,} demoted")
+    print(f"Worker time:  {stats.lane_share()}")
+    lat = stats.latency.summary()
+    print(f"Latency:      p50 {lat['p50']:.0f}ms | p90 {lat['p90']:.0f}ms | p99 {lat['p99']:.0f}ms")
     print(f"Time:         {stats.elapsed:.0f}s ({stats.elapsed/60:.1f}m)")
     print(f"Rate:         {stats.rate:.1f}/s")
     print(f"{'='*70}")
+    if any(hist.count for hist in stats.phases.values()):
+        print(f"PHASES (ms)   {'count':>8} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}")
+        for p in PHASES:
+            s = stats.phases[p].summary()
+            if s["count"]:
+                print(f"  {p:11s} {s['count']:>8,} {s['p50']:>8.1f} {s['p90']:>8.1f} "
+                      f"{s['p99']:>8.1f} {s['max']:>8.1f}")
+        if stats.error_counts:
+            print(f"{'='*70}")
     if stats.error_counts:
         print(f"ERROR BREAKDOWN:")
         for err, count in sorted(stats.error_counts.items(), key=lambda x: -x[1]):
@@ -460,24 +1322,230 @@ async def main_async(args):
     print(f"{'='*70}")
 
 
-def parse_args():
-    p = argparse.ArgumentParser(description="Simple fetcher with custom DNS")
-    p.add_argument("--input", "-i", required=True)
+def config_from_args(args) -> FetchConfig:
+    for dest, default in FETCHER_ARG_DEFAULTS.items():
+        if getattr(args, dest) is None:
+            setattr(args, dest, default)
+    return FetchConfig(
+        workers=args.workers,
+        rate_limit=args.rate,
+        http_timeout=args.timeout,
+        connect_timeout=min(args.timeout, 3.0),
+        db_path=args.db,
+        dns_server=args.dns_server,
+        writer_batch_size=args.batch_size,
+        slow_workers=args.slow_workers,
+        slow_timeout=args.slow_timeout,
+        adaptive_timeout=not args.fixed_timeout,
+        retry_workers=args.retry_workers,
+        processes=max(1, args.processes),
+        use_uvloop=args.uvloop,
+        archive_dir=args.archive,
+        aging_share=args.aging_share,
+    )
+
+
+def load_work_items(args, cfg: FetchConfig):
+    """
+    Select this run's work: retry failures, stale domains or the input CSV.
+
+    Returns (work_items, run_id, input_exhausted) like load_input().
+    """
+    if args.retry_failed:
+        # Earlier transient failures straight from the DB; no input file,
+        # so no run manifest either
+        rows = [row for shard in fan_out(cfg.db_path, get_retryable_domains,
+                                         cfg.retry_max_attempts, args.limit)
+                for row in shard][:args.limit]
+        print(f"Found {len(rows):,} transient failures to retry")
+        return [(r['fqdn'], None, r['fetch_attempts'], None, None) for r in rows], None, False
+    
+    if args.refresh_days is not None:
+        # Stale domains, re-fetched with conditional requests where we
+        # have an ETag / Last-Modified. The content_hash of classified rows
+        # rides along so the pipeline can skip unchanged pages.
+        cutoff = datetime.now(timezone.utc) - timedelta(days=args.refresh_days)
+        rows = heapq.merge(*fan_out(cfg.db_path, get_domains_to_refresh,
+                                    cutoff.isoformat(), args.limit),
+                           key=lambda row: row['fetched_at'])
+        rows = list(rows)[:args.limit]
+        print(f"Found {len(rows):,} domains fetched more than {args.refresh_days:g} days ago")
+        return [(r['fqdn'], None, 0,
+                 {"etag": r['etag'], "last_modified": r['last_modified'],
+                  "content_hash": r['content_hash'] if r['classified'] else None}, None)
+                for r in rows], None, False
+    
+    return load_input(args, cfg)
+
+
+async def main_async(args, resolver=None) -> Optional[Stats]:
+    """
+    Run a fetch and return its Stats (None if there was nothing to do).
+
+    `resolver` overrides DNS resolution in single-process mode; the offline
+    benchmark uses it to point every host at its local server farm.
+    """
+    cfg = config_from_args(args)
+    if resolver is not None and cfg.processes > 1:
+        print("A custom resolver only applies in single-process mode - using 1 process")
+        cfg.processes = 1
+    if args.config:
+        configure_database(cfg.db_path, DatabaseConfig.from_toml(args.config))
+
+    init_database(cfg.db_path)
+
+    work_items, run_id, input_exhausted = load_work_items(args, cfg)
+    if work_items is None:
+        return
+
+    total = len(work_items)
+
+    if total == 0:
+        if input_exhausted:
+            with get_connection(cfg.db_path) as conn:
+                finish_fetch_run(conn, run_id)
+        print("Nothing to fetch!")
+        return
+
+    print(f"\n{'='*70}")
+    print(f"SIMPLE FETCHER (custom DNS: {cfg.dns_server})")
+    print(f"{'='*70}")
+    print(f"To fetch:         {total:,}")
+    print(f"Processes:        {cfg.processes}")
+    print(f"Workers:          {cfg.workers}" + (" per process" if cfg.processes > 1 else ""))
+    print(f"Rate limit:       {cfg.rate_limit}/s")
+    print(f"Timeout:          {cfg.http_timeout}s")
+    print(f"DNS server:       {cfg.dns_server}")
+    print(f"DB batch size:    {cfg.writer_batch_size}")
+    print(f"Slow lane:        {cfg.slow_workers} workers, {cfg.slow_timeout}s timeout")
+    print(f"Retry workers:    {cfg.retry_workers}")
+    if cfg.archive_dir:
+        print(f"Page archive:     {cfg.archive_dir}")
+    if run_id is not None:
+        print(f"Run:              {run_id}")
+    elif args.retry_failed:
+        print(f"Mode:             retry failed")
+    else:
+        print(f"Mode:             refresh (conditional)")
+    print(f"Expected time:    {total / cfg.rate_limit / 3600:.1f} hours")
+    print(f"{'='*70}\n")
+
+    stats = Stats(total=total)
+
+    # Results are committed by a dedicated writer thread
+    archive = PageArchive(cfg.archive_dir) if cfg.archive_dir else None
+    writer = DBWriter(cfg.db_path, cfg.writer_batch_size,
+                      cfg.writer_flush_interval, cfg.writer_queue_size, run_id,
+                      archive=archive)
+
+    print(f"Starting {cfg.workers * cfg.processes} workers...")
+
+    # Start background tasks
+    writer.start()
+    reporter_task = asyncio.create_task(report_progress(stats, args.metrics_file))
+
+    if cfg.processes > 1:
+        await fetch_sharded(cfg, work_items, stats, writer)
+    else:
+        await fetch_all(cfg, work_items, stats, RateLimiter(cfg.rate_limit), writer.put,
+                        resolver)
+
+    # Drain the writer queue and commit the tail
+    await asyncio.get_running_loop().run_in_executor(None, writer.close)
+
+    if input_exhausted:
+        with get_connection(cfg.db_path) as conn:
+            finish_fetch_run(conn, run_id)
+
+    # Cancel background tasks
+    reporter_task.cancel()
+
+    # Final stats
+    print_summary(stats)
+    if archive is not None:
+        print(f"Page archive: {archive.summary()}")
+    write_metrics(args.metrics_file, stats, final=True)
+    return stats
+
+
+def build_arg_parser(description: str = "Simple fetcher with custom DNS") -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(description=description)
+    p.add_argument("--input", "-i")
     p.add_argument("--db", default="wxawebcat.db")
     p.add_argument("--limit", "-n", type=int)
-    p.add_argument("--workers", "-w", type=int, default=50, 
+    p.add_argument("--workers", "-w", type=int,
                    help="Concurrent workers (default: 50)")
-    p.add_argument("--rate", "-r", type=float, default=50.0,
+    p.add_argument("--rate", "-r", type=float,
                    help="Max requests per second (default: 50)")
-    p.add_argument("--timeout", "-t", type=float, default=5.0,
+    p.add_argument("--timeout", "-t", type=float,
                    help="Request timeout in seconds (default: 5)")
     p.add_argument("--dns-server", default="165.232.131.164",
                    help="DNS server to use (default: 165.232.131.164)")
-    return p.parse_args()
+    p.add_argument("--batch-size", type=int,
+                   help="Results per DB commit (default: 500)")
+    p.add_argument("--resume", action="store_true",
+                   help="Continue the last run for this input from its checkpoint")
+    p.add_argument("--retry-failed", action="store_true",
+                   help="Re-fetch earlier transient failures from the DB instead of --input")
+    p.add_argument("--refresh-days", type=float,
+                   help="Re-fetch domains fetched more than this many days ago "
+                        "(conditional requests, classification kept if unchanged)")
+    p.add_argument("--slow-workers", type=int, default=10,
+                   help="Workers for demoted slow hosts, 0 disables the slow lane (default: 10)")
+    p.add_argument("--slow-timeout", type=float, default=15.0,
+                   help="Timeout for hosts in the slow lane (default: 15)")
+    p.add_argument("--fixed-timeout", action="store_true",
+                   help="Always use --timeout instead of adapting it to observed latencies")
+    p.add_argument("--retry-workers", type=int, default=10,
+                   help="Workers reserved for the retry lane, 0 disables retries (default: 10)")
+    p.add_argument("--processes", "-p", type=int, default=1,
+                   help="Fetcher processes, input sharded by fqdn hash (default: 1)")
+    p.add_argument("--uvloop", action="store_true",
+                   help="Use uvloop for the event loop(s) if installed")
+    p.add_argument("--archive", metavar="DIR",
+                   help="Archive compressed raw HTML in DIR for later re-extraction "
+                        "(see wxawebcat_archive.py)")
+    p.add_argument("--priority", type=int,
+                   help="Priority stored with every domain of --input (lower goes first); "
+                        "default: the input's rank column, if it has one")
+    p.add_argument("--aging-share", type=float,
+                   help="Share of the input fetched in file order rather than by priority "
+                        f"(default: {DEFAULT_AGING_SHARE})")
+    p.add_argument("--config",
+                   help="TOML config: [fetcher] fetch_concurrency / rate / timeout / batch_size "
+                        "/ aging_share for options not given on the command line, [database] for SQLite")
+    p.add_argument("--metrics-file",
+                   help="Append a JSON metrics record (rates, per-phase percentiles) "
+                        "to this file every 2 seconds")
+    return p
+
+
+def apply_config_file(args):
+    """Fill options not given on the command line from the --config [fetcher] section"""
+    section = read_toml(args.config).get("fetcher", {})
+    for key, dest in FETCHER_TOML_KEYS.items():
+        if key in section and getattr(args, dest) is None:
+            setattr(args, dest, type(FETCHER_ARG_DEFAULTS[dest])(section[key]))
+
+
+def check_args(p: argparse.ArgumentParser, args):
+    if not args.input and not args.retry_failed and args.refresh_days is None:
+        p.error("--input is required unless --retry-failed or --refresh-days is given")
+    if args.config:
+        apply_config_file(args)
+    return args
+
+
+def parse_args():
+    p = build_arg_parser()
+    return check_args(p, p.parse_args())
 
 
 if __name__ == "__main__":
-    asyncio.run(main_async(parse_args()))
+    args = parse_args()
+    if args.uvloop and not install_uvloop():
+        print("uvloop not installed - using the default event loop")
+    asyncio.run(main_async(args))
 
 # example: python3 wxawebcat_web_fetcher_simple.py   --input top1M.csv   --workers 20   --rate 15   --timeout 5
 